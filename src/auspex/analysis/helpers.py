@@ -1,6 +1,8 @@
 from auspex.data_format import AuspexDataContainer
+from auspex.catalog import RunCatalog
 from auspex.log import logger
 import datetime
+import sqlite3
 import os, re
 from os import path
 import numpy as np
@@ -35,6 +37,20 @@ def _is_auspex(path):
     else:
         return False
 
+def _cataloged_datasets(dirpath):
+    """The groups and datasets of a run, according to the run catalog of its folder, if any."""
+    dirpath = path.abspath(dirpath.rstrip('/'))
+    try:
+        catalog = RunCatalog.existing(path.dirname(dirpath))
+        if catalog:
+            try:
+                return catalog.datasets(dirpath)
+            finally:
+                catalog.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not use the run catalog for {dirpath}: {e}")
+    return {}
+
 def load_data(dirpath=None):
     """
     Open data in the .auspex file at dirpath/
@@ -84,15 +100,19 @@ def load_data(dirpath=None):
     try:
         data_container = AuspexDataContainer(dirpath)
         data_sets = {}
-        # get a list of data groups
-        groups = [x.name for x in os.scandir(dirpath)]
+        # get a list of data groups and datasets, from the run catalog if possible
+        cataloged = _cataloged_datasets(dirpath)
+        groups = list(cataloged) if cataloged else [x.name for x in os.scandir(dirpath)]
 
         for group in groups:
             # parse the data structure and pack the dict with data
             data_sets[group] = {}
-            datafiles = [x.name for x in os.scandir(dirpath + '/' + group)]
-            datasets = list(set(list(filter(lambda x: x.split('.')[1] == 'dat', datafiles))))
-            datanames = [re.match(r"(.+).dat", ds).groups()[0] for ds in datasets]
+            if cataloged:
+                datanames = list(cataloged[group])
+            else:
+                datafiles = [x.name for x in os.scandir(dirpath + '/' + group)]
+                datasets = list(set(list(filter(lambda x: x.split('.')[1] == 'dat', datafiles))))
+                datanames = [re.match(r"(.+).dat", ds).groups()[0] for ds in datasets]
             for data in datanames:
                 data_sets[group][data] = {}
                 ds_data, ds_desc = data_container.open_dataset(group,data)
@@ -147,9 +167,24 @@ def open_data(num=None, folder=None, groupname="main", datasetname="data", date=
         folder = path.join(folder, date)
         assert path.isdir(folder), f"Could not find data folder: {folder}"
 
-        p = re.compile(r".+-(\d+).auspex")
-        files = [x.name for x in os.scandir(folder) if x.is_dir()]
-        data_file = [x for x in files if p.match(x) and int(p.match(x).groups()[0]) == num]
+        # Look the run up in the catalog, falling back to a scan of the folder
+        data_file = []
+        try:
+            catalog = RunCatalog.existing(folder)
+            if catalog:
+                try:
+                    run = catalog.find(num)
+                finally:
+                    catalog.close()
+                if run and path.isdir(run):
+                    data_file = [path.basename(run)]
+        except sqlite3.Error as e:
+            logger.warning(f"Could not use the run catalog in {folder}: {e}")
+
+        if not data_file:
+            p = re.compile(r".+-(\d+).auspex")
+            files = [x.name for x in os.scandir(folder) if x.is_dir()]
+            data_file = [x for x in files if p.match(x) and int(p.match(x).groups()[0]) == num]
 
     if len(data_file) == 0:
         raise ValueError("Could not find file!")
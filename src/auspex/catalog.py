@@ -0,0 +1,181 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+__all__ = ['RunCatalog']
+
+import os, os.path
+import re
+import json
+import time
+import sqlite3
+
+class RunCatalog(object):
+    """An index of the Auspex data containers (runs) in a data directory, kept in a SQLite file
+    in that directory. Runs are named `ExperimentName-NNNN.auspex`, and the catalog records each
+    run along with its groups and datasets, their shapes, types and axes, and when they were
+    created. It is updated as datasets are written, and allocates run numbers, so that neither
+    requires scanning the directory.
+
+    A new catalog indexes the runs already in its directory once. Use `rebuild()` if runs have
+    since been added or removed by other means.
+
+    Example:
+
+        >>> catalog = RunCatalog('/path/to/my/data/190301')
+        >>> catalog.find(42)
+        '/path/to/my/data/190301/Experiment-0042.auspex'
+    """
+
+    filename = "auspex_catalog.sqlite"
+
+    # Matches the run number of a container
+    run_pattern = re.compile(r"(.+)-(\d{4,})\.auspex$")
+
+    def __init__(self, dirname):
+        super(RunCatalog, self).__init__()
+        self.dirname = os.path.abspath(dirname)
+        os.makedirs(self.dirname, exist_ok=True)
+        path = os.path.join(self.dirname, self.filename)
+        new_catalog = not os.path.exists(path)
+        self.db = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                num INTEGER NOT NULL,
+                path TEXT NOT NULL UNIQUE,
+                created REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS runs_num ON runs (num);
+            CREATE TABLE IF NOT EXISTS datasets (
+                run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+                groupname TEXT NOT NULL,
+                datasetname TEXT NOT NULL,
+                shape TEXT NOT NULL,
+                dtype TEXT NOT NULL,
+                axes TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (run_id, groupname, datasetname));
+        """)
+        if new_catalog:
+            self.rebuild()
+
+    @classmethod
+    def existing(cls, dirname):
+        """Open the catalog of a directory if it has one, otherwise return None."""
+        if os.path.exists(os.path.join(dirname, cls.filename)):
+            return cls(dirname)
+        return None
+
+    def close(self):
+        self.db.close()
+
+    def rebuild(self):
+        """Index the runs, and their datasets, that are in the directory."""
+        with self._transaction():
+            self.db.execute("DELETE FROM datasets")
+            self.db.execute("DELETE FROM runs")
+            for entry in os.scandir(self.dirname):
+                if entry.is_dir() and self.run_pattern.match(entry.name):
+                    run_id = self._add_run(entry.path, entry.stat().st_mtime)
+                    for group in os.scandir(entry.path):
+                        if not group.is_dir():
+                            continue
+                        for meta_file in os.scandir(group.path):
+                            if meta_file.name.endswith('_meta.json'):
+                                try:
+                                    with open(meta_file.path, 'r') as f:
+                                        meta = json.load(f)
+                                except (OSError, ValueError):
+                                    continue
+                                self._add_dataset(run_id, group.name, meta_file.name[:-len('_meta.json')], meta, meta_file.stat().st_mtime)
+
+    def _transaction(self):
+        return _Transaction(self.db)
+
+    def _add_run(self, path, created=None):
+        path = os.path.abspath(path)
+        match = self.run_pattern.match(os.path.basename(path))
+        if not match:
+            raise ValueError(f"{path} is not a numbered Auspex run.")
+        self.db.execute("INSERT OR IGNORE INTO runs (name, num, path, created) VALUES (?, ?, ?, ?)",
+                        (match.group(1), int(match.group(2)), path, created or time.time()))
+        return self.db.execute("SELECT id FROM runs WHERE path = ?", (path,)).fetchone()[0]
+
+    def _add_dataset(self, run_id, groupname, datasetname, meta, created=None):
+        axes = [{'name': name, 'unit': meta['units'].get(name), 'num_points': len(points)}
+                for name, points in meta['axes'].items()]
+        self.db.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (run_id, groupname, datasetname, json.dumps(meta['shape']), meta['dtype'],
+                         json.dumps(axes), created or time.time()))
+
+    def allocate(self, basename):
+        """Reserve the next run number in the directory for a run called `basename`, and
+        return the path of the new run (without the .auspex extension)."""
+        with self._transaction():
+            num = self.db.execute("SELECT COALESCE(MAX(num) + 1, 0) FROM runs").fetchone()[0]
+            # Skip over any runs created without the catalog
+            while os.path.exists(os.path.join(self.dirname, f"{basename}-{num:04d}.auspex")):
+                num += 1
+            path = os.path.join(self.dirname, f"{basename}-{num:04d}")
+            self._add_run(path + ".auspex")
+        return path
+
+    def latest(self, name=None):
+        """Return the path of the most recent run (called `name`, if given) without the .auspex
+        extension, or None if there are no runs."""
+        if name is None:
+            row = self.db.execute("SELECT path FROM runs ORDER BY num DESC LIMIT 1").fetchone()
+        else:
+            row = self.db.execute("SELECT path FROM runs WHERE name = ? ORDER BY num DESC LIMIT 1", (name,)).fetchone()
+        return row[0][:-len(".auspex")] if row else None
+
+    def add_dataset(self, path, groupname, datasetname, meta):
+        """Record a dataset of the run at `path`, described by its metadata."""
+        with self._transaction():
+            self._add_dataset(self._add_run(path), groupname, datasetname, meta)
+
+    def find(self, num, name=None):
+        """Return the path of the run with the given number (and name, if there are several), or
+        None if there is no such run."""
+        if name is None:
+            rows = self.db.execute("SELECT path FROM runs WHERE num = ?", (num,)).fetchall()
+        else:
+            rows = self.db.execute("SELECT path FROM runs WHERE num = ? AND name = ?", (num, name)).fetchall()
+        if len(rows) > 1:
+            raise ValueError(f"Ambiguous file information: found {[r[0] for r in rows]}")
+        return rows[0][0] if rows else None
+
+    def runs(self, name=None):
+        """Return a list of (name, number, path, creation time) for the runs, in order."""
+        query = "SELECT name, num, path, created FROM runs"
+        if name is None:
+            return self.db.execute(query + " ORDER BY num").fetchall()
+        return self.db.execute(query + " WHERE name = ? ORDER BY num", (name,)).fetchall()
+
+    def datasets(self, path):
+        """Return a dictionary of the datasets of a run, keyed by group and then by dataset name,
+        with their shapes, types, axes (names, units and number of points), and creation times."""
+        rows = self.db.execute("""SELECT groupname, datasetname, shape, dtype, axes, datasets.created
+                                  FROM datasets JOIN runs ON runs.id = run_id WHERE runs.path = ?""",
+                               (os.path.abspath(path),)).fetchall()
+        result = {}
+        for groupname, datasetname, shape, dtype, axes, created in rows:
+            result.setdefault(groupname, {})[datasetname] = {'shape': tuple(json.loads(shape)), 'dtype': dtype,
+                                                             'axes': json.loads(axes), 'created': created}
+        return result
+
+class _Transaction(object):
+    """Runs a block of statements as a single, immediately locked, transaction."""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
@@ -27,6 +27,10 @@ auspex_dummy_mode = False
 # the requested qubit frequency and sidebanding.
 qubit_IF_priority = False
 
+# Optional auspex.filters.FilterRuntime shared by all experiments, whose
+# persistent workers run the filter pipeline instead of fresh processes.
+filter_runtime = None
+
 ConfigurationFile = None
 LogDir            = None
 
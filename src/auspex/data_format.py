@@ -6,10 +6,259 @@
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 
-from .stream import DataStreamDescriptor, DataAxis
+from .stream import DataStreamDescriptor, DataAxis, SweepAxis
+from .catalog import RunCatalog
+from .log import logger
 import numpy as np
 import os, os.path
 import json
+import zlib
+import lzma
+import sqlite3
+from collections.abc import MutableMapping
+
+# Compressors available to chunked (version 2) datasets
+COMPRESSORS = {
+    'none': (lambda b, level: b, lambda b: b),
+    'zlib': (lambda b, level: zlib.compress(b, level), zlib.decompress),
+    'lzma': (lambda b, level: lzma.compress(b, preset=level), lzma.decompress)
+}
+
+class LazyDataAxis(DataAxis):
+    """A DataAxis read from a dataset's metadata. The points are kept as they were parsed and
+    only turned into an array when first used, so opening a dataset with long axes is cheap."""
+    def __init__(self, name, points, unit=None, metadata=None):
+        self._raw_points = None
+        super(LazyDataAxis, self).__init__(name, unit=unit, metadata=metadata)
+        self._raw_points = points
+        self._points     = None
+        self._original   = None
+
+    def _build(self):
+        if self._raw_points is not None:
+            self._points      = np.array(self._raw_points)
+            self._original    = self._points
+            self._raw_points  = None
+
+    @property
+    def points(self):
+        self._build()
+        return self._points
+
+    @points.setter
+    def points(self, value):
+        self._build()
+        self._points = value
+
+    @property
+    def original_points(self):
+        self._build()
+        return self._original
+
+    @original_points.setter
+    def original_points(self, value):
+        self._build()
+        self._original = value
+
+    def num_points(self):
+        if self._raw_points is not None:
+            return len(self._raw_points)
+        return super(LazyDataAxis, self).num_points()
+
+class AuspexDataset(np.memmap):
+    """A (version 1) dataset opened from disk. This is a copy-on-write memory map of the data
+    file in the shape of the dataset, so opening is cheap and only the parts of the data that
+    are used are read. Changes are never written back to disk. Use `load()` for an in-memory
+    copy, e.g. before the container is removed."""
+    def load(self):
+        return np.array(self)
+
+class LazyGroup(MutableMapping):
+    """The datasets in a group, each of which is opened when it is first accessed."""
+    def __init__(self, container, groupname, datasetnames=()):
+        super(LazyGroup, self).__init__()
+        self.container = container
+        self.groupname = groupname
+        self.datasets  = dict.fromkeys(datasetnames)
+
+    def __getitem__(self, datasetname):
+        if self.datasets[datasetname] is None:
+            self.datasets[datasetname] = self.container.open_dataset(self.groupname, datasetname)
+        return self.datasets[datasetname]
+
+    def __setitem__(self, datasetname, value):
+        self.datasets[datasetname] = value
+
+    def __delitem__(self, datasetname):
+        del self.datasets[datasetname]
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __repr__(self):
+        return f"<LazyGroup {self.groupname}: {list(self.datasets)}>"
+
+class ChunkedDatasetWriter(object):
+    """Appends data to a version 2 dataset. Data is gathered into fixed-size chunks, each of
+    which is compressed independently and appended to the data file, with its offset, size,
+    and number of points appended to the index file. A final partial chunk is written when
+    the writer is closed. The files are opened on the first write, so that the writer can be
+    handed to another process before use."""
+    def __init__(self, filename, index_filename, dtype, chunk_points, compression='zlib', level=1):
+        super(ChunkedDatasetWriter, self).__init__()
+        self.filename       = filename
+        self.index_filename = index_filename
+        self.dtype          = np.dtype(dtype)
+        self.chunk_points   = chunk_points
+        self.compression    = compression
+        self.level          = level
+        self.file           = None
+        self.index_file     = None
+        self.chunk          = None
+        self.chunk_idx      = 0
+        self.offset         = 0
+        self.points_written = 0
+
+    def write(self, data):
+        if self.file is None:
+            self.file       = open(self.filename, 'ab')
+            self.index_file = open(self.index_filename, 'ab')
+            self.offset     = self.file.tell()
+            if self.chunk is None:
+                self.chunk  = np.empty(self.chunk_points, dtype=self.dtype)
+        data = np.ravel(data)
+        while data.size > 0:
+            num = min(data.size, self.chunk_points - self.chunk_idx)
+            self.chunk[self.chunk_idx:self.chunk_idx+num] = data[:num]
+            self.chunk_idx += num
+            data = data[num:]
+            if self.chunk_idx == self.chunk_points:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        buf = COMPRESSORS[self.compression][0](self.chunk[:self.chunk_idx].tobytes(), self.level)
+        self.file.write(buf)
+        self.index_file.write(np.array([self.offset, len(buf), self.chunk_idx], dtype=np.int64).tobytes())
+        self.file.flush()
+        self.index_file.flush()
+        self.offset += len(buf)
+        self.points_written += self.chunk_idx
+        self.chunk_idx = 0
+
+    def truncate(self, points):
+        """Discard everything past the first `points` points (or as many as have been written),
+        so that writing continues from there. Returns the number of points kept. The chunk
+        that `points` falls in is read back, so it can be completed by further writes."""
+        assert self.file is None, "Chunked datasets can only be truncated before writing."
+        index = np.fromfile(self.index_filename, dtype=np.int64).reshape(-1, 3)
+        # Any partial chunk read back by an earlier call follows the chunks in the index
+        points = min(points, int(np.sum(index[:, 2])) + self.chunk_idx)
+        num_chunks, remainder = divmod(points, self.chunk_points)
+        if self.chunk is None:
+            self.chunk = np.empty(self.chunk_points, dtype=self.dtype)
+        self.chunk_idx = remainder
+        if remainder > 0 and num_chunks < len(index):
+            offset, nbytes, npoints = index[num_chunks]
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                buf = COMPRESSORS[self.compression][1](f.read(nbytes))
+            self.chunk[:remainder] = np.frombuffer(buf, dtype=self.dtype, count=remainder)
+        if num_chunks < len(index):
+            os.truncate(self.filename, index[num_chunks, 0])
+        os.truncate(self.index_filename, num_chunks*index.itemsize*3)
+        self.points_written = num_chunks*self.chunk_points
+        return points
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.chunk_idx > 0:
+            self._write_chunk()
+        self.file.close()
+        self.index_file.close()
+        self.file = None
+        self.index_file = None
+
+class ChunkedDataset(object):
+    """Read access to a version 2 dataset. Indexing decompresses only the chunks that hold
+    the requested records (slices along the leading, swept, axes), and the most recently used
+    chunk is cached. Use `np.array(dataset)` or `dataset[...]` to read everything. Chunks
+    that were never written, e.g. if the run was interrupted, read as zeros."""
+    def __init__(self, filename, index_filename, shape, dtype, chunk_points, record_dims, compression):
+        super(ChunkedDataset, self).__init__()
+        self.filename       = filename
+        self.index_filename = index_filename
+        self.shape          = tuple(shape)
+        self.dtype          = np.dtype(dtype)
+        self.chunk_points   = chunk_points
+        self.record_shape   = self.shape[len(self.shape)-record_dims:]
+        self.sweep_shape    = self.shape[:len(self.shape)-record_dims]
+        self.record_points  = int(np.prod(self.record_shape))
+        self.compression    = compression
+        self.index          = np.fromfile(index_filename, dtype=np.int64).reshape(-1, 3)
+        self._cached        = (None, None)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"<ChunkedDataset shape={self.shape} dtype={self.dtype} chunks={len(self.index)}>"
+
+    def read_chunk(self, k):
+        if self._cached[0] == k:
+            return self._cached[1]
+        if k < len(self.index):
+            offset, nbytes, npoints = self.index[k]
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                buf = COMPRESSORS[self.compression][1](f.read(nbytes))
+            chunk = np.frombuffer(buf, dtype=self.dtype, count=npoints)
+        else:
+            chunk = np.zeros(0, dtype=self.dtype)
+        self._cached = (k, chunk)
+        return chunk
+
+    def read_records(self, records):
+        """Return the requested (flat) record indices as an array of shape (len(records),) + record_shape."""
+        out = np.zeros((len(records), self.record_points), dtype=self.dtype)
+        points = records[:, np.newaxis]*self.record_points + np.arange(self.record_points)
+        chunks = records*self.record_points // self.chunk_points
+        for k in np.unique(chunks):
+            chunk = self.read_chunk(k)
+            local = points[chunks == k] - k*self.chunk_points
+            valid = local < chunk.size
+            out[chunks == k] = np.where(valid, chunk[np.minimum(local, max(chunk.size-1, 0))] if chunk.size else 0, 0)
+        return out.reshape((len(records),) + self.record_shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+        sweep_key, record_key = key[:len(self.sweep_shape)], key[len(self.sweep_shape):]
+        records = np.arange(int(np.prod(self.sweep_shape))).reshape(self.sweep_shape)[sweep_key]
+        data = self.read_records(np.ravel(records)).reshape(np.shape(records) + self.record_shape)
+        return data[(Ellipsis,) + record_key]
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def load(self):
+        return self[...]
 
 class AuspexDataContainer(object):
     """A container for Auspex data. Data is stored as `datasets` which may be of any dimension. These are in turn
@@ -68,32 +317,60 @@ class AuspexDataContainer(object):
         if self.mode not in ['a', 'w+']:
             assert not os.path.exists(self.base_path), "Existing data container found. Did you want to open instead?"
         os.makedirs(os.path.join(self.base_path,groupname), exist_ok=True)
-        self.groups[groupname] = {}
+        self.groups[groupname] = LazyGroup(self, groupname)
 
-    def new_dataset(self, groupname, datasetname, descriptor):
+    def new_dataset(self, groupname, datasetname, descriptor, version=1, compression='zlib', chunk_bytes=2**20):
         """Add a dataset to a specific group.
 
         Args:
-            groupname:          Name of the group to which to add the dataset.
-            datasetname:        Name of the dataset to be added.
-            descriptor:         `DataStreamDescriptor` that describes the dataset that is to be added.
+            groupname:              Name of the group to which to add the dataset.
+            datasetname:            Name of the dataset to be added.
+            descriptor:             `DataStreamDescriptor` that describes the dataset that is to be added.
+            version (optional):     1 for a flat binary file (returns a memmap), 2 for compressed chunks
+                                    (returns a `ChunkedDatasetWriter`). Defaults to 1.
+            compression (optional): Compression of version 2 chunks: 'zlib', 'lzma', or 'none'.
+            chunk_bytes (optional): Approximate uncompressed size of version 2 chunks. Chunks always hold
+                                    whole records along the sweep axes.
         """
+        if version == 2:
+            assert compression in COMPRESSORS, f"Unknown compression {compression}. Options are {list(COMPRESSORS)}"
+            shape = tuple(descriptor.dims())
+            # Swept axes lead, chunks hold whole records of the remaining axes
+            num_swept = next((i for i, a in enumerate(descriptor.axes) if not isinstance(a, SweepAxis)), len(shape))
+            record_dims = len(shape) - (max(num_swept, 1) if shape else 0)
+            record_points = int(np.prod(shape[len(shape)-record_dims:]))
+            chunk_points = record_points*max(1, chunk_bytes // (record_points*np.dtype(descriptor.dtype).itemsize))
+            self._create_meta(groupname, datasetname, descriptor, version=2, compression=compression,
+                              chunk_points=chunk_points, record_dims=record_dims)
+            filename = os.path.join(self.base_path,groupname,datasetname+'.dat')
+            index_filename = os.path.join(self.base_path,groupname,datasetname+'.idx')
+            for fn in (filename, index_filename):
+                assert not os.path.exists(fn), "Existing dataset found. Did you want to open instead?"
+                open(fn, 'wb').close()
+            writer = ChunkedDatasetWriter(filename, index_filename, descriptor.dtype, chunk_points, compression)
+            self.groups[groupname][datasetname] = writer
+            return writer
         self._create_meta(groupname, datasetname, descriptor)
         mmap = self._create_memmap(groupname, datasetname, (np.product(descriptor.dims()),), descriptor.dtype)
         self.groups[groupname][datasetname] = mmap
         return mmap
 
-    def _create_meta(self, groupname, datasetname, descriptor):
+    def _create_meta(self, groupname, datasetname, descriptor, version=1, **kwargs):
         """Create the metafile which accompanies the binary data.
 
         Args:
             groupname:          Name of group for which to create the metafile.
             datasetname:        Name of dataset for which to create the metafile.
             descriptor:         `DataStreamDescriptor` that describes the dataset.
+            version (optional): Version of the dataset layout. Any keyword arguments are stored
+                                alongside it, to describe the layout.
         """
         filename = os.path.join(self.base_path,groupname,datasetname+'_meta.json')
         assert not os.path.exists(filename), "Existing dataset metafile found. Did you want to open instead?"
         meta = {'shape': tuple(descriptor.dims()), 'dtype': np.dtype(descriptor.dtype).str}
+        if version > 1:
+            meta['version'] = version
+            meta.update(kwargs)
         meta['axes'] = {a.name: a.points.tolist() for a in descriptor.axes}
         meta['units'] = {a.name: a.unit for a in descriptor.axes}
         meta['meta_data'] = {}
@@ -103,8 +380,70 @@ class AuspexDataContainer(object):
             else:
                 meta['meta_data'][a.name] = None
         meta['filename'] = os.path.join(self.base_path,groupname,datasetname)
+        meta['committed_points'] = 0
         with open(filename, 'w') as f:
             json.dump(meta, f)
+        self._catalog(groupname, datasetname, meta)
+
+    def _catalog(self, groupname, datasetname, meta):
+        """Record a new dataset in the `RunCatalog` of the directory holding this container."""
+        if not RunCatalog.run_pattern.match(os.path.basename(self.base_path)):
+            return
+        try:
+            catalog = RunCatalog(os.path.dirname(self.base_path))
+            try:
+                catalog.add_dataset(self.base_path, groupname, datasetname, meta)
+            finally:
+                catalog.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Could not add {groupname}/{datasetname} to the run catalog: {e}")
+
+    def _read_meta(self, groupname, datasetname):
+        filename = os.path.join(self.base_path,groupname,datasetname+'_meta.json')
+        assert os.path.exists(filename), "Could not find dataset. Is this the correct name?"
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+    def commit(self, groupname, datasetname, points):
+        """Record that the first `points` points of a dataset have been written to disk, so
+        that an interrupted run can be resumed from there. The metafile is replaced atomically."""
+        meta = self._read_meta(groupname, datasetname)
+        meta['committed_points'] = int(points)
+        filename = os.path.join(self.base_path,groupname,datasetname+'_meta.json')
+        with open(filename+'.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(filename+'.tmp', filename)
+
+    def resume_dataset(self, groupname, datasetname, descriptor, version=1, **kwargs):
+        """Reopen a dataset for appending, or create it (see `new_dataset`) if it does not exist yet.
+
+        Returns:
+            dataset:            A writable memmap or a `ChunkedDatasetWriter`, as for `new_dataset`.
+            committed_points:   The number of points committed so far, where writing should continue.
+        """
+        if groupname not in self.groups:
+            self.new_group(groupname)
+        if not os.path.exists(os.path.join(self.base_path,groupname,datasetname+'_meta.json')):
+            return self.new_dataset(groupname, datasetname, descriptor, version=version, **kwargs), 0
+
+        meta = self._read_meta(groupname, datasetname)
+        if tuple(meta['shape']) != tuple(descriptor.dims()) or np.dtype(meta['dtype']) != np.dtype(descriptor.dtype):
+            raise ValueError(f"Cannot resume dataset {groupname}/{datasetname} of shape {tuple(meta['shape'])} and type "
+                             f"{meta['dtype']} with data of shape {tuple(descriptor.dims())} and type {np.dtype(descriptor.dtype).str}.")
+        if meta.get('version', 1) != version:
+            raise ValueError(f"Cannot resume version {meta.get('version', 1)} dataset {groupname}/{datasetname} as version {version}.")
+        committed = meta.get('committed_points', 0)
+
+        filename = os.path.join(self.base_path,groupname,datasetname+'.dat')
+        if version == 2:
+            dataset = ChunkedDatasetWriter(filename, os.path.join(self.base_path,groupname,datasetname+'.idx'),
+                                           meta['dtype'], meta['chunk_points'], meta['compression'])
+            committed = dataset.truncate(committed)
+        else:
+            dataset = np.memmap(filename, dtype=meta['dtype'], mode='r+', shape=(np.product(meta['shape']),))
+            self.open_mmaps.append(dataset)
+        self.groups[groupname][datasetname] = dataset
+        return dataset, committed
 
     def _create_memmap(self, groupname, datasetname, shape, dtype, mode='w+'):
         """Create a memmap (memory-mapped array on disk) for a dataset.
@@ -125,21 +464,18 @@ class AuspexDataContainer(object):
         
     def open_all(self):
         """Open all of the datasets contained in this DataContainer. This also populates the 
-        list of groups.
+        list of groups. Datasets are only opened when they are first accessed.
 
         Returns:
-            A dictionary of all of the datasets, which each item as an (array, descriptor) tuple.
+            A dictionary of all of the datasets, which each item as an (array, descriptor, path) tuple.
         """
         ret = {}
         for groupname in os.listdir(self.base_path):
-            ret[groupname] = {}
-            self.groups[groupname] = {}
-            for datasetname in os.listdir(os.path.join(self.base_path,groupname)):
-                if datasetname[-4:] == '.dat':
-                    dat = self.open_dataset(groupname, datasetname[:-4])
-                    self.groups[groupname][datasetname[:-4]] = dat
-                    ret[groupname][datasetname[:-4]] = dat
+            datasetnames = [d[:-4] for d in os.listdir(os.path.join(self.base_path,groupname)) if d[-4:] == '.dat']
+            self.groups[groupname] = LazyGroup(self, groupname, datasetnames)
+            ret[groupname] = self.groups[groupname]
         return ret
+
     def open_dataset(self, groupname, datasetname):
         """Open a particular dataset stored in this DataContainer.
 
@@ -148,24 +484,21 @@ class AuspexDataContainer(object):
             datasetname:    The name of the dataset that is to be opened.
 
         Returns:
-            data:           A numpy array of the data stored.
+            data:           An `AuspexDataset` (a lazily read numpy array) of the data stored, or a
+                            `ChunkedDataset` for version 2 datasets. Use `data.load()` to read it into memory.
             desc:           `DataStreamDescriptor` for the data stored.
         """
-        filename = os.path.join(self.base_path,groupname,datasetname+'_meta.json')
-        assert os.path.exists(filename), "Could not find dataset. Is this the correct name?"
-        with open(filename, 'r') as f:
-            meta = json.load(f)
+        meta = self._read_meta(groupname, datasetname)
 
         filename = os.path.join(self.base_path,groupname,datasetname+'.dat')
         assert os.path.exists(filename), "Could not find dataset. Is this the correct name?"
-        flat_shape = (np.product(meta['shape']),)
-        mm = np.memmap(filename, dtype=meta['dtype'], mode='r', shape=flat_shape)
-        data = np.array(mm).reshape(tuple(meta['shape']))
-        del mm
+        if meta.get('version', 1) == 2:
+            data = ChunkedDataset(filename, os.path.join(self.base_path,groupname,datasetname+'.idx'), meta['shape'],
+                                  meta['dtype'], meta['chunk_points'], meta['record_dims'], meta['compression'])
+        else:
+            data = AuspexDataset(filename, dtype=meta['dtype'], mode='c', shape=tuple(meta['shape']))
 
         desc = DataStreamDescriptor(meta['dtype'])
         for name, points in meta['axes'].items():
-            ax = DataAxis(name, points, unit=meta['units'][name])
-            ax.metadata = meta['meta_data'][name]
-            desc.add_axis(ax)
+            desc.add_axis(LazyDataAxis(name, points, unit=meta['units'][name], metadata=meta['meta_data'][name]))
         return data, desc, self.base_path.replace('.auspex', '')
@@ -40,8 +40,10 @@ import numbers
 import subprocess
 import queue
 import re
+import sqlite3
 import cProfile
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import zmq
 import numpy as np
@@ -53,6 +55,7 @@ from auspex.parameter import ParameterGroup, FloatParameter, IntParameter, Param
 from auspex.sweep import Sweeper
 from auspex.stream import DataStream, DataAxis, SweepAxis, DataStreamDescriptor, InputConnector, OutputConnector
 from auspex.filters import Plotter, MeshPlotter, ManualPlotter, WriteToFile, DataBuffer, Filter
+from auspex.catalog import RunCatalog
 from auspex.log import logger
 import auspex.config
 from auspex.config import isnotebook
@@ -62,8 +65,9 @@ def auspex_plot_server():
     client_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"plot_server.py")
     subprocess.Popen(['python', client_path], env=os.environ.copy())
 
-def update_filename(filename, add_date=True):
-    """Update the file number and date."""
+def update_filename(filename, add_date=True, resume=False):
+    """Update the file number and date. If resuming, return the most recent file number instead
+    of the next one, if there is one. File numbers come from the directory's `RunCatalog`."""
     basename, _ = os.path.splitext(filename)
     dirname  = os.path.dirname(os.path.abspath(filename))
 
@@ -72,6 +76,16 @@ def update_filename(filename, add_date=True):
         dirname  = os.path.join(dirname, date)
         basename = os.path.join(dirname, os.path.basename(basename))
 
+    try:
+        catalog = RunCatalog(dirname)
+        try:
+            latest = catalog.latest(os.path.basename(basename)) if resume else None
+            return latest if latest else catalog.allocate(os.path.basename(basename))
+        finally:
+            catalog.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Could not use the run catalog in {dirname} ({e}), scanning the directory instead.")
+
     # Set the file number to the maximum in the current folder + 1
     filenums = []
     if os.path.exists(dirname):
@@ -81,7 +95,10 @@ def update_filename(filename, add_date=True):
                 if len(nums) > 0:
                     filenums.append(int(nums[0]))
 
-    i = max(filenums) + 1 if filenums else 0
+    if resume and filenums:
+        i = max(filenums)
+    else:
+        i = max(filenums) + 1 if filenums else 0
     return "{}-{:04d}".format(basename,i)
 
 class ExperimentGraph(object):
@@ -118,6 +135,47 @@ class ExperimentGraph(object):
 
         self.dag = dag
 
+    def fuse_chains(self, nodes):
+        """Mark the streams of linear filter chains as fused, so that each chain runs in a
+        single process and data passes between its stages without any copies or IPC. A stream
+        is fused when its upstream filter has no other output stream and its downstream filter
+        has no other input and relies on the generic Filter main loop. Process boundaries are
+        kept at fan-out and fan-in, and around filters that are not fusible.
+
+        Returns the list of filters that now run inside the process of another."""
+        for stream in self.edges:
+            stream.fused = False
+        for node in nodes:
+            if isinstance(node, Filter):
+                node.fused_filters = []
+
+        hosted = []
+        for stream in self.edges:
+            upstream, downstream = stream.start_connector.parent, stream.end_connector.parent
+            if not (isinstance(upstream, Filter) and isinstance(downstream, Filter)):
+                continue
+            if upstream not in nodes or downstream not in nodes:
+                continue
+            if not (upstream.fusible and downstream.fusible):
+                continue
+            if sum(len(oc.output_streams) for oc in upstream.output_connectors.values()) != 1:
+                continue
+            if sum(len(ic.input_streams) for ic in downstream.input_connectors.values()) != 1:
+                continue
+            if type(downstream).main is not Filter.main or type(downstream).checkin is not Filter.checkin:
+                continue
+            stream.fused = True
+            hosted.append(downstream)
+
+        # Each chain runs in the process of its first filter
+        for filt in hosted:
+            host = filt
+            while host in hosted:
+                host = next(s for ic in host.input_connectors.values() for s in ic.input_streams).start_connector.parent
+            host.fused_filters.append(filt)
+            logger.debug(f"Fusing {filt} into the process of {host}")
+        return hosted
+
 class MetaExperiment(type):
     """Meta class to bake the instrument objects into a class description
     """
@@ -156,6 +214,10 @@ class MetaExperiment(type):
 
 class Experiment(metaclass=MetaExperiment):
     """The measurement loop to be run for each set of sweep parameters."""
+
+    # Most instruments that are connected or configured at once
+    max_instrument_threads = 8
+
     def __init__(self):
         super(Experiment, self).__init__()
         # Experiment name
@@ -179,6 +241,15 @@ class Experiment(metaclass=MetaExperiment):
         # Disconnect at the end of experiment?
         self.keep_instruments_connected = False
 
+        # Run linear chains of filters in a single process?
+        self.fuse_filters = True
+        self.process_nodes = []
+
+        # Persistent filter workers to use instead of new processes, if any
+        self.runtime = auspex.config.filter_runtime
+        self.runtime_streams = False
+        self.pooled_nodes = []
+
         # Also keep references to all of the plot filters
         self.plotters = [] # Standard pipeline plotters using streams
         self.extra_plotters = [] # Plotters using streams, but not the pipeline
@@ -199,12 +270,22 @@ class Experiment(metaclass=MetaExperiment):
         # indicates whether the instruments are already connected
         self.instrs_connected = False
 
+        # Connect and configure instruments from several threads? Off by default, since not every
+        # driver (or the libraries and interfaces behind it) can be used from several threads at
+        # once. Instruments (by name) listed in instrument_dependencies are only handled once
+        # those they depend on are done, e.g. {'awg': ['clock']}
+        self.concurrent_instruments = False
+        self.instrument_dependencies = {}
+
         # indicates whether this is the first (or only) experiment in a series (e.g. for pulse calibrations)
         self.first_exp = True
 
         # add date to data files?
         self.add_date = False
 
+        # Continue the most recent data files, and the sweep, from where they left off?
+        self.resume = False
+
         # save channel library
         self.save_chanddb = False
 
@@ -255,6 +336,9 @@ class Experiment(metaclass=MetaExperiment):
                 unique_nodes.append(ee.parent)
         self.nodes = unique_nodes
         self.graph = ExperimentGraph(edges)
+        for node in self.nodes:
+            if isinstance(node, Filter):
+                node.check_inputs()
 
     def init_streams(self):
         """Establish the base descriptors for any internal data streams and connectors."""
@@ -324,8 +408,7 @@ class Experiment(metaclass=MetaExperiment):
     def sweep(self):
         # Set any static parameters
         static_params = [p for p in self._parameters.values() if p not in self.sweeper.swept_parameters()]
-        for p in static_params:
-            p.push()
+        self.sweeper.push_parameters(static_params)
 
         # Keep track of the previous values
         logger.debug("Waiting for filters.")
@@ -353,17 +436,9 @@ class Experiment(metaclass=MetaExperiment):
             if self.sweeper.is_adaptive():
                 # Add the new tuples to the stream descriptors
                 for oc in self.output_connectors.values():
-                    # Obtain the lists of values for any fixed
-                    # DataAxes and append them to them to the sweep_values
-                    # in preperation for finding all combinations.
-                    vals = [a for a in oc.descriptor.data_axis_values()]
-                    if sweep_values:
-                        vals  = [[v] for v in sweep_values] + vals
-                    # Find all coordinate tuples and update the list of
-                    # tuples that the experiment has probed.
-                    nested_list    = list(itertools.product(*vals))
-                    flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-                    oc.descriptor.visited_tuples = oc.descriptor.visited_tuples + flattened_list
+                    # Combine the sweep values with every point of the fixed DataAxes
+                    # and update the list of tuples that the experiment has probed.
+                    oc.descriptor.add_visited_tuples(oc.descriptor.sweep_tuples(sweep_values))
 
                     # Since the filters are in separate processes, pass them the same
                     # information so that they may perform the same operations.
@@ -372,6 +447,10 @@ class Experiment(metaclass=MetaExperiment):
             # Run the procedure
             self.run()
 
+            # Set up the next point while this one is wrapped up
+            if self.sweeper.prefetch:
+                self.sweeper.prefetch_next()
+
             # See if the axes want to extend themselves. They will push updates
             # directly to the output_connecters as messages that will be passed
             # through the filter pipeline.
@@ -385,10 +464,69 @@ class Experiment(metaclass=MetaExperiment):
     def connect_instruments(self):
         # Connect the instruments to their resources
         if not self.instrs_connected:
-            for instrument in self._instruments.values():
-                instrument.connect()
+            self.for_each_instrument(lambda instrument: instrument.connect(), "Connected")
             self.instrs_connected = True
 
+    def for_each_instrument(self, action, description="Configured", dependencies=None):
+        """Call `action(instrument)` for each of the experiment's instruments. If
+        concurrent_instruments is True, the calls are made from a pool of threads, with each
+        instrument handed to the pool as soon as the instruments it depends on (according to
+        `dependencies`, or instrument_dependencies by default) are done. Otherwise they are made
+        one at a time from the calling thread, in an order that respects the dependencies. The
+        time taken for each instrument is logged. If any call fails, no further instruments are
+        started and the first exception is raised once the calls already running are over."""
+        if dependencies is None:
+            dependencies = self.instrument_dependencies
+        names = list(self._instruments.keys())
+        waiting = {}
+        for name in names:
+            deps = set(dependencies.get(name, ()))
+            if not deps.issubset(names):
+                raise ValueError(f"Instrument {name} depends on unknown instruments {deps.difference(names)}.")
+            waiting[name] = deps
+
+        def timed(name):
+            start = time.time()
+            action(self._instruments[name])
+            logger.info(f"{description} instrument {name} in {time.time()-start:.3f} s")
+
+        start = time.time()
+        if not self.concurrent_instruments:
+            # Some drivers can only be used from the thread that opened them, so stay on this one
+            while waiting:
+                ready = [n for n, deps in waiting.items() if not deps]
+                if not ready:
+                    raise ValueError(f"Instruments {list(waiting.keys())} have circular dependencies.")
+                for name in ready:
+                    del waiting[name]
+                    timed(name)
+                    for deps in waiting.values():
+                        deps.discard(name)
+            logger.info(f"{description} {len(names)} instruments in {time.time()-start:.3f} s")
+            return
+
+        running, error = {}, None
+        with ThreadPoolExecutor(self.max_instrument_threads, thread_name_prefix="instruments") as executor:
+            while waiting or running:
+                if error is None:
+                    for name in [n for n, deps in waiting.items() if not deps]:
+                        del waiting[name]
+                        running[executor.submit(timed, name)] = name
+                    if not running:
+                        raise ValueError(f"Instruments {list(waiting.keys())} have circular dependencies.")
+                elif not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    for deps in waiting.values():
+                        deps.discard(name)
+        if error is not None:
+            raise error
+        logger.info(f"{description} {len(names)} instruments in {time.time()-start:.3f} s")
+
     def disconnect_instruments(self):
         # Connect the instruments to their resources
         for instrument in self._instruments.values():
@@ -468,12 +606,32 @@ class Experiment(metaclass=MetaExperiment):
         for n in self.nodes + self.extra_plotters:
             if n != self and hasattr(n, 'final_init'):
                 n.final_init()
+        # Borrow long-lived stream transport from the filter runtime, if it is free
+        self.runtime_streams = bool(self.runtime) and self.runtime.attach_streams(self.graph.edges)
         # Call final init on the DataStreams to fix their shared memory buffer sizes
         for edge in self.graph.edges:
             edge.final_init()
 
         self.init_progress_bars()
 
+    def restart_sweep(self):
+        """Restart the sweep after the last sweep point for which every writer has committed its data,
+        and make the writers continue from there."""
+        num_tuples = self.sweeper.num_points()
+        if not self.writers or not self.sweeper.axes:
+            return
+        points_per_tuple = {w: w.descriptor.expected_num_points() // num_tuples for w in self.writers}
+        start = min(w.w_idx // points_per_tuple[w] for w in self.writers)
+        if start >= num_tuples:
+            logger.warning("The data files are already complete, repeating the final sweep point.")
+            start = num_tuples - 1
+        # Drop any partial sweep point
+        for w in self.writers:
+            w.seek(start*points_per_tuple[w])
+        if start > 0:
+            logger.info(f"Resuming sweep from point {start} of {num_tuples}.")
+            self.sweeper.restart_from(start)
+
     def init_progress_bars(self):
         """ initialize the progress bars."""
         self.progressbars = {}
@@ -512,9 +670,10 @@ class Experiment(metaclass=MetaExperiment):
         # Auto increment the filenames
         for filename in set(self.filenames):
             wrs = [w for w in self.writers if w.filename.value == filename]
-            inc_filename = update_filename(filename, add_date=self.add_date)
+            inc_filename = update_filename(filename, add_date=self.add_date, resume=self.resume)
             for w in wrs:
                 w.filename.value = inc_filename
+                w.resume = self.resume
         self.filenames = [w.filename.value for w in self.writers]
         # Save ChannelLibrary version
         if hasattr(self, 'chan_db') and self.filenames and self.save_chandb:
@@ -542,6 +701,9 @@ class Experiment(metaclass=MetaExperiment):
         # Last minute init
         self.final_init()
 
+        if self.resume:
+            self.restart_sweep()
+
         # Launch plot servers.
         if len(self.plotters) > 0:
             self.connect_to_plot_server()
@@ -572,6 +734,10 @@ class Experiment(metaclass=MetaExperiment):
             self.other_nodes.extend(self.extra_plotters)
             self.other_nodes.remove(self)
 
+            # Filters hosted by another filter's process are not started themselves
+            hosted = self.graph.fuse_chains(self.other_nodes) if self.fuse_filters else []
+            self.process_nodes = [n for n in self.other_nodes if n not in hosted]
+
             # If we are launching the process dashboard,
             # setup the bokeh server and establish a queue for
             # filters to push data back to our thread below for
@@ -580,9 +746,14 @@ class Experiment(metaclass=MetaExperiment):
             if self.dashboard:
                 self.init_dashboard()
 
-            # Start the filter processes
-            for n in self.other_nodes:
-                n.start()
+            # Start the filter processes, handing as many as we can to the runtime
+            self.pooled_nodes = []
+            if self.runtime_streams:
+                rejected = self.runtime.launch(self.process_nodes, foreign=[self])
+                self.pooled_nodes = [n for n in self.process_nodes if n not in rejected]
+            for n in self.process_nodes:
+                if n not in self.pooled_nodes:
+                    n.start()
 
             # Run the main experiment loop
             self.sweep()
@@ -592,26 +763,21 @@ class Experiment(metaclass=MetaExperiment):
                 if callback:
                     callback(plot)
 
-            # Wait for the
-            time.sleep(0.1)
-            times = {n: 0 for n in self.other_nodes}
-            dones = {n: n.done.is_set() for n in self.other_nodes}
-            while False in dones.values():
-                time.sleep(1.0)
-                for n in self.other_nodes:
-                    if not n.done.is_set():
-                        times[n] += 1
-                        logger.debug(f"{str(n)} not done. Is the pipeline backed up at IO stage?")
-                    else:
-                        dones[n] = True
+            # Wait for the filters to finish
+            for n in self.other_nodes:
+                while not n.done.wait(1.0):
+                    logger.debug(f"{str(n)} not done. Is the pipeline backed up at IO stage?")
 
             # Get the final buffers, otherwise we won't be able to join reliably
-            for n in self.plotters + self.buffers:
+            for n in self.plotters:
                 if n not in self.manual_plotters:
                     n.final_buffer = n._final_buffer.get()
 
-            for n in self.other_nodes:
-                n.join()
+            for n in self.process_nodes:
+                if n in self.pooled_nodes:
+                    self.runtime.wait(n)
+                else:
+                    n.join()
 
             for buff in self.buffers:
                 buff.output_data, buff.descriptor = buff.get_data()
@@ -649,21 +815,30 @@ class Experiment(metaclass=MetaExperiment):
                 else:
                     break
                 for n in self.other_nodes:
-                    n.terminate()
+                    if n.is_alive():
+                        n.terminate()
                 raise Exception('Filter pipeline stuck!')
         except KeyboardInterrupt as e:
             for n in self.other_nodes:
-                n.terminate()
+                if n.is_alive():
+                    n.terminate()
 
         if not self.keep_instruments_connected:
             logger.debug("Disconnecting instruments")
             self.disconnect_instruments()
 
+        # Recover the runtime workers, and give the filters back their own events
+        if self.runtime_streams:
+            self.runtime.release()
+            self.runtime_streams = False
+
         for n in self.other_nodes:
             n.done.set()
 
-        import gc
-        gc.collect()
+        # Only needed to reap the processes we started ourselves
+        if len(self.pooled_nodes) < len(self.process_nodes):
+            import gc
+            gc.collect()
 
     def add_axis(self, axis, position=0):
         for oc in self.output_connectors.values():
@@ -48,6 +48,12 @@ def remove_fields(a, names):
     keep_names = [name for name in dt.names if name not in names]
     return view_fields(a, keep_names)
 
+def squares(x):
+    """Elementwise squares, with the real and imaginary parts of complex data kept apart."""
+    if np.iscomplexobj(x):
+        return x.real**2 + 1j*x.imag**2
+    return x**2
+
 
 class Averager(Filter):
     """Takes data and collapses along the specified axis."""
@@ -66,7 +72,6 @@ class Averager(Filter):
         self.threshold.value = threshold
         self.points_before_final_average   = None
         self.points_before_partial_average = None
-        self.sum_so_far = None
         self.num_averages = None
         self.passthrough = False
 
@@ -125,8 +130,6 @@ class Averager(Filter):
             # We will be left with only a single point here!
             descriptor.add_axis(DataAxis("result", [0]))
 
-        self.sum_so_far                 = np.zeros(self.avg_dims, dtype=descriptor.dtype)
-        self.current_avg_frame          = np.zeros(self.points_before_final_average, dtype=descriptor.dtype)
         self.partial_average.descriptor = descriptor
         self.source.descriptor          = descriptor
         self.excited_counts             = np.zeros(self.data_dims, dtype=np.int64)
@@ -135,10 +138,8 @@ class Averager(Filter):
         # of the sweeps are adaptive...
         desc_out_dtype = descriptor_in.axis_data_type(with_metadata=True, excluding_axis=self.axis.value)
         if not descriptor_in.is_adaptive():
-            vals           = [a.points_with_metadata() for a in descriptor_in.axes if a.name != self.axis.value]
-            nested_list    = list(itertools.product(*vals))
-            flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-            descriptor.visited_tuples = np.core.records.fromrecords(flattened_list, dtype=desc_out_dtype)
+            expected_tuples = descriptor_in.expected_tuples(with_metadata=True, excluding_axis=self.axis.value)
+            descriptor.visited_tuples = expected_tuples
         else:
             descriptor.visited_tuples = np.empty((0), dtype=desc_out_dtype)
 
@@ -172,7 +173,7 @@ class Averager(Filter):
         self.final_counts.descriptor = descriptor_count
 
         if not descriptor_in.is_adaptive():
-            descriptor_var.visited_tuples = np.core.records.fromrecords(flattened_list, dtype=desc_out_dtype)
+            descriptor_var.visited_tuples = expected_tuples
         else:
             descriptor_var.visited_tuples = np.empty((0), dtype=desc_out_dtype)
 
@@ -188,12 +189,17 @@ class Averager(Filter):
         if self.points_before_final_average is None:
             raise Exception("Average has not been initialized. Run 'update_descriptors'")
 
-        self.completed_averages = 0
-        self.idx_frame          = 0
-        self.idx_global         = 0
-        # We only need to accumulate up to the averaging axis
-        # BUT we may get something longer at any given time!
-        self.carry = np.zeros(0, dtype=self.source.descriptor.dtype)
+        self.idx_frame  = 0 # Position within the current averaging frame
+        self.idx_global = 0
+        self.reset_accumulators()
+
+    def reset_accumulators(self):
+        """Start a new averaging frame. Each point of the averaged frame keeps a running mean and sum of
+        squared deviations (Welford), with separate real and imaginary parts for complex data."""
+        acc_dtype    = np.result_type(self.sink.descriptor.dtype, np.float64)
+        self.mean    = np.zeros(self.points_before_partial_average, dtype=acc_dtype)
+        self.m2      = np.zeros(self.points_before_partial_average, dtype=acc_dtype)
+        self.excited = np.zeros(self.points_before_partial_average, dtype=np.int64)
 
     def process_data(self, data):
 
@@ -206,107 +212,100 @@ class Averager(Filter):
                 os.push(data)
             return
 
-        # TODO: handle unflattened data separately
-        if len(data.shape) > 1:
-            data = data.flatten()
-        #handle single points
-        elif not isinstance(data, np.ndarray) and (data.size == 1):
-            data = np.array([data])
+        data = np.asarray(data).ravel()
+        idx  = 0
 
-        if self.carry.size > 0:
-            data = np.concatenate((self.carry, data))
-            self.carry = np.zeros(0, dtype=self.source.descriptor.dtype)
+        # Whole frames lined up with the start of the data are averaged all at once
+        if self.idx_frame == 0 and data.size >= self.points_before_final_average:
+            idx = (data.size // self.points_before_final_average) * self.points_before_final_average
+            self.push_frames(data[:idx].reshape(self.reshape_dims))
 
-        idx       = 0
+        # Anything else is folded into the running averages as it arrives, without ever
+        # revisiting old data, so the cost is proportional to the new points.
         while idx < data.size:
-            #check whether we have enough data to fill an averaging frame
-            if data.size - idx >= self.points_before_final_average:
-                #logger.debug("Have {} points, enough for final avg.".format(data.size))
-                # How many chunks can we process at once?
-                num_chunks = int((data.size - idx)/self.points_before_final_average)
-                new_points = num_chunks*self.points_before_final_average
-                reshaped   = data[idx:idx+new_points].reshape(self.reshape_dims)
-                averaged   = reshaped.mean(axis=self.mean_axis)
-                idx       += new_points
-
-                # do state assignment
-                excited_states = (np.real(reshaped) > self.threshold.value).sum(axis=self.mean_axis)
-                ground_states = self.num_averages - excited_states
-
-                if self.sink.descriptor.is_adaptive():
-                    new_tuples = self.sink.descriptor.tuples()[self.idx_global:self.idx_global + new_points]
-                    new_tuples_stripped = remove_fields(new_tuples, self.axis.value)
-                    take_axis = -1 if self.axis_num > 0 else 0
-                    reduced_tuples = new_tuples_stripped.reshape(self.reshape_dims).take((0,), axis=take_axis)
-                    self.idx_global += new_points
-
-                # Add to Visited tuples
-                if self.sink.descriptor.is_adaptive():
-                    for os in self.source.output_streams + self.final_variance.output_streams + self.partial_average.output_streams:
-                        os.descriptor.visited_tuples = np.append(os.descriptor.visited_tuples, reduced_tuples)
-
-                for os in self.source.output_streams:
-                    os.push(averaged)
-
-                for os in self.final_variance.output_streams:
-                    os.push(reshaped.var(axis=self.mean_axis, ddof=1)) # N-1 in the denominator
-
-                for os in self.partial_average.output_streams:
-                    os.push(averaged)
-
-                for os in self.final_counts.output_streams:
-                    os.push(ground_states)
-                    os.push(excited_states)
-
-            # Maybe we can fill a partial frame
-            elif data.size - idx >= self.points_before_partial_average:
-                # logger.info("Have {} points, enough for partial avg.".format(data.size))
-                # How many chunks can we process at once?
-                num_chunks       = int((data.size - idx)/self.points_before_partial_average)
-                new_points       = num_chunks*self.points_before_partial_average
-
-                # Find the appropriate dimensions for the partial
-                partial_reshape_dims = self.reshape_dims[:]
-                partial_reshape_dims[self.mean_axis] = -1
-                partial_reshape_dims = partial_reshape_dims[self.mean_axis:]
-
-                reshaped         = data[idx:idx+new_points].reshape(partial_reshape_dims)
-                summed           = reshaped.sum(axis=self.mean_axis)
-                self.sum_so_far += summed
-
-                self.current_avg_frame[self.idx_frame:self.idx_frame+new_points] = data[idx:idx+new_points]
-                idx             += new_points
-                self.idx_frame  += new_points
-
-                self.completed_averages += num_chunks
-
-                # If we now have enoough for the final average, push to both partial and final...
-                if self.completed_averages == self.num_averages:
-                    reshaped = self.current_avg_frame.reshape(partial_reshape_dims)
-                    for os in self.source.output_streams + self.partial_average.output_streams:
-                        os.push(reshaped.mean(axis=self.mean_axis))
-                    for os in self.final_variance.output_streams:
-                        os.push(np.real(reshaped).var(axis=self.mean_axis, ddof=1)+1j*np.imag(reshaped).var(axis=self.mean_axis, ddof=1)) # N-1 in the denominator
-
-                    # do state assignment
-                    excited_states = (np.real(reshaped) < self.threshold.value).sum(axis=self.mean_axis)
-                    ground_states  = self.num_averages - excited_states
-                    for os in self.final_counts.output_streams:
-                        os.push(ground_states)
-                        os.push(excited_states)
-
-                    self.sum_so_far[:]        = 0.0
-                    self.current_avg_frame[:] = 0.0
-                    self.completed_averages   = 0
-                    self.idx_frame            = 0
-                else:
-                    # Emit a partial average since we've accumulated enough data
-                    if (time.time() - self.last_update >= self.update_interval):
-                        for os in self.partial_average.output_streams:
-                            os.push(self.sum_so_far/self.completed_averages)
-                        self.last_update = time.time()
-
-            # otherwise just add it to the carry
-            else:
-                self.carry = data[idx:]
-                break
+            idx += self.accumulate(data[idx:])
+            if self.idx_frame == self.points_before_final_average:
+                self.push_accumulated_frame()
+
+        # Emit a partial average once we have seen at least one complete set of points
+        if self.idx_frame >= self.points_before_partial_average and time.time() - self.last_update >= self.update_interval:
+            for os in self.partial_average.output_streams:
+                os.push(self.mean.copy())
+            self.last_update = time.time()
+
+    def accumulate(self, data):
+        """Fold the start of data into the current frame, up to the end of the current row of points
+        or as many whole rows as are available, and return the number of points used."""
+        rows, offset = divmod(self.idx_frame, self.points_before_partial_average)
+        if offset > 0 or data.size < self.points_before_partial_average:
+            # Points of a partial row, every one of which has already seen `rows` values
+            num_points = min(self.points_before_partial_average - offset, data.size)
+            block      = data[:num_points].reshape(1, num_points)
+            sl         = slice(offset, offset + num_points)
+        else:
+            num_rows   = min(data.size, self.points_before_final_average - self.idx_frame) // self.points_before_partial_average
+            num_points = num_rows*self.points_before_partial_average
+            block      = data[:num_points].reshape(num_rows, self.points_before_partial_average)
+            sl         = slice(None)
+
+        # Chan et al. merge of the block statistics into the running ones
+        num_new = block.shape[0]
+        total   = rows + num_new
+        mean    = block.mean(axis=0)
+        delta   = mean - self.mean[sl]
+        self.mean[sl]    += delta*(num_new/total)
+        self.m2[sl]      += squares(block - mean).sum(axis=0) + squares(delta)*(rows*num_new/total)
+        # Frames built up piecewise have always counted the points below the threshold
+        self.excited[sl] += (np.real(block) < self.threshold.value).sum(axis=0)
+
+        self.idx_frame += num_points
+        return num_points
+
+    def push_accumulated_frame(self):
+        """Push the results of the completed running averages and start again."""
+        self.update_visited_tuples(self.points_before_final_average)
+        for os in self.source.output_streams + self.partial_average.output_streams:
+            os.push(self.mean)
+        for os in self.final_variance.output_streams:
+            os.push(self.m2/(self.num_averages - 1)) # N-1 in the denominator
+        for os in self.final_counts.output_streams:
+            os.push(self.num_averages - self.excited)
+            os.push(self.excited)
+        # Fresh arrays, since downstream filters in this process may still refer to the pushed ones
+        self.reset_accumulators()
+        self.idx_frame = 0
+
+    def push_frames(self, reshaped):
+        """Push the results for one or more whole frames of data."""
+        self.update_visited_tuples(reshaped.size)
+        averaged  = reshaped.mean(axis=self.mean_axis)
+
+        # do state assignment
+        excited_states = (np.real(reshaped) > self.threshold.value).sum(axis=self.mean_axis)
+        ground_states  = self.num_averages - excited_states
+
+        for os in self.source.output_streams:
+            os.push(averaged)
+
+        for os in self.final_variance.output_streams:
+            os.push(reshaped.var(axis=self.mean_axis, ddof=1)) # N-1 in the denominator
+
+        for os in self.partial_average.output_streams:
+            os.push(averaged)
+
+        for os in self.final_counts.output_streams:
+            os.push(ground_states)
+            os.push(excited_states)
+
+    def update_visited_tuples(self, new_points):
+        """Record the tuples of newly averaged frames for adaptive sweeps."""
+        if not self.sink.descriptor.is_adaptive():
+            return
+        new_tuples = self.sink.descriptor.tuples()[self.idx_global:self.idx_global + new_points]
+        new_tuples_stripped = remove_fields(new_tuples, self.axis.value)
+        take_axis = -1 if self.axis_num > 0 else 0
+        reduced_tuples = new_tuples_stripped.reshape(self.reshape_dims).take((0,), axis=take_axis)
+        self.idx_global += new_points
+
+        for os in self.source.output_streams + self.final_variance.output_streams + self.partial_average.output_streams:
+            os.descriptor.add_visited_tuples(reduced_tuples.ravel())
@@ -14,10 +14,18 @@ from copy import deepcopy
 
 import numpy as np
 import scipy.signal
+import scipy.fftpack
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    # Single precision transforms when available
+    import scipy.fft as fft
+except ImportError:
+    import numpy.fft as fft
 
 from .filter import Filter
 from auspex.parameter import Parameter, IntParameter, FloatParameter
-from auspex.stream import  DataStreamDescriptor, InputConnector, OutputConnector
+from auspex.stream import  DataStreamDescriptor, DataAxis, InputConnector, OutputConnector
 from auspex.log import logger
 
 try:
@@ -45,7 +53,14 @@ class Channelizer(Filter):
     an axis name is supplied to `follow_axis` then the filter will demodulate at the freqency
     `axis_frequency_value - follow_freq_offset` otherwise it will demodulate at `frequency`. Note that
     the filter coefficients are still calculated with respect to the `frequency` paramter, so it should
-    be chosen accordingly when `follow_axis` is defined."""
+    be chosen accordingly when `follow_axis` is defined.
+
+    The `backend` selects between the three stage IIR pipeline ("iir"), which uses the IPP based
+    libchannelizer when it is available, and a pure numpy FIR ("fir", see `PolyphaseChannelizer`) that has
+    linear phase, keeps its state across partial records rather than copying them, and can select several
+    frequencies from a single transform of the input. Passing a list of `frequencies` selects all of them
+    with the FIR, and adds a "frequency" axis to the output, just before the (decimated) time axis. By
+    default the FIR is used for several frequencies and the IIR for one, for which it is still faster."""
 
     sink               = InputConnector()
     source             = OutputConnector()
@@ -56,10 +71,13 @@ class Channelizer(Filter):
     bandwidth          = FloatParameter(value_range=(0.00, 100e6), increment=0.1e6, default=5e6)
 
     def __init__(self, frequency=None, bandwidth=None, decimation_factor=None,
-                    follow_axis=None, follow_freq_offset=None, **kwargs):
+                    follow_axis=None, follow_freq_offset=None, backend=None, frequencies=None, **kwargs):
         super(Channelizer, self).__init__(**kwargs)
         if frequency:
             self.frequency.value = frequency
+        if frequencies is not None:
+            self.frequency.value = frequencies[0]
+        self.frequencies = list(frequencies) if frequencies is not None else None
         if bandwidth:
             self.bandwidth.value = bandwidth
         if decimation_factor:
@@ -69,10 +87,32 @@ class Channelizer(Filter):
         if follow_freq_offset:
             self.follow_freq_offset.value = follow_freq_offset
         self.quince_parameters = [self.decimation_factor, self.frequency, self.bandwidth]
+        if backend is None:
+            backend = "fir" if self.multiple_frequencies else "iir"
+        self.backend = backend
         self._phase = 0.0
 
+    @property
+    def multiple_frequencies(self):
+        return self.frequencies is not None and len(self.frequencies) > 1
+
     def final_init(self):
-        self.init_filters(self.frequency.value, self.bandwidth.value)
+        if self.backend not in ["iir", "fir"]:
+            raise ValueError(f"Unknown channelizer backend {self.backend}")
+        self.use_fir = self.backend == "fir"
+        if self.multiple_frequencies:
+            if not self.use_fir:
+                raise ValueError("Only the fir backend of the channelizer can select several frequencies.")
+            if self.follow_axis.value != "":
+                raise ValueError("The channelizer cannot follow an axis while selecting several frequencies.")
+
+        if self.use_fir:
+            self.fir = PolyphaseChannelizer(self.fir_taps(), self.decimation_factor.value, self.time_pts,
+                                            self.frequencies or [self.frequency.value], phase=self._phase)
+            # Output samples of the current record, until there are enough to push it one frequency at a time
+            self.pending = np.zeros((0, self.fir.num_freqs), dtype=np.complex64)
+        else:
+            self.init_filters(self.frequency.value, self.bandwidth.value)
 
         if self.follow_axis.value is not "":
             desc = self.sink.descriptor
@@ -81,7 +121,10 @@ class Channelizer(Filter):
             self.pts_before_freq_reset  = desc.num_points_through_axis(axis_num)
             self.demod_freqs = desc.axes[axis_num].points - self.follow_freq_offset.value
             self.current_freq = 0
-            self.update_references(self.current_freq)
+            if self.use_fir:
+                self.fir.set_frequencies([self.current_freq], phase=self._phase)
+            else:
+                self.update_references(self.current_freq)
         self.idx = 0
 
         # For storing carryover if getting uneven buffers
@@ -97,6 +140,15 @@ class Channelizer(Filter):
         self.reference_r = np.real(ref)
         self.reference_i = np.imag(ref)
 
+    def fir_taps(self):
+        """Low pass FIR for the channel bandwidth. The transition band is a small multiple of the
+        bandwidth, and the length is a whole number of decimation periods, for the polyphase
+        implementation, but no longer than a record."""
+        decim    = self.decimation_factor.value
+        num_taps = int(np.ceil(4.0 / (self.bandwidth.value * self.time_step) / decim)) * decim
+        num_taps = max(decim, min(num_taps, (self.record_length // decim) * decim))
+        return scipy.signal.firwin(num_taps, self.bandwidth.value/2, fs=1.0/self.time_step)
+
     def init_filters(self, frequency, bandwidth):
         # convert bandwidth normalized to Nyquist interval
         n_bandwidth = bandwidth * self.time_step * 2
@@ -183,6 +235,8 @@ class Channelizer(Filter):
         decimated_descriptor.axes[-1] = deepcopy(self.sink.descriptor.axes[-1])
         decimated_descriptor.axes[-1].points = self.sink.descriptor.axes[-1].points[self.decimation_factor.value-1::self.decimation_factor.value]
         decimated_descriptor.axes[-1].original_points = decimated_descriptor.axes[-1].points
+        if self.multiple_frequencies:
+            decimated_descriptor.axes.insert(len(decimated_descriptor.axes)-1, DataAxis("frequency", self.frequencies, unit="Hz"))
         decimated_descriptor._exp_src = self.sink.descriptor._exp_src
         decimated_descriptor.dtype = np.complex64
         self.source.descriptor = decimated_descriptor
@@ -190,6 +244,10 @@ class Channelizer(Filter):
 
     def process_data(self, data):
 
+        if self.use_fir:
+            self.process_data_fir(data)
+            return
+
         # Append any data carried from the last run
         if self.carry.size > 0:
             data = np.concatenate((self.carry, data))
@@ -202,10 +260,10 @@ class Channelizer(Filter):
         remaining_points = data.size % self.record_length
         if remaining_points > 0:
             if num_records > 0:
-                self.carry = data[-remaining_points:]
+                self.carry = data[-remaining_points:].copy()
                 data = data[:-remaining_points]
             else:
-                self.carry = data
+                self.carry = data.copy()
         else:
             self.carry = np.zeros(0, dtype=self.source.descriptor.dtype)
 
@@ -285,6 +343,144 @@ class Channelizer(Filter):
             for os in self.source.output_streams:
                 os.push(filtered)
 
+    def process_data_fir(self, data):
+        # Update demodulation frequency if necessary
+        if self.follow_axis.value is not "":
+            freq = self.demod_freqs[(self.idx % self.pts_before_freq_reset) // self.pts_before_freq_update]
+            if freq != self.current_freq:
+                self.fir.set_frequencies([freq], phase=self._phase)
+                self.current_freq = freq
+        self.idx += data.size
+
+        # Partial records are absorbed into the filter state, so there is no carry
+        filtered = self.fir.process(data.ravel())
+        if self.fir.num_freqs == 1:
+            filtered = filtered[:, 0]
+        else:
+            # Each record goes out as one decimated record per frequency
+            if self.pending.size > 0:
+                filtered = np.concatenate((self.pending, filtered))
+            num_outputs  = self.fir.out_idx.size
+            complete     = (filtered.shape[0] // num_outputs) * num_outputs
+            self.pending = filtered[complete:].copy()
+            filtered     = filtered[:complete].reshape(-1, num_outputs, self.fir.num_freqs).transpose(0, 2, 1).ravel()
+        if filtered.size > 0:
+            for os in self.source.output_streams:
+                os.push(filtered)
+
+class PolyphaseChannelizer(object):
+    """Pure numpy channelizer that mixes each record down from one or more frequencies and applies a
+    decimating low pass FIR. Mixing is folded into the filter: for each frequency `f` the kernel
+    `taps[k]*exp(2j*pi*f*k*dt)` is applied directly to the raw data, and the result is rotated by
+    `exp(-2j*pi*f*t)` at the output times. All frequencies are therefore computed from a single pass
+    over the input.
+
+    Whole records are filtered together by fast (FFT) convolution, with a single forward
+    transform of the data. The spectrum for each frequency is folded onto the decimated output
+    samples before the (shorter) inverse transform, so only the outputs we keep are computed.
+
+    Each record is filtered as if it started from rest. Data may arrive split at any point: the filter
+    keeps the tail of the current record as its state between calls, and computes the outputs whose
+    windows are complete directly, polyphase style, so partial records cost only as much as their data.
+
+    Args:
+        taps:           Low pass FIR coefficients.
+        decimation:     Decimation factor, output samples are taken at indices `decimation-1::decimation`.
+        time_pts:       Sample times within a record.
+        frequencies:    Frequencies of the channels to select.
+        phase:          Additional phase of the mix down references.
+    """
+    def __init__(self, taps, decimation, time_pts, frequencies, phase=0.0):
+        self.taps          = np.asarray(taps, dtype=np.float64)
+        self.num_taps      = self.taps.size
+        self.decimation    = decimation
+        self.time_pts      = np.asarray(time_pts)
+        self.record_length = self.time_pts.size
+        self.time_step     = self.time_pts[1] - self.time_pts[0]
+        self.out_idx       = np.arange(decimation - 1, self.record_length, decimation)
+        # Long enough that the circular convolution never wraps onto outputs, and divisible by the decimation
+        self.fft_length    = decimation*scipy.fftpack.next_fast_len(int(np.ceil((self.record_length + self.num_taps - 1)/decimation)))
+        self.reset()
+        self.set_frequencies(frequencies, phase=phase)
+
+    def reset(self):
+        """Forget any partial record."""
+        self.history = np.zeros(self.num_taps - 1, dtype=np.float32) # Input preceding the current position
+        self.rec_pos = 0
+
+    def set_frequencies(self, frequencies, phase=0.0):
+        frequencies    = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+        self.num_freqs = frequencies.size
+        delays         = np.arange(self.num_taps) * self.time_step
+        kernels        = self.taps[:, None] * np.exp(2j*np.pi*np.outer(delays, frequencies))
+
+        # Windows run forward in time, so the oldest sample meets the last tap
+        self.kernels_c = kernels[::-1].astype(np.complex64)
+        # Real and imaginary parts side by side, so real data needs a single real product
+        self.kernels_r = np.concatenate((kernels[::-1].real, kernels[::-1].imag), axis=1).astype(np.float32)
+
+        # Kernel spectra, shifted to the first output sample and scaled for the folded inverse transform
+        bins         = np.arange(self.fft_length)
+        shift        = np.exp(2j*np.pi*bins*(self.decimation - 1)/self.fft_length) / self.decimation
+        self.spectra = (np.fft.fft(kernels, self.fft_length, axis=0).T * shift).astype(np.complex64)
+
+        # Recover the gain from selecting a single sideband along with the output rotation
+        self.rotation  = 2*np.exp(-2j*np.pi*np.outer(self.time_pts[self.out_idx], frequencies) + 1j*phase).astype(np.complex64)
+
+    def process(self, data):
+        """Channelize the next stretch of the stream and return all newly completed output samples,
+        of shape `(num_outputs, num_frequencies)`."""
+        outputs = []
+        idx     = 0
+        if self.rec_pos > 0:
+            idx = min(self.record_length - self.rec_pos, data.size)
+            outputs.append(self.process_partial(data[:idx]))
+        num_records = (data.size - idx) // self.record_length
+        if num_records > 0:
+            records = data[idx:idx + num_records*self.record_length].reshape(num_records, self.record_length)
+            outputs.append(self.process_records(records).reshape(-1, self.num_freqs))
+            idx += num_records*self.record_length
+        if idx < data.size:
+            outputs.append(self.process_partial(data[idx:]))
+        if len(outputs) == 0:
+            return np.zeros((0, self.num_freqs), dtype=np.complex64)
+        return np.concatenate(outputs) if len(outputs) > 1 else outputs[0]
+
+    def process_records(self, records):
+        """Filter whole records, returning an array of shape `(num_records, num_outputs, num_frequencies)`."""
+        if records.dtype not in [np.float32, np.complex64]:
+            records = records.astype(np.complex64 if np.iscomplexobj(records) else np.float32)
+        spectrum = fft.fft(records, self.fft_length, axis=-1)
+        # Fold the spectrum onto the decimated samples: outputs decimation-1::decimation of the
+        # full inverse transform are the inverse transform of the sum of the aliased bands.
+        folded   = (spectrum[:, None, :] * self.spectra).reshape(records.shape[0], self.num_freqs, self.decimation, -1).sum(axis=2)
+        result   = fft.ifft(folded, axis=-1)[:, :, :self.out_idx.size]
+        return (np.swapaxes(result, 1, 2) * self.rotation).astype(np.complex64)
+
+    def process_partial(self, data):
+        """Filter part of a record, continuing from the stored state."""
+        start   = self.rec_pos
+        stop    = start + data.size
+        buff    = np.concatenate((self.history, data))
+        first   = np.searchsorted(self.out_idx, start)
+        last    = np.searchsorted(self.out_idx, stop)
+        offset  = buff[self.out_idx[first] - start:] if last > first else buff[:0]
+        windows = as_strided(offset, shape=(last - first, self.num_taps),
+                             strides=(self.decimation*buff.strides[0], buff.strides[0]), writeable=False)
+        if np.iscomplexobj(windows):
+            result = windows @ self.kernels_c
+        else:
+            result = windows @ self.kernels_r
+            result = result[:, :self.num_freqs] + 1j*result[:, self.num_freqs:]
+        result = (result * self.rotation[first:last]).astype(np.complex64)
+
+        if stop == self.record_length:
+            self.reset()
+        else:
+            self.history = buff[buff.size - (self.num_taps - 1):]
+            self.rec_pos = stop
+        return result
+
 class LibChannelizerFallback(object):
     @staticmethod
     def filter_records_fir(coeffs,
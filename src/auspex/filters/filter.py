@@ -21,6 +21,7 @@ else:
     from multiprocessing import Event
     from multiprocessing import Queue
     from multiprocessing import Value, Array
+    from multiprocessing.connection import wait as mp_wait
 
 from setproctitle import setproctitle
 import cProfile
@@ -28,11 +29,12 @@ import itertools
 import time, datetime
 import queue
 import copy
+import collections
 import ctypes
 import numpy as np
 
 from auspex.parameter import Parameter
-from auspex.stream import DataStream, InputConnector, OutputConnector
+from auspex.stream import DataStream, InputConnector, OutputConnector, StreamAligner
 from auspex.log import logger
 import auspex.config
 
@@ -62,6 +64,15 @@ class MetaFilter(type):
 class Filter(Process, metaclass=MetaFilter):
     """Any node on the graph that takes input streams with optional output streams"""
 
+    # Longest time (s) an idle filter blocks before re-checking its exit event and checkin
+    idle_timeout = 0.1
+
+    # How often (s) the filter checks that the parent process is still alive
+    watchdog_interval = 1.0
+
+    # Whether this filter may share a process with its neighbours in a linear chain
+    fusible = True
+
     def __init__(self, name=None, **kwargs):
         super(Filter, self).__init__()
         self.filter_name = name
@@ -81,6 +92,9 @@ class Filter(Process, metaclass=MetaFilter):
         self.finished_processing = Event()
         self.finished_processing.clear()
 
+        # Downstream filters that run inside this filter's process
+        self.fused_filters = []
+
         for ic in self._input_connectors:
             a = InputConnector(name=ic, parent=self)
             a.parent = self
@@ -157,9 +171,47 @@ class Filter(Process, metaclass=MetaFilter):
         else:
             return True
 
+    def _parent_watchdog(self):
+        """Rate limited check on the parent process, returns False if it has gone away."""
+        now = time.time()
+        if now - self._last_watchdog < self.watchdog_interval:
+            return True
+        self._last_watchdog = now
+        return self._parent_process_running()
+
+    def wait_for_messages(self, streams, timeout=None):
+        """Block until at least one of the streams has messages, or until the timeout expires,
+        and then return a dictionary of all currently available messages keyed by stream."""
+        timeout  = self.idle_timeout if timeout is None else timeout
+        messages = {s: [] for s in streams}
+        queues   = [s.queue for s in streams]
+
+        if len(streams) == 1:
+            try:
+                messages[streams[0]].append(queues[0].get(timeout=timeout))
+            except queue.Empty:
+                return messages
+        elif all(hasattr(q, '_reader') for q in queues):
+            # Sleep on the underlying pipes of the multiprocessing queues
+            mp_wait([q._reader for q in queues], timeout)
+        else:
+            # Thread-based queues offer no way to wait on several at once
+            time.sleep(min(timeout, 0.002))
+
+        for s in streams:
+            while True:
+                try:
+                    messages[s].append(s.queue.get(False))
+                except queue.Empty:
+                    break
+        return messages
+
     def run(self):
         self.p = psutil.Process(os.getpid())
         logger.debug(f"{self} launched with pid {os.getpid()}. ppid {os.getppid()}")
+        for filt in self.fused_filters:
+            filt.p = self.p
+            filt.execute_on_run()
         if auspex.config.profile:
             if not self.filter_name:
                 name = "Unlabeled"
@@ -177,10 +229,22 @@ class Filter(Process, metaclass=MetaFilter):
     def push_to_all(self, message):
         for oc in self.output_connectors.values():
             for ost in oc.output_streams:
-                ost.queue.put(message)
-                if message['type'] == 'event' and message["event_type"] == "done":
-                    logger.debug(f"Closing out queue {ost.queue}")
-                    ost.queue.close()
+                ost.push_event(message["event_type"], message["data"])
+
+    def receive_fused_data(self, data):
+        """Process data handed over directly by an upstream filter running in the same
+        process, just as `main` would have processed it from the input stream."""
+        self.process_data(data)
+        self.processed += data.nbytes
+
+    def receive_fused_event(self, message):
+        """Handle an event from an upstream filter running in the same process."""
+        self.push_to_all(message)
+        if message['event_type'] == 'done':
+            self.done.set()
+            self.on_done()
+        else:
+            self.process_message(message)
 
     def push_resource_usage(self):
         if self.perf_queue and (datetime.datetime.now() - self.last_performance_update).seconds > 1.0:
@@ -196,6 +260,14 @@ class Filter(Process, metaclass=MetaFilter):
         """For any filter-specific loop needs"""
         pass
 
+    def check_inputs(self):
+        """Called once the graph is built. Filters with several input streams must define
+        `process_aligned(chunks)`, which is handed equal length chunks of data, one from each
+        input stream in the order in which the streams were connected."""
+        num_streams = sum(len(ic.input_streams) for ic in self.input_connectors.values())
+        if num_streams > 1 and not callable(getattr(self, 'process_aligned', None)):
+            raise ValueError(f"{self} has {num_streams} input streams but does not define process_aligned to combine them.")
+
     def main(self):
         """
         Generic run method which waits on a single stream and calls `process_data` on any new_data
@@ -204,31 +276,28 @@ class Filter(Process, metaclass=MetaFilter):
 
         logger.debug('Running "%s" run loop', self.filter_name)
         setproctitle(f"python auspex filter: {self}")
-        input_stream = getattr(self, self._input_connectors[0]).input_streams[0]
+        input_streams = [s for ic in self.input_connectors.values() for s in ic.input_streams]
+        if len(input_streams) > 1:
+            self.main_aligned(input_streams)
+            return
+        input_stream = input_streams[0]
         desc = input_stream.descriptor
 
         stream_done = False
         stream_points = 0
+        self._last_watchdog = time.time()
 
         while not self.exit.is_set():# and not self.finished_processing.is_set():
-            # Try to pull all messages in the queue. queue.empty() is not reliable, so we
-            # ask for forgiveness rather than permission.
-            messages = []
-
             # For any filter-specific loop needs
             self.checkin()
 
             # Check to see if the parent process still exists:
-            if not self._parent_process_running():
+            if not self._parent_watchdog():
                 logger.warning(f"{self} with pid {os.getpid()} could not find parent with pid {os.getppid()}. Assuming something has gone wrong. Exiting.")
                 break
 
-            while not self.exit.is_set():
-                try:
-                    messages.append(input_stream.queue.get(False))
-                except queue.Empty as e:
-                    time.sleep(0.002)
-                    break
+            # Sleep until there are messages, then pull everything that is waiting.
+            messages = self.wait_for_messages([input_stream])[input_stream]
 
             self.push_resource_usage()
             for message in messages:
@@ -255,6 +324,9 @@ class Filter(Process, metaclass=MetaFilter):
                         stream_points += len(message_data)
                         self.process_data(message_data)
                         self.processed += message_data.nbytes
+                        # The data may be a view into the stream's ring buffer, so
+                        # only hand the space back once we are done with it.
+                        input_stream.release()
 
             if stream_done:
                 self.push_to_all({"type": "event", "event_type": "done", "data": None})
@@ -266,3 +338,64 @@ class Filter(Process, metaclass=MetaFilter):
 
         # except Exception as e:
         #     logger.warning(f"Filter {self} raised exception {e}. Bailing.")
+
+    def main_aligned(self, streams):
+        """Run loop for filters with several input streams. Data are handed to `process_aligned`
+        (see `check_inputs`) in chunks of equal length from every stream, and events are only acted upon, and passed
+        along the graph once, when every stream has delivered them at the same point in its data."""
+        for s in streams[1:]:
+            if not np.all(s.descriptor.expected_tuples() == streams[0].descriptor.expected_tuples()):
+                raise ValueError(f"Multiple streams connected to {self} must have matching descriptors.")
+
+        aligner = StreamAligner(streams)
+        events  = [collections.deque() for _ in streams]
+        streams_done = False
+        self._last_watchdog = time.time()
+
+        while not self.exit.is_set():
+            self.checkin()
+
+            if not self._parent_watchdog():
+                logger.warning(f"{self} with pid {os.getpid()} could not find parent with pid {os.getppid()}. Assuming something has gone wrong. Exiting.")
+                break
+
+            # Sleep until any of the streams has messages. Data are read straight from the
+            # ring buffers, so only the events need to be kept.
+            messages = self.wait_for_messages(streams)
+            self.push_resource_usage()
+            for i, stream in enumerate(streams):
+                events[i].extend(m for m in messages[stream] if m['type'] == 'event')
+
+            while True:
+                # Never read past the next event of any stream
+                limit = min((e[0]['position'] - aligner.consumed[i] for i, e in enumerate(events) if e), default=None)
+                chunks = aligner.read(limit)
+                if chunks is not None:
+                    self.process_aligned(chunks)
+                    self.processed += sum(c.nbytes for c in chunks)
+                    continue
+                if not all(events):
+                    break
+
+                # Every stream has reached its next event
+                pending = [e.popleft() for e in events]
+                for i, message in enumerate(pending):
+                    if message['position'] != aligner.consumed[i]:
+                        logger.warning(f"{self} input {streams[i]} is misaligned by {message['position'] - aligner.consumed[i]} points at a {message['event_type']} event.")
+                        aligner.discard(i, message['position'] - aligner.consumed[i])
+                if any(m['event_type'] != pending[0]['event_type'] for m in pending):
+                    logger.warning(f"{self} received mismatched events {[m['event_type'] for m in pending]} from its inputs.")
+                if any(m['event_type'] == 'done' for m in pending):
+                    logger.debug(f"{self} received done messages!")
+                    streams_done = True
+                    break
+                self.push_to_all(pending[0])
+                self.process_message(pending[0])
+            aligner.release()
+
+            if streams_done:
+                self.push_to_all({"type": "event", "event_type": "done", "data": None})
+                self.done.set()
+                break
+
+        self.on_done()
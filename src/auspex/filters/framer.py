@@ -75,10 +75,10 @@ class Framer(Filter):
         remaining_points = data.size % self.frame_points
         if remaining_points > 0:
             if num_frames > 0:
-                self.carry = data[-remaining_points:]
+                self.carry = data[-remaining_points:].copy()
                 data = data[:-remaining_points]
             else:
-                self.carry = data
+                self.carry = data.copy()
         else:
             self.carry = np.zeros(0, dtype=self.sink.descriptor.dtype)
 
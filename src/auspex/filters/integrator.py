@@ -29,8 +29,15 @@ class KernelIntegrator(Filter):
     box_car_stop    = FloatParameter(default=100e-9)
     demod_frequency = FloatParameter(default=0.0)
 
-    """Integrate with a given kernel. Kernel will be padded/truncated to match record length"""
-    def __init__(self, **kwargs):
+    """Integrate with a given kernel. Kernel will be padded/truncated to match record length.
+
+    Several kernels can be applied to the same stream at once by passing a list of `kernels`, each
+    of which may be a kernel file name or expression (as for the `kernel` parameter), an array, or
+    a dictionary describing a box car with optional keys `box_car_start`, `box_car_stop`, and
+    `demod_frequency`. The result for the first kernel is pushed to `source` and the result for
+    kernel `i` to the output connector `source_i`. All kernels are applied with a single matrix
+    product per chunk of data."""
+    def __init__(self, kernels=None, **kwargs):
         super(KernelIntegrator, self).__init__(**kwargs)
         self.pre_int_op  = None
         self.post_int_op = None
@@ -43,41 +50,75 @@ class KernelIntegrator(Filter):
             self.post_int_op = kwargs["post_integration_operation"]
         # self.quince_parameters = [self.simple_kernel, self.demod_frequency, self.box_car_start, self.box_car_stop]
 
+        # Every kernel past the first gets its own output connector
+        self.kernels = kernels
+        self.sources = [self.source]
+        for i in range(1, len(kernels) if kernels else 1):
+            oc = OutputConnector(name=f"source_{i}", parent=self)
+            self.output_connectors[oc.name] = oc
+            setattr(self, oc.name, oc)
+            self.sources.append(oc)
+
+    def load_kernel(self, name):
+        """Load a kernel from the kernel directory, or else evaluate it as an expression."""
+        if os.path.exists(os.path.join(config.KernelDir, name+'.txt')):
+            return np.loadtxt(os.path.join(config.KernelDir, name+'.txt'), dtype=complex, converters={0: lambda s: complex(s.decode().replace('+-', '-'))})
+        try:
+            return eval(name.encode('unicode_escape'))
+        except:
+            raise ValueError('Kernel invalid. Provide a file name or an expression to evaluate')
+
+    def box_car(self, start, stop, frequency):
+        time_pts = self.sink.descriptor.axes[-1].points
+        time_step = time_pts[1] - time_pts[0]
+        kernel = np.zeros(len(time_pts), dtype=np.complex128)
+        sample_start = int(start / time_step)
+        sample_stop = int(stop / time_step) + 1
+        kernel[sample_start:sample_stop] = 1.0
+        # add modulation
+        kernel *= np.exp(2j * np.pi * frequency * time_pts)
+        return kernel
+
+    def make_kernel(self, spec):
+        if isinstance(spec, str):
+            return self.load_kernel(spec)
+        elif isinstance(spec, dict):
+            return self.box_car(spec.get('box_car_start', self.box_car_start.value),
+                                spec.get('box_car_stop', self.box_car_stop.value),
+                                spec.get('demod_frequency', self.demod_frequency.value))
+        return np.asarray(spec, dtype=np.complex128)
+
     def update_descriptors(self):
-        if not self.simple_kernel and self.kernel.value is None:
+        if not self.kernels and not self.simple_kernel and self.kernel.value is None:
             raise ValueError("Integrator was passed kernel None")
 
         logger.debug('Updating KernelIntegrator "%s" descriptors based on input descriptor: %s.', self.filter_name, self.sink.descriptor)
 
         record_length = self.sink.descriptor.axes[-1].num_points()
 
-        if self.kernel.value:
-            if os.path.exists(os.path.join(config.KernelDir, self.kernel.value+'.txt')):
-                kernel = np.loadtxt(os.path.join(config.KernelDir, self.kernel.value+'.txt'), dtype=complex, converters={0: lambda s: complex(s.decode().replace('+-', '-'))})
-            else:
-                try:
-                    kernel = eval(self.kernel.value.encode('unicode_escape'))
-                except:
-                    raise ValueError('Kernel invalid. Provide a file name or an expression to evaluate')
+        if self.kernels:
+            kernels = [self.make_kernel(spec) for spec in self.kernels]
+        elif self.kernel.value:
+            kernels = [self.load_kernel(self.kernel.value)]
             if self.simple_kernel.value:
                 logger.warning("Using specified kernel. To use a box car filter instead, clear kernel.value")
-
         elif self.simple_kernel.value:
-            time_pts = self.sink.descriptor.axes[-1].points
-            time_step = time_pts[1] - time_pts[0]
-            kernel = np.zeros(record_length, dtype=np.complex128)
-            sample_start = int(self.box_car_start.value / time_step)
-            sample_stop = int(self.box_car_stop.value / time_step) + 1
-            kernel[sample_start:sample_stop] = 1.0
-            # add modulation
-            kernel *= np.exp(2j * np.pi * self.demod_frequency.value  * time_pts)
+            kernels = [self.box_car(self.box_car_start.value, self.box_car_stop.value, self.demod_frequency.value)]
         else:
             raise ValueError('Kernel invalid. Either provide a file name or an expression to evaluate or set simple_kernel.value to true')
-        # pad or truncate the kernel to match the record length
-        if kernel.size < record_length:
-            self.aligned_kernel = np.append(kernel, np.zeros(record_length-kernel.size, dtype=np.complex128))
-        else:
-            self.aligned_kernel = np.resize(kernel, record_length)
+
+        # pad or truncate the kernels to match the record length
+        aligned = []
+        for kernel in kernels:
+            kernel = np.asarray(kernel, dtype=np.complex128)
+            if kernel.size < record_length:
+                aligned.append(np.append(kernel, np.zeros(record_length-kernel.size, dtype=np.complex128)))
+            else:
+                aligned.append(np.resize(kernel, record_length))
+        self.aligned_kernels = np.stack(aligned, axis=1)
+        self.aligned_kernel  = self.aligned_kernels[:, 0]
+        # Real and imaginary parts side by side, so real data needs a single real product
+        self.stacked_kernels = np.concatenate((self.aligned_kernels.real, self.aligned_kernels.imag), axis=1)
 
         # Integrator reduces and removes axis on output stream
         # update output descriptors
@@ -86,18 +127,61 @@ class KernelIntegrator(Filter):
         output_descriptor.axes = self.sink.descriptor.axes[:-1]
         output_descriptor._exp_src = self.sink.descriptor._exp_src
         output_descriptor.dtype = np.complex128
-        for ost in self.source.output_streams:
-            ost.set_descriptor(output_descriptor)
-            ost.end_connector.update_descriptors()
+        for oc in self.sources:
+            oc.descriptor = output_descriptor
+            for ost in oc.output_streams:
+                ost.set_descriptor(output_descriptor)
+                ost.end_connector.update_descriptors()
+
+    def final_init(self):
+        # Integrals of the record in progress, which may be split across chunks
+        self.record_pos = 0
+        self.partial    = np.zeros(self.aligned_kernels.shape[1], dtype=np.complex128)
+
+    def integrate(self, data, rows):
+        """Apply all of the kernels (restricted to the given record samples) to the data."""
+        if np.iscomplexobj(data):
+            return data @ self.aligned_kernels[rows]
+        result = data @ self.stacked_kernels[rows]
+        return result[..., :self.aligned_kernels.shape[1]] + 1j*result[..., self.aligned_kernels.shape[1]:]
 
     def process_data(self, data):
 
-        # TODO: handle variable partial records
         if self.pre_int_op:
             data = self.pre_int_op(data)
-        filtered = np.inner(np.reshape(data, (-1, len(self.aligned_kernel))), self.aligned_kernel)
-        if self.post_int_op:
-            filtered = self.post_int_op(filtered)
+        data = np.ravel(data)
+        record_length = self.aligned_kernels.shape[0]
+        results = []
+        idx = 0
+
+        # Finish the record in progress
+        if self.record_pos > 0:
+            idx = min(record_length - self.record_pos, data.size)
+            self.partial += self.integrate(data[:idx], slice(self.record_pos, self.record_pos + idx))
+            self.record_pos += idx
+            if self.record_pos == record_length:
+                results.append(self.partial[None, :])
+                self.final_init()
+
+        # Whole records
+        num_records = (data.size - idx) // record_length
+        if num_records > 0:
+            results.append(self.integrate(np.reshape(data[idx:idx + num_records*record_length], (num_records, record_length)), slice(None)))
+            idx += num_records*record_length
+
+        # Start on the next record
+        if idx < data.size:
+            self.partial   += self.integrate(data[idx:], slice(0, data.size - idx))
+            self.record_pos = data.size - idx
+
+        if len(results) == 0:
+            return
+        filtered = np.concatenate(results)
+
         # push to ouptut connectors
-        for os in self.source.output_streams:
-            os.push(filtered)
+        for i, oc in enumerate(self.sources):
+            result = filtered[:, i]
+            if self.post_int_op:
+                result = self.post_int_op(result)
+            for os in oc.output_streams:
+                os.push(result)
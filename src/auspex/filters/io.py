@@ -26,6 +26,9 @@ from auspex.data_format import AuspexDataContainer
 import itertools
 import contextlib
 import queue
+import threading
+import tempfile
+import weakref
 import numpy as np
 import os.path
 import os, psutil
@@ -40,17 +43,163 @@ from auspex.stream import InputConnector, OutputConnector
 from auspex.log import logger
 import auspex.config as config
 
+# DataBuffers live in shared memory where possible
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+BUFFER_HEADER_BYTES = 64
+
+def remove_buffer_file(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+class AsyncWriter(object):
+    """Writes data to a dataset (a memmap, or a `ChunkedDatasetWriter`) from a background thread,
+    so that slow storage does not hold up the filter pipeline. Incoming data is copied into
+    blocks of `block_points`, which are written out sequentially once full. At most `queue_depth`
+    blocks wait for the disk, after which `write` blocks, so memory use stays bounded. Written
+    data is synced (msync, plus fsync if requested) at most every `sync_interval` seconds, and
+    always when the writer is closed.
+
+    The write lag (points accepted but not yet written) and time spent writing are tracked,
+    see `stats()`. Writing starts at point `offset` of the dataset, and after every sync the
+    total number of points on disk is passed to the `commit` callback, if any."""
+    def __init__(self, dataset, dtype, block_points, queue_depth=8, sync_interval=1.0, fsync=False, offset=0, commit=None):
+        super(AsyncWriter, self).__init__()
+        self.dataset       = dataset
+        self.block_points  = block_points
+        self.sync_interval = sync_interval
+        self.fsync         = fsync
+        self.pending       = queue.Queue(maxsize=queue_depth)
+        self.free          = queue.Queue()
+        for _ in range(2):
+            self.free.put(np.empty(block_points, dtype=dtype))
+        self.spare_blocks  = queue_depth
+        self.dtype         = dtype
+
+        self.commit         = commit
+        self.block          = self.free.get()
+        self.block_idx      = 0
+        self.start          = offset
+        self.offset         = offset
+        self.points_written = 0
+        self.max_lag        = 0
+        self.write_time     = 0.0
+        self.max_write_time = 0.0
+        self.last_sync      = time.time()
+        self.error          = None
+
+        self.thread = threading.Thread(target=self._run, name="auspex-writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def lag(self):
+        return self.offset - self.start + self.block_idx - self.points_written
+
+    def stats(self):
+        return {"points_written": self.points_written, "lag": self.lag, "max_lag": self.max_lag,
+                "write_time": self.write_time, "max_write_time": self.max_write_time}
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        data = np.ravel(data)
+        while data.size > 0:
+            num = min(data.size, self.block_points - self.block_idx)
+            self.block[self.block_idx:self.block_idx+num] = data[:num]
+            self.block_idx += num
+            data = data[num:]
+            if self.block_idx == self.block_points:
+                self.submit()
+        self.max_lag = max(self.max_lag, self.lag)
+
+    def submit(self):
+        """Hand the current block, full or not, to the writer thread."""
+        if self.block_idx == 0:
+            return
+        self.pending.put((self.offset, self.block, self.block_idx))
+        self.offset += self.block_idx
+        self.block_idx = 0
+        # Use a recycled block if there is one, allocating up to the queue depth before waiting
+        try:
+            self.block = self.free.get_nowait()
+        except queue.Empty:
+            if self.spare_blocks > 0:
+                self.spare_blocks -= 1
+                self.block = np.empty(self.block_points, dtype=self.dtype)
+            else:
+                self.block = self.free.get()
+
+    def sync(self):
+        if isinstance(self.dataset, np.memmap):
+            self.dataset.flush()
+            if self.fsync:
+                with open(self.dataset.filename, 'rb+') as f:
+                    os.fsync(f.fileno())
+        elif self.dataset.file is not None:
+            self.dataset.file.flush()
+            if self.fsync:
+                os.fsync(self.dataset.file.fileno())
+        self.last_sync = time.time()
+        if self.commit:
+            self.commit(self.start + self.points_written if isinstance(self.dataset, np.memmap) else self.dataset.points_written)
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            offset, block, num = item
+            try:
+                start = time.time()
+                if isinstance(self.dataset, np.memmap):
+                    self.dataset[offset:offset+num] = block[:num]
+                else:
+                    self.dataset.write(block[:num])
+                # Count the block before syncing, so that it is included in what gets committed
+                self.points_written += num
+                if self.sync_interval is not None and time.time() - self.last_sync > self.sync_interval:
+                    self.sync()
+                elapsed = time.time() - start
+                self.write_time += elapsed
+                self.max_write_time = max(self.max_write_time, elapsed)
+            except Exception as e:
+                logger.error(f"Asynchronous write failed: {e}")
+                self.error = e
+            self.free.put(block)
+
+    def close(self):
+        """Write out everything that remains and stop the writer thread."""
+        self.submit()
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        self.sync()
+
 class WriteToFile(Filter):
     """Writes data to file using the Auspex container type, which is a simple directory structure
     with subdirectories, binary datafiles, and json meta files that store the axis descriptors
-    and other information."""
+    and other information.
+
+    Pass `version=2` to write compressed, chunked datasets instead of a flat binary file,
+    with the chunk `compression` ('zlib', 'lzma', or 'none') and approximate `chunk_bytes`.
+
+    By default data is written by an `AsyncWriter` thread in blocks of `block_bytes`, with up to
+    `queue_depth` blocks waiting for the disk and syncs every `sync_interval` seconds (plus
+    fsync if `fsync` is set). Set `async_write=False` to write from the filter itself.
+
+    The number of points safely written is recorded in the dataset's metadata as the run
+    progresses. With `resume=True` (see `Experiment.resume`) an existing dataset is reopened
+    and writing continues after the points it already holds."""
 
     sink        = InputConnector()
     filename    = FilenameParameter()
     groupname   = Parameter(default='main')
     datasetname = Parameter(default='data')
 
-    def __init__(self, filename=None, groupname=None, datasetname=None, **kwargs):
+    def __init__(self, filename=None, groupname=None, datasetname=None, version=1, compression='zlib', chunk_bytes=2**20,
+                 async_write=True, block_bytes=2**22, queue_depth=8, sync_interval=1.0, fsync=False, resume=False, **kwargs):
         super(WriteToFile, self).__init__(**kwargs)
         if filename: 
             self.filename.value = filename
@@ -59,6 +208,18 @@ class WriteToFile(Filter):
         if datasetname:
             self.datasetname.value = datasetname
 
+        self.version     = version
+        self.compression = compression
+        self.chunk_bytes = chunk_bytes
+
+        self.async_write   = async_write
+        self.block_bytes   = block_bytes
+        self.queue_depth   = queue_depth
+        self.sync_interval = sync_interval
+        self.fsync         = fsync
+        self.writer        = None
+        self.resume        = resume
+
         self.ret_queue = None # MP queue For returning data
 
     def final_init(self):
@@ -69,10 +230,35 @@ class WriteToFile(Filter):
         self.descriptor = self.sink.input_streams[0].descriptor
         self.container  = AuspexDataContainer(self.filename.value)
         self.group      = self.container.new_group(self.groupname.value)
-        self.mmap       = self.container.new_dataset(self.groupname.value, self.datasetname.value, self.descriptor)
+        options = dict(version=self.version, compression=self.compression, chunk_bytes=self.chunk_bytes)
+        if self.resume:
+            self.mmap, self.w_idx = self.container.resume_dataset(self.groupname.value, self.datasetname.value, self.descriptor, **options)
+        else:
+            self.mmap  = self.container.new_dataset(self.groupname.value, self.datasetname.value, self.descriptor, **options)
+            self.w_idx = 0
+        self.points_taken = self.w_idx
+        self.last_commit  = time.time()
 
-        self.w_idx = 0
-        self.points_taken = 0
+    def seek(self, points):
+        """Continue writing from point `points` of the dataset, which must not be past the
+        points already written. Only to be used before the run starts."""
+        assert points <= self.w_idx, "Cannot seek past the data written so far."
+        if self.version == 2:
+            self.mmap.truncate(points)
+        self.w_idx = points
+        self.points_taken = points
+
+    def commit(self, points):
+        self.container.commit(self.groupname.value, self.datasetname.value, points)
+
+    def execute_on_run(self):
+        # The writer thread has to be started by the process that runs the filter
+        if self.async_write:
+            dtype = np.dtype(self.descriptor.dtype)
+            block_points = max(1, min(self.block_bytes // dtype.itemsize, self.descriptor.expected_num_points()))
+            self.writer = AsyncWriter(self.mmap, dtype, block_points, queue_depth=self.queue_depth,
+                                      sync_interval=self.sync_interval, fsync=self.fsync,
+                                      offset=self.w_idx, commit=self.commit)
 
     def get_data_while_running(self, return_queue):
         """Return data to the main thread or user as requested. Use a MP queue to transmit."""
@@ -86,52 +272,93 @@ class WriteToFile(Filter):
 
     def process_data(self, data):
         # Write the data
-        self.mmap[self.w_idx:self.w_idx+data.size] = data
+        if self.writer:
+            self.writer.write(data)
+        elif self.version == 2:
+            self.mmap.write(data)
+        else:
+            self.mmap[self.w_idx:self.w_idx+data.size] = data
         self.w_idx += data.size
         self.points_taken = self.w_idx
+        if not self.writer and self.sync_interval is not None and time.time() - self.last_commit > self.sync_interval:
+            if self.version == 2:
+                self.commit(self.mmap.points_written)
+            else:
+                self.mmap.flush()
+                self.commit(self.w_idx)
+            self.last_commit = time.time()
+
+    def on_done(self):
+        if self.writer:
+            self.writer.close()
+            stats = self.writer.stats()
+            logger.debug(f"{self} wrote {stats['points_written']} points in {stats['write_time']:.3f} s "
+                         f"(max lag {stats['max_lag']} points, slowest block {stats['max_write_time']:.3f} s)")
+            self.writer = None
+        if self.version == 2:
+            self.mmap.close()
+            self.commit(self.mmap.points_written)
+        else:
+            self.mmap.flush()
+            self.commit(self.w_idx)
 
 class DataBuffer(Filter):
-    """Writes data to IO."""
+    """Collects data in a buffer that is shared with the process that created the filter, so
+    that `get_data` can read it at any time without the data being sent between processes. The
+    buffer is a memory mapped temporary file (in /dev/shm where available) that starts with a
+    small header: a generation counter, which is odd while data is being written, followed by
+    the number of points taken. Readers use the counter to take consistent snapshots."""
 
     sink = InputConnector()
 
     def __init__(self, **kwargs):
         super(DataBuffer, self).__init__(**kwargs)
-        self._final_buffer = Queue()
-        self._temp_buffer = Queue()
-        self._get_buffer = Event()
-        self.final_buffer  = None
+        self.header      = None
+        self.buff        = None
+        self.buffer_file = None
 
     def final_init(self):
         self.w_idx        = 0
         self.points_taken = 0
         self.descriptor   = self.sink.input_streams[0].descriptor
-        self.buff         = np.empty(self.descriptor.expected_num_points(), dtype=self.descriptor.dtype)
+        dtype             = np.dtype(self.descriptor.dtype)
+
+        # Each run gets a fresh buffer, as the last one may still be in use
+        if self.buffer_file:
+            remove_buffer_file(self.buffer_file)
+        fd, self.buffer_file = tempfile.mkstemp(prefix="auspex-buffer-", suffix=".dat", dir=SHARED_MEMORY_DIR)
+        num_points = max(self.descriptor.expected_num_points(), 1)
+        os.ftruncate(fd, BUFFER_HEADER_BYTES + num_points*dtype.itemsize)
+        os.close(fd)
+        self.header = np.memmap(self.buffer_file, dtype=np.int64, mode='r+', shape=(2,))
+        self.buff   = np.memmap(self.buffer_file, dtype=dtype, mode='r+', offset=BUFFER_HEADER_BYTES, shape=(num_points,))
+        weakref.finalize(self, remove_buffer_file, self.buffer_file)
 
-    def checkin(self):
-        if self._get_buffer.is_set():
-            self._temp_buffer.put(self.buff)
-        self._get_buffer.clear()
+    @property
+    def generation(self):
+        """The number of completed writes to the buffer."""
+        return int(self.header[0]) // 2
 
     def process_data(self, data):
         # Write the data
+        self.header[0] += 1
         self.buff[self.w_idx:self.w_idx+data.size] = data
         self.w_idx += data.size
         self.points_taken = self.w_idx
-
-    def main(self):
-        super(DataBuffer, self).main()
-        self._final_buffer.put(self.buff)
+        self.header[1] = self.w_idx
+        self.header[0] += 1
 
     def get_data(self):
+        num_points = self.descriptor.expected_num_points()
         if self.done.is_set():
-            if self.final_buffer is None:
-                self.final_buffer = self._final_buffer.get()
-            time.sleep(0.05)
-            return np.reshape(self.final_buffer, self.descriptor.dims()), self.descriptor
+            # Nothing will change, so hand out the buffer itself
+            data = self.buff[:num_points].view(np.ndarray)
         else:
-            self._get_buffer.set()
-            temp_buffer = self._temp_buffer.get()
-            time.sleep(0.05)
-            return np.reshape(temp_buffer, self.descriptor.dims()), self.descriptor
-        
+            while True:
+                generation = self.header[0]
+                if generation % 2 == 0:
+                    data = np.array(self.buff[:num_points])
+                    if self.header[0] == generation:
+                        break
+                time.sleep(0.001)
+        return np.reshape(data, self.descriptor.dims()), self.descriptor
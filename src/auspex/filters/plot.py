@@ -28,6 +28,9 @@ else:
     from multiprocessing import Queue
 
 class Plotter(Filter):
+    # Keep plot updates from stalling the data path
+    fusible   = False
+
     sink      = InputConnector()
     plot_dims = IntParameter(value_range=(0,1,2), snap=1, default=0) # 0 means auto
     plot_mode = Parameter(allowed_values=["real", "imag", "real/imag", "amp/phase", "quad"], default="quad")
@@ -219,6 +222,8 @@ class Plotter(Filter):
         return self.descriptor.axes[index].name + unit_str
 
 class MeshPlotter(Filter):
+    fusible = False
+
     sink = InputConnector()
     plot_mode = Parameter(allowed_values=["real", "imag", "real/imag", "amp/phase", "quad"], default="quad")
 
@@ -0,0 +1,350 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+__all__ = ['FilterRuntime']
+
+import os
+import sys
+import io
+import mmap
+import copy
+import types
+import pickle
+import traceback
+
+if sys.platform == 'win32' or 'NOFORKING' in os.environ:
+    from threading import Event, Lock
+    from queue import Queue
+else:
+    import multiprocessing as mp
+    import multiprocessing.queues
+    import multiprocessing.synchronize
+    import multiprocessing.sharedctypes
+    from multiprocessing import Process, Event, Queue, SimpleQueue, Value, Lock
+
+from setproctitle import setproctitle
+import numpy as np
+
+from .filter import Filter
+from auspex.parameter import Parameter
+from auspex.stream import StreamChannel, InputConnector, OutputConnector
+from auspex.log import logger
+
+class _WorkerSlot(object):
+    """A persistent worker process, along with the events and queues it lends to the filter it runs."""
+    def __init__(self, num_events, num_queues):
+        self.jobs      = Queue()
+        self.idle      = Event()
+        self.events    = [Event() for _ in range(num_events)]
+        self.queues    = [Queue() for _ in range(num_queues)]
+        self.errors    = SimpleQueue() # Written synchronously, so errors are there before idle is set
+        self.process   = None
+        self.filter    = None
+        self.originals = {}
+
+class _FilterPickler(pickle.Pickler):
+    """Pickles a filter for a worker. Runtime resources are sent by reference, everything the
+    worker cannot or should not receive (other filters, the experiment, database objects) is
+    dropped, and process-bound primitives are recreated on the other side. Parameters that belong
+    to the experiment (e.g. those of sweep axes) travel without the methods and hooks that only
+    the experiment calls. Any other callable that cannot follow the filter (lambdas, local
+    functions, methods of objects that are dropped) makes pickling fail, so that the filter
+    runs in its own process instead."""
+    def __init__(self, file, filt, resources, foreign):
+        super(_FilterPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.filt      = filt
+        self.resources = resources
+        self.foreign   = foreign
+        self.detached  = {} # Copies of the experiment's parameters, pickled as they are
+
+    def persistent_id(self, obj):
+        key = self.resources.get(id(obj))
+        if key is not None:
+            return key
+        if isinstance(obj, Filter):
+            return None if obj is self.filt else ('none',)
+        if isinstance(obj, (InputConnector, OutputConnector)):
+            return None if obj.parent is self.filt else ('none',)
+        if any(obj is f for f in self.foreign) or type(obj).__module__.split('.')[0] in FilterRuntime.foreign_modules:
+            return ('none',)
+        if isinstance(obj, Parameter) and getattr(obj, 'parent', None) is not self.filt and id(obj) not in self.detached:
+            detached = copy.copy(obj)
+            self.detached[id(detached)] = detached
+            detached.method, detached.instrument, detached.instrument_tree = None, None, None
+            detached.pre_push_hooks, detached.post_push_hooks = [], []
+            detached.parent = None
+            return ('parameter', detached)
+        if isinstance(obj, mp.process.AuthenticationString):
+            return ('none',)
+        if isinstance(obj, mp.sharedctypes.Synchronized):
+            return ('value', obj._obj._type_, obj.value)
+        if isinstance(obj, (mp.synchronize.Lock, mp.synchronize.RLock)):
+            return ('lock',)
+        if isinstance(obj, types.MethodType) and self.persistent_id(obj.__self__) == ('none',):
+            raise pickle.PicklingError(f"{obj} is bound to an object that stays behind.")
+        if isinstance(obj, types.FunctionType) and '<' in obj.__qualname__:
+            raise pickle.PicklingError(f"{obj} cannot be sent by reference.")
+        if isinstance(obj, np.memmap):
+            if not isinstance(obj.base, mmap.mmap):
+                raise pickle.PicklingError("Only whole memmaps can be reopened by a worker.")
+            return ('memmap', obj.filename, obj.dtype.str, obj.shape, obj.offset)
+        return None
+
+class _FilterUnpickler(pickle.Unpickler):
+    def __init__(self, file, channels, resources):
+        super(_FilterUnpickler, self).__init__(file)
+        self.channels  = channels
+        self.resources = resources
+
+    def persistent_load(self, key):
+        kind = key[0]
+        if kind in ('channel', 'slot'):
+            return self.resources[key]
+        elif kind == 'view':
+            return np.frombuffer(self.channels[key[1]].buff_shared, dtype=key[2], count=key[3])
+        elif kind == 'none':
+            return None
+        elif kind == 'parameter':
+            return key[1]
+        elif kind == 'value':
+            return Value(key[1], key[2])
+        elif kind == 'lock':
+            return Lock()
+        elif kind == 'memmap':
+            return np.memmap(key[1], dtype=key[2], mode='r+', shape=key[3], offset=key[4])
+        raise pickle.UnpicklingError(f"Unknown filter runtime resource {key}")
+
+def _worker_main(runtime, index):
+    """Run loop of a persistent worker: receive a filter, run it to completion, repeat."""
+    slot      = runtime.slots[index]
+    resources = runtime._resources(slot)
+    setproctitle(f"python auspex filter runtime worker {index}")
+    slot.idle.set()
+    while True:
+        payload = slot.jobs.get()
+        if payload is None:
+            break
+        filt = None
+        try:
+            filt = _FilterUnpickler(io.BytesIO(payload), runtime.channels, resources).load()
+            filt.run()
+        except Exception as e:
+            logger.error(f"Filter runtime worker {index} failed while running {filt}: {e}\n{traceback.format_exc()}")
+            # Hand the error to the experiment, which raises it once it waits for the filter
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(f"{type(e).__name__}: {e}")
+            slot.errors.put(e)
+            # Don't leave the experiment waiting on a filter that will never finish
+            for event in slot.events:
+                event.set()
+        finally:
+            filt = None
+            slot.idle.set()
+
+class FilterRuntime(object):
+    """A pool of persistent worker processes that run the filter pipeline. Starting a process
+    per filter, and allocating its queues and shared memory, dominates the cost of short
+    experiments that are run over and over (e.g. calibrations), so instead the runtime forks its
+    workers once, along with a set of stream channels, and lends both to each experiment in turn.
+
+    Filters are pickled to idle workers, with the runtime's own primitives standing in for their
+    events and queues so that the experiment can still wait on them. Any filter that cannot be
+    shipped, or that finds no free worker, is started as its own process as usual. The runtime
+    serves one experiment at a time; a second experiment running concurrently falls back to
+    ordinary processes. To use it for all experiments:
+
+    >>> auspex.config.filter_runtime = FilterRuntime(num_workers=8).start()
+    """
+
+    # Modules whose objects are never sent to a worker
+    foreign_modules = ('bbndb', 'sqlalchemy')
+
+    # How long (s) to wait for a worker to finish before recycling it
+    release_timeout = 10.0
+
+    def __init__(self, num_workers=8, num_channels=32, channel_bytes=2**23, num_events=6, num_queues=4):
+        super(FilterRuntime, self).__init__()
+        self.num_workers   = num_workers
+        self.num_channels  = num_channels
+        self.channel_bytes = channel_bytes
+        self.num_events    = num_events
+        self.num_queues    = num_queues
+        self.channels      = []
+        self.slots         = []
+        self.leased        = []
+        self.running       = False
+
+    def __bool__(self):
+        return self.running
+
+    def start(self):
+        if sys.platform == 'win32' or 'NOFORKING' in os.environ:
+            logger.warning("The filter runtime requires forked processes, filters will be started individually.")
+            return self
+        # Everything the workers share must exist before they fork
+        self.channels = [StreamChannel(self.channel_bytes) for _ in range(self.num_channels)]
+        self.slots    = [_WorkerSlot(self.num_events, self.num_queues) for _ in range(self.num_workers)]
+        self._channel_keys = {}
+        for i, channel in enumerate(self.channels):
+            for name, obj in vars(channel).items():
+                self._channel_keys[id(obj)] = ('channel', i, name)
+        for i in range(self.num_workers):
+            self._spawn(i)
+        self.running = True
+        return self
+
+    def stop(self):
+        for slot in self.slots:
+            slot.jobs.put(None)
+        for slot in self.slots:
+            slot.process.join(self.release_timeout)
+            if slot.process.is_alive():
+                slot.process.terminate()
+        self.channels = []
+        self.slots    = []
+        self.running  = False
+
+    def _spawn(self, index):
+        slot = self.slots[index]
+        slot.idle.clear()
+        slot.process = Process(target=_worker_main, args=(self, index), daemon=True)
+        slot.process.start()
+
+    def _resources(self, slot):
+        resources = {key: getattr(self.channels[key[1]], key[2]) for key in self._channel_keys.values()}
+        for k, event in enumerate(slot.events):
+            resources[('slot', 'event', k)] = event
+        for k, q in enumerate(slot.queues):
+            resources[('slot', 'queue', k)] = q
+        return resources
+
+    def attach_streams(self, streams):
+        """Lend a channel to each of the streams. Returns False, without attaching anything,
+        if the runtime is not running, is already serving an experiment, or is too small."""
+        streams = list(streams)
+        if not self.running or self.leased or len(streams) > len(self.channels):
+            return False
+        for stream, channel in zip(streams, self.channels):
+            stream.attach(channel)
+        self.leased = streams
+        return True
+
+    def launch(self, filters, foreign=()):
+        """Hand the filters to idle workers, and return a list of those that must instead
+        be started as ordinary processes."""
+        rejected = []
+        for filt in filters:
+            slot = next((s for s in self.slots if s.filter is None and s.idle.is_set()), None)
+            if slot is None or not self._ship(filt, slot, foreign):
+                rejected.append(filt)
+        return rejected
+
+    def _ship(self, filt, slot, foreign):
+        if filt.fused_filters:
+            # The filters hosted by this one would have to travel with it
+            return False
+        streams = [s for c in filt.input_connectors.values() for s in c.input_streams]
+        streams.extend(s for c in filt.output_connectors.values() for s in c.output_streams)
+        if any(s.channel is None for s in streams):
+            return False
+
+        # Swap the filter's events and queues for the slot's, which the worker already holds
+        bindings = {}
+        events, queues = iter(slot.events), iter(slot.queues)
+        for name, value in vars(filt).items():
+            if isinstance(value, mp.synchronize.Event):
+                prim = next(events, None)
+                if prim is not None:
+                    prim.set() if value.is_set() else prim.clear()
+            elif isinstance(value, mp.queues.Queue):
+                prim = next(queues, None)
+                while prim is not None and not prim.empty():
+                    prim.get_nowait()
+            else:
+                continue
+            if prim is None:
+                logger.debug(f"{filt} has too many events or queues for the filter runtime.")
+                return False
+            bindings[name] = prim
+        originals = {name: getattr(filt, name) for name in bindings}
+        for name, prim in bindings.items():
+            setattr(filt, name, prim)
+
+        resources = dict(self._channel_keys)
+        for stream in streams:
+            resources[id(stream.buff_np)] = ('view', self.channels.index(stream.channel), stream.dtype.str, stream.buffer_size)
+        for k, event in enumerate(slot.events):
+            resources[id(event)] = ('slot', 'event', k)
+        for k, q in enumerate(slot.queues):
+            resources[id(q)] = ('slot', 'queue', k)
+
+        payload = io.BytesIO()
+        try:
+            _FilterPickler(payload, filt, resources, foreign).dump(filt)
+        except Exception as e:
+            logger.debug(f"Could not ship {filt} to the filter runtime ({e}), it will run in its own process.")
+            for name, original in originals.items():
+                setattr(filt, name, original)
+            return False
+
+        slot.filter    = filt
+        slot.originals = originals
+        slot.idle.clear()
+        slot.jobs.put(payload.getvalue())
+        return True
+
+    def wait(self, filt, timeout=None):
+        """Wait for a filter launched on the runtime to finish, like Process.join(). Raises the
+        exception that stopped the filter, if any."""
+        for slot in self.slots:
+            if slot.filter is filt:
+                finished = slot.idle.wait(timeout)
+                if finished and not slot.errors.empty():
+                    raise slot.errors.get()
+                return finished
+        return True
+
+    def release(self):
+        """Recover the workers and channels lent to the current experiment. Workers that have
+        not finished are replaced, and the filters get their own events and queues back in the
+        state the worker left them."""
+        stuck = False
+        for i, slot in enumerate(self.slots):
+            filt = slot.filter
+            if filt is None:
+                continue
+            if not slot.idle.wait(self.release_timeout):
+                logger.warning(f"Filter runtime worker {i} is stuck running {filt}, terminating it.")
+                slot.process.terminate()
+                slot.process.join()
+                stuck = True
+            for name, original in slot.originals.items():
+                prim = getattr(filt, name)
+                if isinstance(original, mp.queues.Queue):
+                    while not prim.empty():
+                        original.put(prim.get_nowait())
+                else:
+                    original.set() if prim.is_set() else original.clear()
+                setattr(filt, name, original)
+            while not slot.errors.empty():
+                slot.errors.get()
+            slot.filter    = None
+            slot.originals = {}
+        # Streams go back to private transport, so that later runs don't touch channels
+        # that now belong to someone else, along with a fresh (empty) ring of their own.
+        for stream in self.leased:
+            stream.attach(None)
+            if stream.descriptor is not None:
+                stream.final_init()
+        self.leased = []
+        if stuck:
+            # A terminated worker may have left shared queues locked, so start over
+            self.stop()
+            self.start()
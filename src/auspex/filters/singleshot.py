@@ -10,7 +10,7 @@ __all__ = ['SingleShotMeasurement']
 
 import numpy as np
 from scipy.signal import hilbert
-from scipy.stats import gaussian_kde, norm
+from scipy.stats import norm
 from scipy.special import betaincinv
 from sklearn.linear_model import LogisticRegressionCV
 from time import sleep
@@ -29,6 +29,32 @@ from auspex.log import logger
 import auspex.config as config
 import time
 
+def batched_histogram(x, lows, highs, num_bins):
+    """Histogram each row of `x` into `num_bins` equal bins spanning [lows, highs] for that row,
+    with the same edge conventions as np.histogram. Returns an array of shape (rows, num_bins)."""
+    rows = x.shape[0]
+    width = np.where(highs > lows, highs - lows, 1.0)
+    idx = ((x - lows[:, np.newaxis]) * (num_bins / width)[:, np.newaxis]).astype(np.int64)
+    np.clip(idx, 0, num_bins - 1, out=idx)
+    idx += num_bins*np.arange(rows)[:, np.newaxis]
+    return np.bincount(idx.ravel(), minlength=rows*num_bins).reshape(rows, num_bins)
+
+def binned_kde(samples, grid):
+    """Gaussian kernel density estimate of `samples` on an evenly spaced `grid`, using linear
+    binning onto the grid followed by a convolution with the kernel. Uses Scott's rule for the
+    bandwidth (but no narrower than the grid spacing), as does scipy.stats.gaussian_kde, while
+    costing O(N) rather than O(N*len(grid))."""
+    step = grid[1] - grid[0]
+    pos = np.clip((samples - grid[0]) / step, 0, len(grid) - 1)
+    lower = np.minimum(pos.astype(np.int64), len(grid) - 2)
+    frac = pos - lower
+    counts = np.bincount(lower, 1 - frac, minlength=len(grid)) + np.bincount(lower + 1, frac, minlength=len(grid))
+    bandwidth = max(np.std(samples, ddof=1) * len(samples)**(-1/5), step)
+    half_width = min(int(np.ceil(4*bandwidth/step)), len(grid) - 1)
+    offsets = step*np.arange(-half_width, half_width + 1)
+    weights = np.exp(-0.5*(offsets/bandwidth)**2) / (np.sqrt(2*np.pi)*bandwidth*len(samples))
+    return np.convolve(counts, weights)[half_width:half_width+len(grid)]
+
 class SingleShotMeasurement(Filter):
 
     save_kernel = BoolParameter(default=False)
@@ -71,8 +97,8 @@ class SingleShotMeasurement(Filter):
             raise ValueError("Single shot filter sink does not appear to have a time axis!")
         self.num_averages = len(self.sink.descriptor.axes[self.descriptor.axis_num("averages")].points)
         self.num_segments = len(self.sink.descriptor.axes[self.descriptor.axis_num("segment")].points)
-        self.ground_data = np.zeros((self.record_length, self.num_averages), dtype=np.complex)
-        self.excited_data = np.zeros((self.record_length, self.num_averages), dtype=np.complex)
+        self.ground_data = np.zeros((self.record_length, self.num_averages), dtype=np.complex128)
+        self.excited_data = np.zeros((self.record_length, self.num_averages), dtype=np.complex128)
         self.total_points = self.num_segments*self.record_length*self.num_averages # Total points BEFORE sweep axes
 
         output_descriptor = DataStreamDescriptor()
@@ -89,21 +115,59 @@ class SingleShotMeasurement(Filter):
 
 
     def final_init(self):
-        self.fid_buffer = np.empty(self.record_length*self.num_averages*self.num_segments, dtype=np.complex)
+        self.fid_buffer = np.empty(self.record_length*self.num_averages*self.num_segments, dtype=np.complex128)
         self.idx = 0
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        """Running per-time-point statistics of the shots received so far."""
+        self.shots_done   = 0
+        self.ground_count = 0
+        self.ground_mean  = np.zeros(self.record_length, dtype=np.complex128)
+        self.ground_m2    = np.zeros(self.record_length, dtype=np.float64)
+        self.excited_count = 0
+        self.excited_mean  = np.zeros(self.record_length, dtype=np.complex128)
+
+    def update_statistics(self):
+        """Fold the shots completed since the last call into the running statistics, so that
+        the matched filter is ready as soon as the last shot arrives."""
+        shots = self.idx // self.record_length
+        if shots <= self.shots_done:
+            return
+        block = self.fid_buffer[self.shots_done*self.record_length:shots*self.record_length].reshape(self.record_length, -1, order='F')
+        # Ground and excited shots alternate
+        ground  = block[:, self.shots_done % 2::2]
+        excited = block[:, (self.shots_done + 1) % 2::2]
+
+        if ground.shape[1] > 0:
+            # Chan et al. pairwise update of the mean and the sum of squared deviations
+            n     = ground.shape[1]
+            mean  = ground.mean(axis=1)
+            m2    = np.sum(np.abs(ground - mean[:, np.newaxis])**2, axis=1)
+            total = self.ground_count + n
+            delta = mean - self.ground_mean
+            self.ground_mean += delta * n / total
+            self.ground_m2   += m2 + np.abs(delta)**2 * self.ground_count * n / total
+            self.ground_count = total
+        if excited.shape[1] > 0:
+            n     = excited.shape[1]
+            total = self.excited_count + n
+            self.excited_mean += (excited.mean(axis=1) - self.excited_mean) * n / total
+            self.excited_count = total
+        self.shots_done = shots
 
     def process_data(self, data):
         """Fill the ground and excited data bins"""
 
         self.fid_buffer[self.idx:self.idx+len(data)] = data
         self.idx += len(data)
+        self.update_statistics()
 
         if self.idx == self.record_length*self.num_averages*self.num_segments:
-            self.idx = 0
             reshaped = self.fid_buffer.reshape(self.record_length, -1, order='F')
             self.ground_data = reshaped[:, ::2]
             self.excited_data = reshaped[:, 1::2]
-            self.compute_filter()
+            self.compute_filter(statistics=(self.ground_mean, self.excited_mean, self.ground_m2/(self.ground_count-1)))
             if self.logistic_regression.value:
                 self.logistic_fidelity()
             if self.save_kernel.value:
@@ -111,26 +175,35 @@ class SingleShotMeasurement(Filter):
             for os in self.fidelity.output_streams:
                 os.push(self.fidelity_result)
             self.pdf_data_queue.put(self.pdf_data)
+            self.idx = 0
+            self.reset_statistics()
 
-    def compute_filter(self):
+    def compute_filter(self, statistics=None):
         """Compute the single shot kernel and obtain single-shot measurement
         fidelity.
 
         Expects that the data will be in self.ground_data and self.excited_data,
         which are (T, N)-shaped numpy arrays, with T the time axis and N the
-        number of shots."""
+        number of shots. The ground mean, excited mean and ground variance along
+        the time axis can be passed in as `statistics` if they are already known,
+        otherwise they are computed from the data.
+
+        The I and Q distributions are estimated with `binned_kde`, on bins spanning
+        the range of each quadrature over both states."""
         #get excited and ground state data
-        try:
-            ground_mean = np.mean(self.ground_data, axis=1)
-            excited_mean = np.mean(self.excited_data, axis=1)
-        except AttributeError:
-            raise Exception("Single shot filter does not appear to have any data!")
+        if statistics is None:
+            try:
+                statistics = (np.mean(self.ground_data, axis=1), np.mean(self.excited_data, axis=1),
+                              np.var(self.ground_data, ddof=1, axis=1))
+            except AttributeError:
+                raise Exception("Single shot filter does not appear to have any data!")
+        ground_mean, excited_mean, ground_var = statistics
         distance = np.abs(np.mean(ground_mean - excited_mean))
         bias = np.mean(ground_mean + excited_mean) / distance
         logger.debug("Found single-shot measurement distance: {} and bias {}.".format(distance, bias))
         #construct matched filter kernel
         old_settings = np.seterr(divide='ignore', invalid='ignore')
-        kernel = np.nan_to_num(np.divide(np.conj(ground_mean - excited_mean), np.var(self.ground_data, ddof=1, axis=1)))
+        kernel = np.nan_to_num(np.divide(np.conj(ground_mean - excited_mean), ground_var))
         np.seterr(**old_settings)
         #sets kernel to zero when difference is too small, and prevents
         #kernel from diverging when var->0 at beginning of record_length
@@ -146,52 +219,35 @@ class SingleShotMeasurement(Filter):
             kernel = hilbert(np.real(kernel))
         #normalize between -1 and 1
         kernel = kernel / np.amax(np.hstack([np.abs(np.real(kernel)), np.abs(np.imag(kernel))]))
-        #apply matched filter
-        weighted_ground = self.ground_data * kernel[:, np.newaxis]
-        weighted_excited = self.excited_data * kernel[:, np.newaxis]
 
+        #apply matched filter
         if self.optimal_integration_time.value:
-            #take cumulative sum up to each time step
-            ground_I = np.real(weighted_ground)
-            ground_Q = np.imag(weighted_ground)
-            excited_I = np.real(weighted_excited)
-            excited_Q = np.imag(weighted_excited)
-            int_ground_I = np.cumsum(ground_I, axis=0)
-            int_ground_Q = np.cumsum(ground_Q, axis=0)
-            int_excited_I = np.cumsum(excited_I, axis=0)
-            int_excited_Q = np.cumsum(excited_Q, axis=0)
-            I_mins = np.amin(np.minimum(int_ground_I, int_excited_I), axis=1)
-            I_maxes = np.amax(np.maximum(int_ground_I, int_excited_I), axis=1)
+            #take cumulative sum of the in-phase quadrature up to each time step
+            int_ground_I = np.cumsum(np.real(self.ground_data * kernel[:, np.newaxis]), axis=0)
+            int_excited_I = np.cumsum(np.real(self.excited_data * kernel[:, np.newaxis]), axis=0)
+            I_mins = np.minimum(np.amin(int_ground_I, axis=1), np.amin(int_excited_I, axis=1))
+            I_maxes = np.maximum(np.amax(int_ground_I, axis=1), np.amax(int_excited_I, axis=1))
             num_times = int_ground_I.shape[0]
-            fidelities = np.zeros((num_times, ))
-            #Loop through each integration point; estimate the CDF and
-            #then calculate best measurement fidelity
-            for pt in range(num_times):
-                bins = np.linspace(I_mins[pt], I_maxes[pt], 100)
-                g_PDF = np.histogram(int_ground_I[pt, :], bins)[0]
-                e_PDF = np.histogram(int_excited_I[pt,:], bins)[0]
-                fidelities[pt] = np.sum(np.abs(g_PDF - e_PDF)) / np.sum(g_PDF + e_PDF)
+            #histogram every integration point at once and pick the best measurement fidelity
+            g_PDF = batched_histogram(int_ground_I, I_mins, I_maxes, 99)
+            e_PDF = batched_histogram(int_excited_I, I_mins, I_maxes, 99)
+            fidelities = np.sum(np.abs(g_PDF - e_PDF), axis=1) / np.sum(g_PDF + e_PDF, axis=1)
             best_idx = fidelities.argmax(axis=0)
             self.best_integration_time = best_idx
             logger.info("Found best integration time at {} out of {} decimated points.".format(best_idx, num_times))
-            #redo calculation with KDEs to get a more accurate estimate
-            bins = np.linspace(I_mins[best_idx], I_maxes[best_idx], 100)
-            g_KDE = gaussian_kde(int_ground_I[best_idx, :])
-            e_KDE = gaussian_kde(int_excited_I[best_idx, :])
-            g_PDF = g_KDE(bins)
-            e_PDF = e_KDE(bins)
+            #integrate both quadratures up to the best time
+            ground = np.dot(kernel[:best_idx+1], self.ground_data[:best_idx+1])
+            excited = np.dot(kernel[:best_idx+1], self.excited_data[:best_idx+1])
         else:
-            ground_I = np.sum(np.real(weighted_ground), axis=0)
-            ground_Q = np.sum(np.imag(weighted_excited), axis=0)
-            excited_I = np.sum(np.real(weighted_excited), axis=0)
-            excited_Q = np.sum(np.imag(weighted_excited), axis=0)
-            I_min = np.amin(np.minimum(ground_I, excited_I))
-            I_max = np.amax(np.maximum(ground_I, excited_I))
-            bins = np.linspace(I_min, I_max, 100)
-            g_KDE = gaussian_kde(ground_I)
-            e_KDE = gaussian_kde(excited_I)
-            g_PDF = g_KDE(bins)
-            e_PDF = e_KDE(bins)
+            ground = np.dot(kernel, self.ground_data)
+            excited = np.dot(kernel, self.excited_data)
+        ground_I, ground_Q = np.real(ground), np.imag(ground)
+        excited_I, excited_Q = np.real(excited), np.imag(excited)
+
+        #smooth the distributions with a binned kernel density estimate
+        bins = np.linspace(min(np.amin(ground_I), np.amin(excited_I)), max(np.amax(ground_I), np.amax(excited_I)), 100)
+        g_PDF = binned_kde(ground_I, bins)
+        e_PDF = binned_kde(excited_I, bins)
 
         self.kernel = kernel
         max_F_I = 1 - 0.5 * (1 - 0.5 * (bins[2] - bins[1]) * np.sum(np.abs(g_PDF - e_PDF)))
@@ -206,41 +262,21 @@ class SingleShotMeasurement(Filter):
             self.pdf_data["I Threshold"] = bins[indmax]
             logger.info("Single shot kernel found I threshold at {}.".format(bins[indmax]))
 
-        if self.optimal_integration_time.value:
-            mu_g, sigma_g = norm.fit(int_ground_I[best_idx, :])
-            mu_e, sigma_e = norm.fit(int_excited_I[best_idx, :])
-        else:
-            mu_g, sigma_g = norm.fit(ground_I)
-            mu_e, sigma_e = norm.fit(excited_I)
-        self.pdf_data["Ground I Gaussian PDF"] = norm.pdf(bins, mu_g, sigma_g)
-        self.pdf_data["Excited I Gaussian PDF"] = norm.pdf(bins, mu_e, sigma_e)
+        #maximum likelihood gaussian fits
+        self.pdf_data["Ground I Gaussian PDF"] = norm.pdf(bins, np.mean(ground_I), np.std(ground_I))
+        self.pdf_data["Excited I Gaussian PDF"] = norm.pdf(bins, np.mean(excited_I), np.std(excited_I))
 
         #calculate kernel density estimates for other quadrature
-        if self.optimal_integration_time.value:
-            Q_min = np.amin([int_ground_Q[best_idx,:], int_excited_Q[best_idx,:]])
-            Q_max = np.argmax([int_ground_Q[best_idx,:], int_excited_Q[best_idx,:]])
-            qbins = np.linspace(Q_min, Q_max, 100)
-            g_KDE = gaussian_kde(int_ground_Q[best_idx, :])
-            e_KDE = gaussian_kde(int_excited_Q[best_idx, :])
-        else:
-            qbins = np.linspace(np.amin([ground_Q, excited_Q]), np.amax([ground_Q, excited_Q]), 100)
-            g_KDE = gaussian_kde(ground_Q)
-            e_KDE = gaussian_kde(excited_Q)
+        qbins = np.linspace(min(np.amin(ground_Q), np.amin(excited_Q)), max(np.amax(ground_Q), np.amax(excited_Q)), 100)
         self.pdf_data["Q Bins"] = qbins
-        g_PDF_Q = g_KDE(qbins)
-        e_PDF_Q = e_KDE(qbins)
+        g_PDF_Q = binned_kde(ground_Q, qbins)
+        e_PDF_Q = binned_kde(excited_Q, qbins)
         self.pdf_data["Ground Q PDF"] =  g_PDF_Q
         self.pdf_data["Excited Q PDF"] =  e_PDF_Q
         self.pdf_data["Max Q Fidelity"] = 1 - 0.5 * (1 - 0.5 * (qbins[2] - qbins[1]) * np.sum(np.abs(g_PDF_Q - e_PDF_Q)))
 
-        if self.optimal_integration_time.value:
-            mu_g, sigma_g = norm.fit(int_ground_Q[best_idx, :])
-            mu_e, sigma_e = norm.fit(int_excited_Q[best_idx, :])
-        else:
-            mu_g, sigma_g = norm.fit(ground_Q)
-            mu_e, sigma_e = norm.fit(excited_Q)
-        self.pdf_data["Ground Q Gaussian PDF"] = norm.pdf(bins, mu_g, sigma_g)
-        self.pdf_data["Excited Q Gaussian PDF"] = norm.pdf(bins, mu_e, sigma_e)
+        self.pdf_data["Ground Q Gaussian PDF"] = norm.pdf(qbins, np.mean(ground_Q), np.std(ground_Q))
+        self.pdf_data["Excited Q Gaussian PDF"] = norm.pdf(qbins, np.mean(excited_Q), np.std(excited_Q))
 
         self.fidelity_result = self.pdf_data["Max I Fidelity"] + 1j * self.pdf_data["Max Q Fidelity"]
         logger.info("Single shot fidelity filter found: {}".format(self.fidelity_result))
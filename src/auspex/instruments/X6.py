@@ -19,26 +19,11 @@ import sys
 
 from auspex.log import logger
 import auspex.config as config
-from .instrument import Instrument, ReceiverChannel
+from .instrument import Instrument, ReceiverChannel, SocketReceiver
+from .synthetic import SyntheticX6
 from unittest.mock import MagicMock
 
-from multiprocessing import Value
-
-# win32 doesn't support MSG_WAITALL, so on windows we
-# need to do things a slower, less efficient way.
-# (we could optimize this, if performance becomes a problem)
-#
-if sys.platform == 'win32':
-    def sock_recvall(s, data_len):
-        buf = bytearray()
-        while data_len > 0:
-            new = s.recv(data_len)
-            data_len -= len(new)
-            buf.extend(new)
-        return bytes(buf)
-else:
-    def sock_recvall(s, data_len):
-        return s.recv(data_len, socket.MSG_WAITALL)
+from multiprocessing import Value, Event
 
 class X6Channel(ReceiverChannel):
     """Channel for an X6"""
@@ -105,12 +90,24 @@ class X6(Instrument):
         self.name          = name
 
         self.last_timestamp = Value('d', datetime.datetime.now().timestamp())
+        self.total_received = Value('d', 0)
+        self.expected_points = Value('d', 0) # zero when not known, as for the hardware
+
+        # Set by the receivers whenever data arrive, so that waiting for data doesn't take polling
+        self.data_received  = Event()
+        # Set by the receivers once the expected number of points has arrived
+        self.acquisition_complete = Event()
+        # How often (s) progress is reported while waiting for data
+        self.progress_interval = 0.1
 
         self.gen_fake_data        = gen_fake_data
         self.increment_ideal_data = False
         self.ideal_counter        = 0
         self.ideal_data           = None
 
+        # Settings of a SyntheticX6 to stream data from instead of the hardware, if any
+        self.synthetic            = None
+
         self.timeout = 10.0
 
     def __str__(self):
@@ -120,7 +117,10 @@ class X6(Instrument):
         self.disconnect()
 
     def connect(self, resource_name=None):
-        if config.auspex_dummy_mode or self.gen_fake_data:
+        if self.synthetic is not None:
+            self.fake_x6 = True
+            self._lib = SyntheticX6(**self.synthetic)
+        elif config.auspex_dummy_mode or self.gen_fake_data:
             self.fake_x6 = True
             self._lib = MagicMock()
         else:
@@ -136,7 +136,6 @@ class X6(Instrument):
             self.resource_name = resource_name
 
         # pass thru functions
-        self.acquire    = self._lib.acquire
         self.stop       = self._lib.stop
         # self.disconnect = self._lib.disconnect
 
@@ -200,6 +199,18 @@ class X6(Instrument):
         else:
             logger.error("Unrecognized stream type %s" % channel.stream_type)
 
+    def acquire(self):
+        with self.total_received.get_lock():
+            self.total_received.value = 0
+            # Only a synthetic source is sure to send the number of points we'd expect
+            if self.synthetic is not None:
+                points = sum(self.record_points(chan) for chan in self._chan_to_rsocket)
+                self.expected_points.value = points*self._lib.nbr_segments*self._lib.nbr_waveforms*self._lib.nbr_round_robins
+            else:
+                self.expected_points.value = 0
+            self.acquisition_complete.clear()
+        self._lib.acquire()
+
     def data_available(self):
         return self._lib.get_data_available()
 
@@ -233,6 +244,15 @@ class X6(Instrument):
         # todo: other checking here
         self._channels.append(channel)
 
+    def record_points(self, channel):
+        """Number of points in each record of the channel's stream."""
+        if channel.stream_type == "integrated":
+            return 1
+        elif channel.stream_type == "demodulated":
+            return int(self._lib.record_length/32)
+        else: #Raw
+            return int(self._lib.record_length/4)
+
     def spew_fake_data(self, counter, ideal_data, random_mag=0.1, random_seed=12345):
         """
         Generate fake data on the stream. For unittest usage.
@@ -246,12 +266,7 @@ class X6(Instrument):
         # import ipdb; ipdb.set_trace();
         segs = self._lib.nbr_segments
         for chan, wsock in self._chan_to_wsocket.items():
-            if chan.stream_type == "integrated":
-                length = 1
-            elif chan.stream_type == "demodulated":
-                length = int(self._lib.record_length/32)
-            else: #Raw
-                length = int(self._lib.record_length/4)
+            length = self.record_points(chan)
             buff = np.zeros((segs, length), dtype=chan.dtype)
             # for chan, wsock in self._chan_to_wsocket.items():
             for i in range(segs):
@@ -280,6 +295,7 @@ class X6(Instrument):
         try:
             sock = self._chan_to_rsocket[channel]
             sock.settimeout(2)
+            receiver = SocketReceiver(sock, oc, channel.dtype)
             self.last_timestamp.value = datetime.datetime.now().timestamp()
             total = 0
             ready.value += 1
@@ -287,43 +303,45 @@ class X6(Instrument):
             logger.debug(f"{self} receiver launched with pid {os.getpid()}. ppid {os.getppid()}")
             while not exit.is_set():
                 # push data from a socket into an OutputConnector (oc)
-                # wire format is just: [size, buffer...]
-                # TODO receive 4 or 8 bytes depending on sizeof(size_t)
-                run.wait() # Block until we are running again
+                if not run.wait(0.1):
+                    continue # Block until we are running again
                 try:
-                    msg = sock.recv(8)
+                    num_points = receiver.receive()
+                    total += num_points
                     self.last_timestamp.value = datetime.datetime.now().timestamp()
-                except:
+                    self.count_received(num_points)
+                except socket.timeout:
                     continue
-
-                # reinterpret as int (size_t)
-                msg_size = struct.unpack('n', msg)[0]
-                buf = sock_recvall(sock, msg_size)
-                if len(buf) != msg_size:
-                    logger.error("Channel %s socket msg shorter than expected" % channel.channel)
-                    logger.error("Expected %s bytes, received %s bytes" % (msg_size, len(buf)))
+                except ConnectionError as e:
+                    logger.error(f"Channel {channel.channel}: {e}")
+                    return
+                except Exception as e:
+                    # The stream gave up waiting for the downstream filters to make room
+                    logger.error(f"Channel {channel.channel} stopped receiving: {e}")
                     return
-                data = np.frombuffer(buf, dtype=channel.dtype)
-                # logger.info(f"X6 {msg_size} got {len(data)}")
-                total += len(data)
-                oc.push(data)
 
             # logger.info('RECEIVED %d %d', total, oc.points_taken.value)
             # TODO: this is suspeicious
+            # Drain whatever notifications are left until the queues go quiet, so that this
+            # process isn't kept from exiting by unread messages
             for stream in oc.output_streams:
-                abc = 0
                 while True:
                     try:
-                        dat = stream.queue.get(False)
-                        abc += 1
-                        time.sleep(0.005)
+                        stream.queue.get(timeout=0.005)
                     except queue.Empty as e:
-                        # logger.info(f"All my data {oc} has been consumed {abc}")
                         break
             # logger.info("X6 receive data exiting")
         except Exception as e:
             logger.warning(f"{self} receiver raised exception {e}. Bailing.")
 
+    def count_received(self, num_points):
+        """Add to the points received, and signal completion once all of those expected are in."""
+        with self.total_received.get_lock():
+            self.total_received.value += num_points
+            if 0 < self.expected_points.value <= self.total_received.value:
+                self.acquisition_complete.set()
+        self.data_received.set()
+
     def get_buffer_for_channel(self, channel):
         return self._lib.transfer_stream(*channel.channel)
 
@@ -341,7 +359,7 @@ class X6(Instrument):
             total_spewed = 0
 
             counter = {chan: 0 for chan in self._chan_to_wsocket.keys()}
-            initial_points = {oc: oc.points_taken.value for oc in ocs}
+            initial_received = self.total_received.value
             for j in range(self._lib.nbr_round_robins):
                 if self.ideal_data is not None:
                     #add ideal data for testing
@@ -362,17 +380,17 @@ class X6(Instrument):
             # logger.info("Counter: %s", str(counter))
             # logger.info('TOTAL fake data generated %d', total_spewed)
             if ocs:
-                while True:
-                    total_taken = 0
-                    for oc in ocs:
-                        total_taken += oc.points_taken.value - initial_points[oc]
-                        if progressbars:
-                                progress_updaters[oc](ocs[0].points_taken.value)
-                        # logger.info('TOTAL fake data received %d', oc.points_taken.value - initial_points[oc])
-                    if total_taken == total_spewed:
-                        break
-                    # logger.info('WAITING for acquisition to finish %d < %d', total_taken, total_spewed)
-                    time.sleep(0.025)
+                # Now that we know how much is coming, the receivers can tell when it's all in
+                with self.total_received.get_lock():
+                    self.expected_points.value = initial_received + total_spewed
+                    if self.total_received.value >= self.expected_points.value:
+                        self.acquisition_complete.set()
+                    else:
+                        self.acquisition_complete.clear()
+                while not self.acquisition_complete.wait(self.progress_interval):
+                    if progressbars:
+                        for oc in ocs:
+                            progress_updaters[oc](ocs[0].points_taken.value)
                 for oc in ocs:
                     if progressbars:
                         try:
@@ -382,7 +400,12 @@ class X6(Instrument):
                             pass
 
         else:
-            while not self.done():
+            while True:
+                # Clear before checking, so that data arriving in between still wake us up
+                self.data_received.clear()
+                # The library has the last word on completion, unless the source is synthetic
+                if self.done() or (self.synthetic is not None and self.acquisition_complete.is_set()):
+                    break
                 if not dig_run.is_set():
                     self.last_timestamp.value = datetime.datetime.now().timestamp()
                 if (datetime.datetime.now().timestamp() - self.last_timestamp.value) > timeout:
@@ -391,7 +414,8 @@ class X6(Instrument):
                 if progressbars:
                     for oc in ocs:
                         progress_updaters[oc](ocs[0].points_taken.value)
-                time.sleep(0.1)
+                # The library is polled, but data arriving on the sockets cut the wait short
+                self.data_received.wait(self.progress_interval)
             for oc in ocs:
                 if progressbars:
                     try:
@@ -15,32 +15,15 @@ import datetime, time
 import sys
 import numpy as np
 
-from multiprocessing import Value
+from multiprocessing import Value, Event
 
-from .instrument import Instrument, ReceiverChannel
+from .instrument import Instrument, ReceiverChannel, SocketReceiver
+from .synthetic import SyntheticATS9870
 from auspex.log import logger
 import auspex.config as config
 
 from unittest.mock import MagicMock
 
-# win32 doesn't support MSG_WAITALL, so on windows we
-# need to do things a slower, less efficient way.
-# (we could optimize this, if performance becomes a problem)
-#
-# TODO: this code is repeated in the X6 driver.
-#
-if sys.platform == 'win32':
-    def sock_recvall(s, data_len):
-        buf = bytearray()
-        while data_len > 0:
-            new = s.recv(data_len)
-            data_len -= len(new)
-            buf.extend(new)
-        return bytes(buf)
-else:
-    def sock_recvall(s, data_len):
-        return s.recv(data_len, socket.MSG_WAITALL)
-
 class AlazarChannel(ReceiverChannel):
     phys_channel = None
 
@@ -77,14 +60,25 @@ class AlazarATS9870(Instrument):
         self.fetch_count    = Value('d', 0)
         self.total_received = Value('d', 0)
 
+        # Set by the receivers whenever data arrive, so that waiting for data doesn't take polling
+        self.data_received  = Event()
+        # How often (s) progress is reported while waiting for data
+        self.progress_interval = 0.1
+
         self.gen_fake_data        = gen_fake_data
         self.increment_ideal_data = False
         self.ideal_counter        = 0
         self.ideal_data           = None
         np.random.seed(12345)
 
+        # Settings of a SyntheticATS9870 to stream data from instead of the hardware, if any
+        self.synthetic            = None
+
     def connect(self, resource_name=None):
-        if config.auspex_dummy_mode or self.gen_fake_data:
+        if self.synthetic is not None:
+            self.fake_alazar = True
+            self._lib = SyntheticATS9870(**self.synthetic)
+        elif config.auspex_dummy_mode or self.gen_fake_data:
             self.fake_alazar = True
             self._lib = MagicMock()
         else:
@@ -105,6 +99,7 @@ class AlazarATS9870(Instrument):
     def acquire(self):
         self.fetch_count.value = 0
         self.total_received.value = 0
+        self.data_received.clear()
         self._lib.acquire()
 
     def stop(self):
@@ -168,36 +163,36 @@ class AlazarATS9870(Instrument):
     def receive_data(self, channel, oc, exit, ready, run):
         sock = self._chan_to_rsocket[channel]
         sock.settimeout(2)
+        receiver = SocketReceiver(sock, oc, np.float32)
         self.last_timestamp.value = datetime.datetime.now().timestamp()
         last_print = datetime.datetime.now().timestamp()
         ready.value += 1
 
         while not exit.is_set():
             # push data from a socket into an OutputConnector (oc)
-            # wire format is just: [size, buffer...]
-            # TODO receive 4 or 8 bytes depending on sizeof(size_t)
-            if not run.is_set():
+            if not run.wait(0.1):
                 continue # Block until we are running again
             #logger.info(f'Run set when recv={self.total_received.value}, exp={self.number_segments*self.record_length*self.number_averages*len(self.channels)}')
             try:
-                msg = sock.recv(8)
+                num_points = receiver.receive()
                 self.last_timestamp.value = datetime.datetime.now().timestamp()
-            except:
+            except socket.timeout:
                 logger.info("Didn't find any data on socket within 2 seconds (this is normal during experiment shutdown).")
                 continue
-            msg_size = struct.unpack('n', msg)[0]
-            buf = sock_recvall(sock, msg_size)
-            while len(buf) < msg_size:
-                # time.sleep(0.01)
-                buf2 = sock_recvall(sock, msg_size-len(buf))
-                buf = buf+buf2
-            data = np.frombuffer(buf, dtype=np.float32)
-            self.total_received.value += len(data)
+            except ConnectionError as e:
+                logger.error(f"Channel {channel.phys_channel}: {e}")
+                return
+            except Exception as e:
+                # The stream gave up waiting for the downstream filters to make room
+                logger.error(f"Channel {channel.phys_channel} stopped receiving: {e}")
+                return
+            with self.total_received.get_lock():
+                self.total_received.value += num_points
             if datetime.datetime.now().timestamp() - last_print > 0.25:
                 last_print = datetime.datetime.now().timestamp()
                 # logger.info(f"Alz: {self.total_received.value}")
-            oc.push(data)
             self.fetch_count.value += 1
+            self.data_received.set()
 
         #logger.info(f'Exit set when recv={self.total_received.value}, exp={self.number_segments*self.record_length*self.number_averages*len(self.channels)}')
 
@@ -242,7 +237,11 @@ class AlazarATS9870(Instrument):
 
             self.ideal_counter += 1
 
-        while not self.done():
+        while True:
+            # Clear before checking, so that data arriving in between still wake us up
+            self.data_received.clear()
+            if self.done():
+                break
             if not dig_run.is_set():
                 self.last_timestamp.value = datetime.datetime.now().timestamp()
             if (datetime.datetime.now().timestamp() - self.last_timestamp.value) > timeout:
@@ -252,7 +251,7 @@ class AlazarATS9870(Instrument):
             if progressbars:
                 for oc in ocs:
                     progress_updaters[oc](oc.points_taken.value)
-            #time.sleep(0.2) Does this need to be here at all?
+            self.data_received.wait(self.progress_interval)
         if progressbars:
             try:
                 progressbars[oc].next()
@@ -17,11 +17,12 @@ import numpy as np
 import socket
 from unittest.mock import Mock
 import collections
-from struct import pack, iter_unpack
 import serial
 
 U32 = 0xFFFFFFFF #mask for 32-bit unsigned int
 U16 = 0xFFFF
+WORD = np.dtype('>u4') # Words go over the wire big-endian
+MAX_IOV = 1024 # Most buffers sendmsg will take at once
 
 def check_bits(value, shift, mask=0b1):
     """Helper function to get a bit-slice of a 32-bit value.
@@ -139,6 +140,8 @@ class AMC599(object):
     """
 
     PORT = 0xbb4e # TCPIP port (BBN!)
+    max_datagram_words = 0xfffc #max writeable block length (TODO: check if still true)
+    ack_window = 16 # Datagrams written before waiting for their echoes
     ser = None
     ref = ''
 
@@ -170,79 +173,113 @@ class AMC599(object):
             self.ser.close()
 
     def send_bytes(self, data):
-        if isinstance(data, collections.Iterable):
-            return self.socket.sendall(b''.join([pack("!I", _) for _ in data]))
-        else:
-            return self.socket.sendall(pack("!I", data))
+        return self.send_buffers([np.asarray(data, dtype=WORD).reshape(-1)])
+
+    def send_buffers(self, buffers):
+        """Send a list of buffers with as few system calls as possible, without joining them."""
+        views = [memoryview(b).cast('B') for b in buffers]
+        if not hasattr(self.socket, "sendmsg"):
+            # win32 sockets have no sendmsg
+            for view in views:
+                self.socket.sendall(view)
+            return
+        while views:
+            sent = self.socket.sendmsg(views[:MAX_IOV])
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if sent:
+                views[0] = views[0][sent:]
+
+    def recv_into(self, buf):
+        """Fill a writeable buffer from the socket."""
+        view, received = memoryview(buf).cast('B'), 0
+        while received < len(view):
+            n = self.socket.recv_into(view[received:])
+            if n == 0:
+                raise IOError("AMC599 closed the connection.")
+            received += n
+        return buf
+
+    def recv_words(self, num_words):
+        """Receive a number of 32-bit words as an array of native unsigned integers."""
+        return self.recv_into(np.empty(num_words, dtype=WORD)).astype(np.uint32)
 
     def recv_bytes(self, size):
-        resp = self.socket.recv(size)
-        while True:
-            if len(resp) >= size:
-                break
-            resp += self.socket.recv(8)
-        data = [x[0] for x in iter_unpack("!I", resp)]
+        data = self.recv_words(size // 4).tolist()
         return data if len(data)>1 else data[0]
 
-    def write_memory(self, addr, data):
-        if isinstance(data, int):
-            data = [data]
-        elif isinstance(data, list):
-            if not all([isinstance(v, int) for v in data]):
-                raise ValueError("Data must be a list of integers.")
-        else:
+    @staticmethod
+    def _as_words(data):
+        """Check that data is an integer, or a sequence or array of integers, that fits in 32 bits
+        and return it as a flat array."""
+        words = np.asarray(data)
+        if words.dtype.kind not in 'biu':
             raise ValueError("Data must be an integer or a list of integers.")
+        words = words.reshape(-1)
+        if words.size > 0 and (words.min() < 0 or words.max() > U32):
+            raise ValueError("Data must fit in unsigned 32-bit words.")
+        return words
+
+    def write_memory(self, addr, data):
+        words = self._as_words(data)
 
         if self.debug:
-            for off, d in enumerate(data):
+            for off, d in enumerate(words.tolist()):
                 self.debug_memory[addr + off*0x4] = d
             return
 
         self._check_connected()
-        max_ct = 0xfffc #max writeable block length (TODO: check if still true)
+        words = words.astype(WORD)
         cmd = 0x80000000 #write to RAM command
-        datagrams_written = 0
-        init_addr = addr
-        idx = 0
-
-        while (len(data) - idx > 0):
-            ct_left = len(data) - idx
-            ct = ct_left if (ct_left < max_ct) else max_ct
-            datagram = [cmd + ct, addr]
-            datagram.extend(data[idx:idx+ct])
-            self.send_bytes(datagram)
-            datagrams_written += 1
-            idx += ct
-            addr += ct*4
-        #read back data and check amount of bytes written makes sense
-        #the ethernet core echoes back what we wrote
-        resp = self.recv_bytes(2 * 4 * datagrams_written)
-        addr = init_addr
-        for ct in range(datagrams_written):
-            if ct+1 == datagrams_written:
-                words_written = len(data) - ((datagrams_written-1) * max_ct)
-            else:
-                words_written = max_ct
-            # logger.debug("Wrote {} words in {} datagrams: {}", words_written,
-            #                     datagrams_written,
-            #                     [hex(x) for x in resp])
-            assert (resp[2*ct] == 0x80800000 + words_written)
-            assert (resp[2*ct+1] == addr)
-            addr += 4 * words_written
+
+        # The ethernet core echoes back the header of every datagram we write. Rather than waiting
+        # for each echo in turn, keep up to ack_window datagrams in flight and check the echoes as
+        # they come back.
+        pending = collections.deque()
+        echo = np.empty(2, dtype=WORD)
+        for idx in range(0, len(words), self.max_datagram_words):
+            chunk = words[idx:idx+self.max_datagram_words]
+            header = np.array([cmd + len(chunk), addr], dtype=WORD)
+            self.send_buffers([header, chunk])
+            pending.append((0x80800000 + len(chunk), addr))
+            addr += 4*len(chunk)
+            while len(pending) > (self.ack_window if idx + len(chunk) < len(words) else 0):
+                expected = pending.popleft()
+                self.recv_into(echo)
+                if tuple(int(e) for e in echo) != expected:
+                    raise IOError("Unexpected echo {} from AMC599 after writing {} words to {}.".format(
+                        [hex(e) for e in echo], expected[0] & 0xffff, hex(expected[1])))
 
     def read_memory(self, addr, num_words):
+        data = self.read_words(addr, num_words).tolist()
+        return data[0] if num_words == 1 else data
+
+    def read_words(self, addr, num_words):
+        """Read a number of words from memory as an array of unsigned 32-bit integers."""
 
         if self.debug:
             response = []
             for x in range(num_words):
                 response.append(self.debug_memory.get(addr+0x4*x, 0x0))
-            return response[0] if num_words == 1 else response
+            return np.array(response, dtype=np.uint32)
 
         self._check_connected()
-        datagram = [0x10000000 + num_words, addr]
-        self.send_bytes(datagram)
-        resp_header = self.recv_bytes(2 * 4) #4 bytes per word...
-        return self.recv_bytes(4 * num_words)
+        # Long reads are split into datagrams like writes, with up to ack_window requests in flight
+        data = np.empty(num_words, dtype=WORD)
+        resp_header = np.empty(2, dtype=WORD)
+        chunks = [(idx, min(self.max_datagram_words, num_words - idx)) for idx in range(0, num_words, self.max_datagram_words)]
+        for ct, (idx, size) in enumerate(chunks):
+            self.send_bytes([0x10000000 + size, addr + 4*idx])
+            if ct >= self.ack_window:
+                self._recv_chunk(data, *chunks[ct - self.ack_window], resp_header)
+        for idx, size in chunks[max(0, len(chunks) - self.ack_window):]:
+            self._recv_chunk(data, idx, size, resp_header)
+        return data.astype(np.uint32)
+
+    def _recv_chunk(self, data, idx, size, resp_header):
+        self.recv_into(resp_header)
+        self.recv_into(data[idx:idx+size])
 
     def serial_read_dac_register(self, dac, addr):
         if dac not in [0, 1]:
@@ -872,19 +909,23 @@ class APS3(Instrument, metaclass=MakeBitFieldParams):
     sequence_filename = ''
 
     def load_sequence(self, sequence):
-        packed_seq = []
-        for instr in sequence:
-            packed_seq.append(instr & U32)
-            packed_seq.append(instr >> 32)
+        # Each 64-bit instruction goes out as its low word followed by its high word
+        packed_seq = np.ascontiguousarray(sequence, dtype='<u8').view('<u4')
 
         sleep(0.01)
         self.write_dram(self.SEQ_OFFSET(), packed_seq)
         logger.debug(f"Wrote {len(packed_seq)} words to sequence memory.")
         sleep(0.01)
 
+    @staticmethod
+    def _pack_waveform(wf):
+        """Pack pairs of 16-bit samples into 32-bit words, the first sample in the low half."""
+        wf = np.ascontiguousarray(wf, dtype='<u2')
+        return wf[:2*(len(wf) // 2)].view('<u4')
+
     def load_waveforms(self, wfA, wfB):
-        wfA_32 = [((wfA[2*i+1] << 16) | wfA[2*i]) for i in range(len(wfA) // 2)]
-        wfB_32 = [((wfB[2*i+1] << 16) | wfB[2*i]) for i in range(len(wfB) // 2)]
+        wfA_32 = self._pack_waveform(wfA)
+        wfB_32 = self._pack_waveform(wfB)
 
         if len(wfA_32) > 0 and len(wfB_32) > 0:
             self.write_dram(self.WFA_OFFSET(), wfA_32) # I
@@ -893,19 +934,12 @@ class APS3(Instrument, metaclass=MakeBitFieldParams):
             logger.warning('Discarding zero-length waveform.')
 
     def read_waveforms(self, wf_len):
-        wfA_32 = self.read_dram(self.WFA_OFFSET(), wf_len // 2)
-        wfB_32 = self.read_dram(self.WFB_OFFSET(), wf_len // 2)
-
-        wfA = []
-        wfB = []
-
-        for i in range(wf_len // 2):
-            wfA.append(wfA_32[i] & 0xFFFF)
-            wfA.append((wfA_32[i] >> 16) & 0xFFFF)
-            wfB.append(wfB_32[i] & 0xFFFF)
-            wfB.append((wfB_32[i] >> 16) & 0xFFFF)
+        board  = APS3CommunicationManager.board(self.address)
+        wfA_32 = board.read_words(DRAM_AXI_BASE + self.WFA_OFFSET(), wf_len // 2).astype('<u4')
+        wfB_32 = board.read_words(DRAM_AXI_BASE + self.WFB_OFFSET(), wf_len // 2).astype('<u4')
 
-        return wfA, wfB
+        # Each word holds two samples, the first in the low half
+        return wfA_32.view('<u2').tolist(), wfB_32.view('<u2').tolist()
 
     def load_sequence_file(self, seq_file):
         self.sequence_filename = seq_file
@@ -922,12 +956,12 @@ class APS3(Instrument, metaclass=MakeBitFieldParams):
                 raise ValueError('Unexpected number of channels, sequence file reports ' + str(num_channels) + ' channels.')
 
             instructions_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
-            instructions = [int(x) for x in np.frombuffer(file.read(instructions_size*8), dtype=np.uint64)]
+            instructions = np.frombuffer(file.read(instructions_size*8), dtype=np.uint64)
 
             data = []
             for chan in range(num_channels):
                 data_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
-                data.append([int(x) for x in np.frombuffer(file.read(data_size*2), dtype=np.uint16)])
+                data.append(np.frombuffer(file.read(data_size*2), dtype=np.uint16))
 
             self.load_waveforms(data[0], data[1])
             self.load_sequence(instructions)
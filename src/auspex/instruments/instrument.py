@@ -2,8 +2,10 @@ __all__ = ['Instrument']
 
 import numpy as np
 import os
+import sys
 import time
 import socket
+import struct
 from unittest.mock import MagicMock
 
 from auspex.log import logger
@@ -36,7 +38,7 @@ class Command(object):
     def parse(self):
         for a in ['aliases', 'set_delay', 'get_delay',
                   'value_map', 'value_range',
-                  'allowed_values']:
+                  'allowed_values', 'volatile']:
             if a in self.kwargs:
                 setattr(self, a, self.kwargs.pop(a))
             else:
@@ -162,6 +164,86 @@ class SCPIRampCommand(SCPICommand, RampCommand): pass
 
 class ReceiverChannel(object): pass
 
+def sock_recv_into(sock, buf):
+    """Fill the writable buffer from the socket, returning the number of bytes received, which
+    is only short of the buffer's size if the socket was closed."""
+    view = memoryview(buf).cast('B')
+    received = 0
+    while received < len(view):
+        # win32 doesn't support MSG_WAITALL
+        flags = socket.MSG_WAITALL if sys.platform != 'win32' else 0
+        new = sock.recv_into(view[received:], len(view) - received, flags)
+        if new == 0:
+            break
+        received += new
+    return received
+
+class SocketReceiver(object):
+    """Reads the messages that digitizer drivers write to a socket, in the wire format
+    [size (size_t), data...], and pushes their data to an OutputConnector without allocating
+    anything per message. When the connector feeds a single stream of the same dtype, the data
+    are received straight into that stream's shared memory; otherwise they are received into a
+    reusable buffer and pushed from there. Either way nothing is read from the socket while the
+    downstream filters have no room for it, so a sender that gets ahead is held up by the socket
+    rather than overflowing memory."""
+
+    def __init__(self, sock, oc, dtype):
+        self.sock   = sock
+        self.oc     = oc
+        self.dtype  = np.dtype(dtype)
+        self.header = bytearray(struct.calcsize('n'))
+        self.buffer = np.empty(0, dtype=self.dtype)
+        streams     = oc.output_streams
+        if len(streams) == 1 and not streams[0].fused and streams[0].dtype == self.dtype:
+            self.stream = streams[0]
+        else:
+            self.stream = None
+
+    def receive(self):
+        """Receive one message and return the number of points it held. Raises socket.timeout
+        if no message starts arriving within the socket's timeout. Once part of a message has
+        been read the rest must follow: a timeout or closed socket midway through would leave
+        the framing broken, so either raises ConnectionError and the receiver should stop."""
+        self._recv_into(self.header, started=False)
+        msg_size   = struct.unpack('n', self.header)[0]
+        num_points = msg_size // self.dtype.itemsize
+
+        if self.stream is not None:
+            remaining = num_points
+            while remaining > 0:
+                view = self.stream.reserve(remaining)
+                self._recv_into(view)
+                self.stream.commit(view.size)
+                # Keep the connector's count in step with the stream's as each chunk is published
+                with self.oc.points_taken_lock:
+                    self.oc.points_taken.value += view.size
+                remaining -= view.size
+            return num_points
+
+        if self.buffer.size < num_points:
+            self.buffer = np.empty(num_points, dtype=self.dtype)
+        data = self.buffer[:num_points]
+        self._recv_into(data)
+        self.oc.push(data)
+        return num_points
+
+    def _recv_into(self, buf, started=True):
+        """Fill the buffer from the socket. A timeout is only passed on as such if nothing of the
+        message had been read yet, i.e. if `started` is False and the buffer is still empty."""
+        view     = memoryview(buf).cast('B')
+        received = 0
+        while received < len(view):
+            try:
+                new = self.sock.recv_into(view[received:])
+            except socket.timeout:
+                if started or received > 0:
+                    raise ConnectionError(f"Digitizer socket timed out {received} of {len(view)} bytes into a message.")
+                raise
+            if new == 0:
+                raise ConnectionError("Digitizer socket closed." if not (started or received) else
+                                      f"Digitizer socket closed {received} of {len(view)} bytes into a message.")
+            received += new
+
 class MetaInstrument(type):
     def __init__(self, name, bases, dct):
         type.__init__(self, name, bases, dct)
@@ -180,7 +262,7 @@ class MetaInstrument(type):
                         if nv.aliases is not None:
                             for a in nv.aliases:
                                 logger.debug("------> Adding alias '%s'" % a)
-                                add_command_SCPI(self, a, v)
+                                add_command_SCPI(self, a, v, cache_name=k)
                     elif instr_type == "CLib":
                         nv = add_command_CLib(self, k, v)
                         if nv.aliases is not None:
@@ -225,6 +307,19 @@ class Instrument(metaclass=MetaInstrument):
 class CLibInstrument(Instrument): pass
 
 class SCPIInstrument(Instrument):
+    """An instrument controlled by SCPI commands. Optionally, the settings written to and read
+    from the instrument are cached, so that reading them back, or writing the same value again,
+    costs nothing. Only commands that can be both set and got are cached, and only while they
+    are not declared volatile (with the `volatile` keyword of the command, or `mark_volatile`)
+    since the instrument may change them by itself. Methods that change the settings of the
+    instrument by other means should `invalidate` them.
+
+    >>> instr.enable_cache()
+    >>> instr.frequency = 5e9 # Written to the instrument
+    >>> instr.frequency       # Served from the cache
+    5e9
+    >>> instr.frequency = 5e9 # Not written again
+    """
 
     __isfrozen = False
 
@@ -235,8 +330,49 @@ class SCPIInstrument(Instrument):
         if not hasattr(self, "instrument_type"):
             self.instrument_type = None # This can be AWG, Digitizer, etc.
         self.interface       = None
+        self.cache_enabled   = False
+        self._cache          = {}
+        self._volatile       = set()
         self._freeze()
 
+    def enable_cache(self, enabled=True):
+        """Turn the cache of settings on or off, starting from an empty cache either way."""
+        self.cache_enabled = enabled
+        self._cache.clear()
+
+    def invalidate(self, *names):
+        """Forget the cached values of the given commands, or of all of them if none are given,
+        so that they are read from the instrument again."""
+        if not names:
+            self._cache.clear()
+        for key in [k for k in self._cache if k[0] in names]:
+            del self._cache[key]
+
+    def mark_volatile(self, *names):
+        """Never cache the given commands, since the instrument may change them by itself."""
+        self._volatile.update(names)
+        self.invalidate(*names)
+
+    def resync(self):
+        """Read every cached setting back from the instrument, e.g. after it has been changed
+        from the front panel."""
+        for name, *args in list(self._cache):
+            del self._cache[(name, *args)]
+            getattr(self, "get_" + name)(**dict(args))
+
+    def _cache_key(self, name, cmd, kwargs):
+        """The key under which the value of a command is cached, or None if it is not cached."""
+        if not self.cache_enabled or cmd.volatile or name in self._volatile:
+            return None
+        if cmd.get_string is None or cmd.set_string is None:
+            return None
+        key = (name, *sorted(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def connect(self, resource_name=None, interface_type=None):
         """Either connect to the resource name specified during initialization, or specify
         a new resource name here."""
@@ -276,6 +412,8 @@ class SCPIInstrument(Instrument):
         except:
             logger.error("Could not initialize interface for %s.", self.full_resource_name)
             self.interface = MagicMock()
+        # Whatever happened to the instrument in the meantime, its settings must be read afresh
+        self._cache.clear()
         self._freeze()
 
     def disconnect(self):
@@ -285,7 +423,8 @@ class SCPIInstrument(Instrument):
     # This solution from http://stackoverflow.com/questions/3603502/prevent-creating-new-attributes-outside-init
 
     def __setattr__(self, key, value):
-        if self.__isfrozen and not hasattr(self, key):
+        # Look the attribute up on the class, since hasattr would query the instrument for properties
+        if self.__isfrozen and key not in self.__dict__ and not hasattr(type(self), key):
             raise TypeError( "{} has a frozen class. Cannot access attribute {}".format(self, key) )
         object.__setattr__(self, key, value)
 
@@ -305,18 +444,26 @@ class SCPIInstrument(Instrument):
         return "{} @ {}".format(self.name, self.resource_name)
 
 
-def add_command_SCPI(instr, name, cmd):
+def add_command_SCPI(instr, name, cmd, cache_name=None):
     """Helper function for parsing Instrument attributes and turning them into
-    setters and getters for SCPI style commands."""
+    setters and getters for SCPI style commands. Aliases share the cache_name of
+    the command they stand for."""
     # Replace with the relevant SCPI command variant
     new_cmd = globals()['SCPI'+cmd.__class__.__name__](*cmd.args, **cmd.kwargs)
     new_cmd.parse()
+    cache_name = cache_name or name
 
     def fget(self, **kwargs):
+        key = self._cache_key(cache_name, new_cmd, kwargs)
+        if key in self._cache:
+            return self._cache[key]
         val = self.interface.query( new_cmd.get_string.format( **kwargs ) )
         if new_cmd.get_delay is not None:
             time.sleep(new_cmd.get_delay)
-        return new_cmd.convert_get(val)
+        val = new_cmd.convert_get(val)
+        if key is not None:
+            self._cache[key] = val
+        return val
 
     def fset(self, val, **kwargs):
         if new_cmd.value_range is not None:
@@ -329,6 +476,13 @@ def add_command_SCPI(instr, name, cmd):
                 err_msg = "The value {} is not in the allowable set of values specified for instrument '{}': {}".format(val, self.name, new_cmd.allowed_values)
                 raise ValueError(err_msg)
 
+        key = self._cache_key(cache_name, new_cmd, kwargs)
+        if key in self._cache and self._cache[key] == val:
+            logger.debug("Instrument %s already has %s set to %s.", self.name, cache_name, val)
+            return
+        # Should the write fail part way, the instrument's setting is unknown
+        self._cache.pop(key, None)
+
         if isinstance(cmd, RampCommand):
             if 'increment' in kwargs:
                 new_cmd.increment = kwargs['increment']
@@ -350,6 +504,8 @@ def add_command_SCPI(instr, name, cmd):
             self.interface.write(new_cmd.set_string.format(set_value, **kwargs))
             if new_cmd.set_delay is not None:
                 time.sleep(new_cmd.set_delay)
+        if key is not None:
+            self._cache[key] = val
 
     # Add getter and setter methods for passing around
     if new_cmd.additional_args is None:
@@ -6,21 +6,200 @@
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 
-__all__ = ['PrologixSocketResource']
+__all__ = ['PrologixSocketResource', 'PrologixAdapter']
 
 import os
+import re
 import numpy as np
 import socket
 import functools
+import threading
 from auspex.log import logger
-from pyvisa.util import _converters, from_ascii_block, to_ascii_block, to_ieee_block, from_binary_block
+from pyvisa.util import _converters, from_ascii_block, to_ascii_block, to_ieee_block, from_ieee_block
 
 class PrologixError(Exception):
     """Error interacting with the Prologix GPIB-ETHERNET controller."""
 
+class PrologixAdapter(object):
+    """The connection to a Prologix GPIB-ETHERNET controller, shared by all of the instruments
+    on its GPIB bus. Access is serialized across instruments and threads with `lock`, which
+    must be held for any exchange with an instrument, and each instrument sets its own timeout
+    for its exchanges with `settimeout`. The controller is only told to address
+    another instrument when that changes, and with read-after-write disabled, writes go out
+    without waiting on anything. Responses are read up to their terminator, however long.
+
+    Adapters are shared by IP address: use `PrologixAdapter.get` and `release`.
+
+    Attributes:
+        port: TCP port of the controller.
+        timeout: Timeout duration for TCP comms, as last set. Default 5s.
+        bufsize: Maximum amount of data to be received in one call, in bytes.
+    """
+
+    port = 1234 #Prologix communicates on port 1234
+
+    _adapters = {}
+    _adapters_lock = threading.Lock()
+
+    def __init__(self, ipaddr, timeout=5):
+        super(PrologixAdapter, self).__init__()
+        self.ipaddr   = ipaddr
+        self.timeout  = timeout
+        self.bufsize  = 4096
+        self.lock     = threading.RLock()
+        self.sock     = None
+        self.gpib     = None # Address the controller is currently talking to
+        self.users    = 0
+        self._buffer  = bytearray()
+
+    @classmethod
+    def get(cls, ipaddr, timeout=5):
+        """Return the adapter at the given IP address, connecting to it if need be."""
+        with cls._adapters_lock:
+            adapter = cls._adapters.get(ipaddr)
+            if adapter is None:
+                adapter = cls(ipaddr, timeout)
+                adapter.open()
+                cls._adapters[ipaddr] = adapter
+            adapter.users += 1
+            return adapter
+
+    def release(self):
+        """Give up a reference obtained from `get`, closing the connection after the last one."""
+        with self._adapters_lock:
+            self.users -= 1
+            if self.users <= 0:
+                self._adapters.pop(self.ipaddr, None)
+                self.close()
+
+    def open(self):
+        try:
+            self.sock = socket.create_connection((self.ipaddr, self.port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error as err:
+            logger.error("Cannot open socket to Prologix at {0}: {1}".format(self.ipaddr, err))
+            raise PrologixError(self.ipaddr) from err
+        self.sock.sendall(b"++ver\n")
+        whoami = self.read_until(b"\n").decode()
+        if "Prologix" not in whoami:
+            logger.error("The device at {0} does not appear to be a Prologix; got {1}.".format(self.ipaddr, whoami))
+            raise PrologixError(whoami)
+        # Controller mode, and only read from instruments when asked to
+        self.sock.sendall(b"++mode 1\n++auto 0\n")
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+        self.gpib = None
+
+    def settimeout(self, timeout):
+        if timeout == self.timeout:
+            return
+        self.timeout = timeout
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+
+    def send(self, gpib, data):
+        """Send data to the instrument at the given GPIB address, switching to it first if need
+        be. The caller must hold `lock`."""
+        if gpib != self.gpib:
+            data = ('++addr %d\n' % gpib).encode() + data
+            self.gpib = gpib
+        self.sock.sendall(data)
+
+    def request(self, gpib):
+        """Ask the instrument at the given GPIB address for its response."""
+        self.discard()
+        self.send(gpib, b"++read eoi\n")
+
+    def discard(self):
+        """Drop whatever is left of earlier responses, such as the rest of one that timed out.
+        Nothing else can be waiting, since the controller only sends responses when asked."""
+        self._buffer.clear()
+        self.sock.settimeout(0)
+        try:
+            while self.sock.recv(self.bufsize):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def _fill(self):
+        try:
+            new = self.sock.recv(self.bufsize)
+        except:
+            # Don't hand a partial response to whoever reads next
+            self._buffer.clear()
+            raise
+        if not new:
+            self._buffer.clear()
+            raise PrologixError("Prologix at {0} closed the connection.".format(self.ipaddr))
+        self._buffer.extend(new)
+
+    def read_until(self, terminator):
+        """Read up to and including the terminator."""
+        start = 0
+        while True:
+            idx = self._buffer.find(terminator, start)
+            if idx >= 0:
+                end = idx + len(terminator)
+                data = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                return data
+            start = max(len(self._buffer) - len(terminator) + 1, 0)
+            self._fill()
+
+    def read_exactly(self, count):
+        while len(self._buffer) < count:
+            self._fill()
+        data = bytes(self._buffer[:count])
+        del self._buffer[:count]
+        return data
+
+    def read_block(self):
+        """Read a response holding a definite length IEEE block (#<digits><length><data>),
+        along with its terminator."""
+        header = self.read_until(b"#")
+        digits = self.read_exactly(1)
+        length = self.read_exactly(int(digits))
+        return header + digits + length + self.read_exactly(int(length)) + self.read_until(b"\n")
+
+    def read_available(self, bufsize):
+        """Read whatever has arrived (waiting for something if need be), up to bufsize bytes."""
+        if not self._buffer:
+            self._fill()
+        data = bytes(self._buffer[:bufsize])
+        del self._buffer[:bufsize]
+        return data
+
+class _Exchange(object):
+    """Holds the adapter's lock for an exchange with one instrument, using that instrument's timeout."""
+    def __init__(self, adapter, timeout):
+        self.adapter = adapter
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.adapter.lock.acquire()
+        self.adapter.settimeout(self.timeout)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.adapter.lock.release()
+
+def escape(data):
+    """Escape the characters that the Prologix would otherwise interpret, so that binary data
+    reaches the instrument unchanged."""
+    return re.sub(rb"[\x1b\r\n+]", lambda m: b"\x1b" + m.group(0), data)
+
 class PrologixSocketResource(object):
-    """A resource representing a GPIB instrument controlled through a PrologixError
+    """A resource representing a GPIB instrument controlled through a Prologix
     GPIB-ETHERNET controller. Mimics the functionality of a pyVISA resource object.
+    Instruments on the same controller share its connection (see PrologixAdapter).
 
     See http://prologix.biz/gpib-ethernet-controller.html for more details
     and a utility that will discover all prologix instruments on the network.
@@ -38,7 +217,7 @@ class PrologixSocketResource(object):
             self.ipaddr = ipaddr
         if gpib is not None:
             self.gpib = gpib
-        self.sock = None
+        self.adapter = None
         self._timeout = 5
         self.read_termination = "\r\n"
         self.write_termination = "\r\n"
@@ -51,9 +230,10 @@ class PrologixSocketResource(object):
 
     @timeout.setter
     def timeout(self, value):
-        self._timeout = timeout
-        if self.sock is not None:
-            self.sock.settimeout(self._timeout)
+        self._timeout = value
+
+    def _exchange(self):
+        return _Exchange(self.adapter, self._timeout)
 
     def connect(self, ipaddr=None, gpib=None):
         """Connect to a GPIB device through a Prologix GPIB-ETHERNET controller.
@@ -69,26 +249,11 @@ class PrologixSocketResource(object):
             self.ipaddr = ipaddr
         if gpib is not None:
             self.gpib = gpib
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
-                socket.IPPROTO_TCP)
-            self.sock.settimeout(self._timeout)
-            self.sock.connect((self.ipaddr, 1234)) #Prologix communicates on port 1234
-        except socket.error as err:
-            logger.error("Cannot open socket to Prologix at {0}: {1}".format(self.ipaddr,
-                err.msg))
-            raise PrologixError(self.ipaddr) from err
-        self.sock.send(b"++ver\r\n")
-        whoami = self.sock.recv(128).decode()
-        if "Prologix" not in whoami:
-            logger.error("The device at {0} does not appear to be a Prologix; got {1}.".format(self.ipaddr, whoami))
-            raise PrologixError(whoami)
-        self.sock.send(b"++mode 1\r\n") #set to controller mode
-        self.sock.send(b"++auto 1\r\n") #enable read-after-write
-        self._addr()
-        self.sock.send(b"++clr\r\n")
-        idn = self.query(self.idn_string)
-        if idn is '':
+        self.adapter = PrologixAdapter.get(self.ipaddr, self._timeout)
+        with self._exchange():
+            self.adapter.send(self.gpib, b"++clr\n")
+            idn = self.query(self.idn_string)
+        if idn == '':
             logger.error(("Did not receive response to GPIB command {0} " +
                 "from GPIB device {1} on Prologix at {2}.").format(self.idn_string,
                 self.gpib, self.ipaddr))
@@ -98,14 +263,16 @@ class PrologixSocketResource(object):
                 " Prologix controller at {2}.").format(idn, self.gpib, self.ipaddr))
 
     def close(self):
-        """Close the connection to the Prologix."""
-        if self.sock is not None:
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
-
-    def _addr(self):
-        """Set PROLOGIX to address of instrument we want to control."""
-        self.sock.send(('++addr %d\n' % self.gpib).encode())
+        """Give up this instrument's share of the connection to the Prologix."""
+        if self.adapter is not None:
+            self.adapter.release()
+            self.adapter = None
+
+    def _read(self):
+        """Read a response up to its terminator, with the adapter locked."""
+        self.adapter.request(self.gpib)
+        ans = self.adapter.read_until(self.read_termination[-1].encode()).decode()
+        return ans.rstrip(self.read_termination)
 
     def read(self):
         """Read an ASCII value from the instrument.
@@ -115,9 +282,8 @@ class PrologixSocketResource(object):
         Returns:
             The instrument data with termination character stripped.
         """
-        self._addr()
-        ans = self.sock.recv(self.bufsize).decode()
-        return ans.rstrip(self.read_termination)
+        with self._exchange():
+            return self._read()
 
     def query(self, command):
         """Query instrument with ASCII command then read response.
@@ -127,48 +293,66 @@ class PrologixSocketResource(object):
         Returns:
             The instrument data with termination character stripped.
         """
-        self._addr()
-        self.sock.send((command + self.write_termination).encode())
-        ans = self.sock.recv(self.bufsize).decode()
-        return ans.rstrip(self.read_termination)
+        with self._exchange():
+            self.adapter.send(self.gpib, (command + self.write_termination).encode())
+            return self._read()
 
     def write(self, command):
-        """Write a string message to device in ASCII format.
+        """Write a string message to device in ASCII format. Returns without waiting for
+        the instrument.
 
         Args:
             command: The message to be sent.
         Returns:
             The number of bytes in the message.
         """
-        self._addr()
-        self.sock.send((command + self.write_termination).encode())
+        with self._exchange():
+            self.adapter.send(self.gpib, (command + self.write_termination).encode())
         return len(command)
 
-    def read_raw(self, bufsize=None):
+    def read_raw(self, size=None):
         """Read bytes from instrument.
 
         Args:
-            bufsize: Number of bytes to read from instrument. Defaults to resource
+            size: Number of bytes to read from instrument. Defaults to resource
             bufsize if None.
         Returns:
             Instrument data. Nothing is stripped from response.
         """
-        if bufsize is None:
-            bufsize = self.bufsize
-        self._addr()
-        return self.socket.recv(bufsize)
+        if size is None:
+            size = self.bufsize
+        with self._exchange():
+            self.adapter.request(self.gpib)
+            return self.adapter.read_available(size)
+
+    def read_bytes(self, count, chunk_size=None, break_on_termchar=False):
+        """Read a given number of bytes from the instrument.
+
+        Args:
+            count: Number of bytes to read.
+            chunk_size: Ignored, for compatibility with pyVISA.
+            break_on_termchar: Stop at the read termination, if it comes first.
+        Returns:
+            Instrument data. Nothing is stripped from response.
+        """
+        with self._exchange():
+            self.adapter.request(self.gpib)
+            if break_on_termchar:
+                return self.adapter.read_until(self.read_termination[-1].encode())[:count]
+            return self.adapter.read_exactly(count)
 
     def write_raw(self, command):
-        """Write a string message to device as raw bytes. No termination
-        character is appended.
+        """Write a message to device as raw bytes. No termination character is
+        appended, and the bytes are escaped so that they reach the instrument
+        as they are.
 
         Args:
             command: The message to be sent.
         Returns:
             The number of bytes in the message.
         """
-        self._addr()
-        self.sock.send(command)
+        with self._exchange():
+            self.adapter.send(self.gpib, escape(command) + b"\n")
         return len(command)
 
     def write_ascii_values(self, command, values, converter='f', separator=','):
@@ -184,27 +368,22 @@ class PrologixSocketResource(object):
             Total number of bytes sent to instrument.
         """
         ascii_vals = to_ascii_block(values, converter, separator)
-        return self.write(command + ascii_vals + self.write_termination)
+        return self.write(command + ascii_vals)
 
     def query_ascii_values(self, command, converter='f', separator=',',
-        container=list, bufsize=None):
+        container=list):
         """Write a string message to device and return values as iterable.
 
         Args:
             command: Message to be sent to device.
-            values: Data to be written to device (as an interable)
             converter: String format code to be used to convert values.
             separator: Separator between values -- data.split(separator).
             container: Iterable type to use for output.
-            bufsize: Number of bytes to read from instrument. Defaults to resource
-            bufsize if None.
         Returns:
             Iterable of values converted from instrument response.
         """
-        if bufsize is None:
-            bufsize = self.bufsize
-        ascii = self.query(command, bufsize=bufsize)
-        return from_ascii_block(ascii, convereter, separator, container)
+        ascii = self.query(command)
+        return from_ascii_block(ascii, converter, separator, container)
 
     def write_binary_values(self, command, values, datatype='f',
         is_big_endian=False):
@@ -223,13 +402,12 @@ class PrologixSocketResource(object):
         return self.write_raw(command.encode()+data)
 
     def query_binary_values(self, command, datatype='f', container=np.array,
-        is_big_endian=False, bufsize=None):
+        is_big_endian=False):
         """Write a string message to device and read binary values, which are
         returned as iterable. Uses a pyvisa utility function.
 
         Args:
             command: String command sent to instrument.
-            values: Data to be sent to instrument.
             datatype: Format string for single element.
             container: Iterable to return number of as.
             is_big_endian: Bool indicating endianness.
@@ -237,9 +415,9 @@ class PrologixSocketResource(object):
         Returns:
             Iterable of data values to be retuned
         """
-        if bufsize is None:
-            bufsize = self.bufsize
-        self.write(command, bufsize=bufsize)
-        block = self.read_raw()
-        return from_binary_block(block, datatype=datatype,
+        with self._exchange():
+            self.adapter.send(self.gpib, (command + self.write_termination).encode())
+            self.adapter.request(self.gpib)
+            block = self.adapter.read_block()
+        return from_ieee_block(block, datatype=datatype,
             is_big_endian=is_big_endian, container=container)
@@ -0,0 +1,238 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+__all__ = ['SyntheticATS9870', 'SyntheticX6']
+
+import time
+import struct
+import threading
+import numpy as np
+
+from auspex.log import logger
+
+class SyntheticSource(object):
+    """Stands in for a digitizer library, streaming synthetic records to the sockets registered
+    with it in the same [size, data...] wire format, so that the filter pipeline can be exercised
+    (and benchmarked) at full speed without hardware. Everything is computed up front: a handful
+    of seeded blocks of one round robin each, which are sent over and over from a background
+    thread, as fast as the receivers take them or at `rate` records per second.
+
+    Each record is a readout of a qubit whose state is drawn for every segment from `states`,
+    the probabilities of finding the qubit excited (ground by default). The ground and excited
+    states differ in phase by pi, and gaussian noise is added to give an amplitude signal to
+    noise ratio of `snr`. Raw records carry the signal on an `if_freq` carrier, demodulated
+    records carry it at baseband, and integrated records are a single point.
+    """
+
+    def __init__(self, states=None, snr=10.0, if_freq=10e6, rate=None, seed=12345, num_blocks=4):
+        super(SyntheticSource, self).__init__()
+        self.states        = states
+        self.snr           = snr
+        self.if_freq       = if_freq
+        self.rate          = rate
+        self.seed          = seed
+        self.num_blocks    = num_blocks
+
+        self.sampling_rate    = 500e6
+        self.record_length    = 1024
+        self.nbr_segments     = 1
+        self.nbr_waveforms    = 1
+        self.nbr_round_robins = 1
+
+        self._sockets  = {} # key -> (socket, stream type, dtype, samples per record)
+        self._messages = {} # key -> list of precomputed messages
+        self._config   = None
+        self._thread   = None
+        self._stop     = threading.Event()
+
+        # Benchmarking
+        self.bytes_sent = 0
+        self.start_time = None
+        self.end_time   = None
+
+    @property
+    def records_per_block(self):
+        return self.nbr_segments*self.nbr_waveforms
+
+    def _register(self, key, sock, stream_type, dtype, samples):
+        self._sockets[key] = (sock, stream_type, np.dtype(dtype), samples)
+
+    def unregister_sockets(self):
+        self.stop()
+        self._sockets.clear()
+
+    def _records(self, rng, stream_type, samples):
+        """One block of records, as an array of shape (records, samples)."""
+        probs  = np.resize(self.states if self.states is not None else 0.0, self.nbr_segments)
+        states = rng.random_sample((self.nbr_waveforms, self.nbr_segments)) < probs
+        phase  = np.pi*states.reshape(-1, 1)
+        sigma  = 1.0/self.snr
+        if stream_type == "integrated":
+            records = np.exp(1j*phase)
+        else:
+            window  = slice(samples//4, 3*samples//4)
+            records = np.zeros((self.records_per_block, samples), dtype=np.complex128)
+            if stream_type == "raw":
+                t = np.arange(window.stop - window.start)/self.sampling_rate
+                records[:, window] = np.cos(2*np.pi*self.if_freq*t + phase)
+            else:
+                records[:, window] = np.exp(1j*phase)
+        noise = sigma*rng.standard_normal(records.shape)
+        if stream_type == "raw":
+            return records.real + noise
+        return records + noise + 1j*sigma*rng.standard_normal(records.shape)
+
+    def _prepare(self):
+        """Compute the messages for the current configuration, unless they already exist."""
+        config = (self.states if self.states is None else tuple(np.ravel(self.states)), self.snr,
+                  self.if_freq, self.seed, self.num_blocks, self.sampling_rate, self.record_length,
+                  self.nbr_segments, self.nbr_waveforms, tuple(sorted(self._sockets.keys())))
+        if config == self._config:
+            return
+        start = time.time()
+        rng = np.random.RandomState(self.seed)
+        self._messages = {}
+        for key, (sock, stream_type, dtype, samples) in sorted(self._sockets.items()):
+            messages = []
+            for _ in range(self.num_blocks):
+                payload = self._records(rng, stream_type, samples).astype(dtype).tobytes()
+                messages.append(struct.pack('n', len(payload)) + payload)
+            self._messages[key] = messages
+        self._config = config
+        logger.debug(f"Synthetic digitizer computed {self.num_blocks} blocks in {time.time()-start:.3f} s")
+
+    def acquire(self):
+        self.stop()
+        self._prepare()
+        self._stop.clear()
+        self.bytes_sent = 0
+        self.start_time = time.time()
+        self.end_time   = None
+        self._thread    = threading.Thread(target=self._send, name="synthetic digitizer", daemon=True)
+        self._thread.start()
+
+    def _send(self):
+        records = 0
+        try:
+            for rr in range(self.nbr_round_robins):
+                for key, messages in self._messages.items():
+                    if self._stop.is_set():
+                        return
+                    message = messages[rr % self.num_blocks]
+                    self._sockets[key][0].sendall(message)
+                    self.bytes_sent += len(message)
+                records += self.records_per_block
+                if self.rate:
+                    delay = self.start_time + records/self.rate - time.time()
+                    if delay > 0:
+                        self._stop.wait(delay)
+        except OSError as e:
+            logger.warning(f"Synthetic digitizer could not send data: {e}")
+        finally:
+            self.end_time = time.time()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def throughput(self):
+        """Bytes per second sent during the last acquisition."""
+        end = self.end_time or time.time()
+        return self.bytes_sent/(end - self.start_time) if self.start_time and end > self.start_time else 0.0
+
+class SyntheticATS9870(SyntheticSource):
+    """A synthetic stand-in for libalazar's ATS9870, which streams raw float32 records."""
+
+    def connect(self, address):
+        pass
+
+    def disconnect(self):
+        self.stop()
+
+    def setAll(self, config):
+        self.record_length    = int(config['recordLength'])
+        self.nbr_segments     = int(config['nbrSegments'])
+        self.nbr_waveforms    = int(config['nbrWaveforms'])
+        self.nbr_round_robins = int(config['nbrRoundRobins'])
+        self.sampling_rate    = float(config['samplingRate'])
+        self.numberAcquisitions    = self.nbr_round_robins
+        self.samplesPerAcquisition = self.record_length*self.records_per_block
+        self.ch1Buffer = np.zeros(self.samplesPerAcquisition, dtype=np.float32)
+        self.ch2Buffer = np.zeros(self.samplesPerAcquisition, dtype=np.float32)
+
+    def register_socket(self, channel, sock):
+        self._register(channel, sock, "raw", np.float32, self.record_length)
+
+    def acquire(self):
+        # Records are as long as configured when acquisition starts
+        for key, (sock, stream_type, dtype, samples) in list(self._sockets.items()):
+            self._register(key, sock, stream_type, dtype, self.record_length)
+        super(SyntheticATS9870, self).acquire()
+
+    def data_available(self):
+        return False
+
+class SyntheticX6(SyntheticSource):
+    """A synthetic stand-in for libx6's X6. Raw streams are decimated by 4, and demodulated
+    streams by 32, relative to the record length; integrated streams give a point per record."""
+
+    def __init__(self, *args, **kwargs):
+        super(SyntheticX6, self).__init__(*args, **kwargs)
+        self.device_id    = None
+        self.reference    = "internal"
+        self.acquire_mode = "digitizer"
+        self.sampling_rate = 1e9
+
+    def connect(self, device_id):
+        self.device_id = device_id
+
+    def disconnect(self):
+        self.stop()
+        self.device_id = None
+
+    def register_socket(self, a, b, c, sock):
+        self._register((a, b, c), sock, None, None, None)
+
+    def enable_stream(self, a, b, c):
+        pass
+
+    def set_nco_frequency(self, a, b, freq):
+        pass
+
+    def write_kernel(self, a, b, c, kernel):
+        pass
+
+    def set_kernel_bias(self, a, b, c, bias):
+        pass
+
+    def set_threshold(self, a, c, threshold):
+        pass
+
+    def set_threshold_invert(self, a, c, invert):
+        pass
+
+    def acquire(self):
+        for (a, b, c), (sock, _, _, _) in list(self._sockets.items()):
+            if c != 0:
+                self._register((a, b, c), sock, "integrated", np.complex128, 1)
+            elif b != 0:
+                self._register((a, b, c), sock, "demodulated", np.complex128, self.record_length//32)
+            else:
+                self._register((a, b, c), sock, "raw", np.float64, self.record_length//4)
+        super(SyntheticX6, self).acquire()
+
+    def get_is_running(self):
+        return self.is_running()
+
+    def get_data_available(self):
+        return False
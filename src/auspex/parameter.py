@@ -6,6 +6,8 @@
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 
+import time
+
 from auspex.log import logger
 
 class Parameter(object):
@@ -13,7 +15,7 @@ class Parameter(object):
 
     def __init__(self, name=None, unit=None, default=None,
                  value_range=None, allowed_values=None,
-                 increment=None, snap=None):
+                 increment=None, snap=None, settle_time=0.0, instrument=None):
         self.name     = name
         self._value   = default
         self.unit     = unit
@@ -21,6 +23,13 @@ class Parameter(object):
         self.method   = None
         self.instrument_tree = None
 
+        # Time (s) the instrument needs after a push before measurements may be taken
+        self.settle_time = settle_time
+
+        # The instrument that this parameter sets. Parameters of different instruments may be
+        # pushed at the same time (see Sweeper.concurrent). Defaults to the owner of the method.
+        self.instrument = instrument
+
         # These are primarily intended for Quince interoperation,
         # but will maybe be useful for Auspex too...
         self.value_range    = value_range
@@ -107,7 +116,15 @@ class Parameter(object):
         logger.debug("Setting method of Parameter %s to %s" % (self.name, str(method)) )
         self.method = method
 
-    def push(self):
+    def push_key(self):
+        """Parameters with the same key must be pushed one after the other."""
+        if self.instrument is not None:
+            return id(self.instrument)
+        return id(getattr(self.method, '__self__', None))
+
+    def push(self, settle=True):
+        """Send the value to the instrument and, unless settle is False, wait out the settle time.
+        Returns the time at which the instrument will have settled."""
         if self.method is not None:
             # logger.debug("Calling pre_push_hooks of Parameter %s with value %s" % (self.name, self._value) )
             for pph in self.pre_push_hooks:
@@ -117,6 +134,11 @@ class Parameter(object):
             # logger.debug("Calling post_push_hooks of Parameter %s with value %s" % (self.name, self._value) )
             for pph in self.post_push_hooks:
                 pph()
+            if not settle:
+                return time.time() + self.settle_time
+            if self.settle_time:
+                time.sleep(self.settle_time)
+        return time.time()
 
 class FilenameParameter(Parameter):
     def __init__(self, *args, **kwargs):
@@ -160,9 +182,15 @@ class ParameterGroup(Parameter):
         for param, method in zip(self.parameters,methods):
             param.assign_method(method)
 
-    def push(self):
-        for param in self.parameters:
-            param.push()
+    def push_key(self):
+        return id(None)
+
+    def push(self, settle=True):
+        settled = [param.push(settle=False) for param in self.parameters]
+        settled = max(settled, default=time.time())
+        if settle:
+            time.sleep(max(0.0, settled - time.time()))
+        return settled
 
 class FloatParameter(Parameter):
 
@@ -338,10 +338,9 @@ class MixerCalibrationExperiment(Experiment):
             self.I_offset.assign_method(lambda x: self.awg.set_offset(int(self._phys_chan.label[-2]), x))
             self.Q_offset.assign_method(lambda x: self.awg.set_offset(int(self._phys_chan.label[-1]), x))
             self.phase_skew.assign_method(lambda x: self.awg.set_mixer_phase_skew(self._phys_chan.label[-2:], x, self.SSB_FREQ))
-        self.I_offset.add_post_push_hook(lambda: time.sleep(0.1))
-        self.Q_offset.add_post_push_hook(lambda: time.sleep(0.1))
-        self.amplitude_factor.add_post_push_hook(lambda: time.sleep(0.1))
-        self.phase_skew.add_post_push_hook(lambda: time.sleep(0.1))
+        for param in [self.I_offset, self.Q_offset, self.amplitude_factor, self.phase_skew]:
+            param.settle_time = 0.1
+            param.instrument  = self.awg
 
         for name, instr in self._instruments.items():
             # Configure with dictionary from the instrument proxyg
@@ -439,6 +439,33 @@ class QubitExperiment(Experiment):
         auspex_instr.ideal_data = ideal_data
         auspex_instr.gen_fake_data = False
 
+    def set_synthetic_data(self, digitizer_proxy, states=None, snr=10.0, rate=None, seed=12345, **kwargs):
+        """Stream precomputed, synthetic data from a digitizer instead of the hardware, as fast as
+        the pipeline will take it (or at a fixed rate), in order to measure the throughput of the
+        pipeline without hardware. See `auspex.instruments.synthetic.SyntheticSource`.
+
+        Parameters:
+            digitizer_proxy (bbndb `Receiver` instance)
+                The digitizer instrument proxy to be replaced by a synthetic source.
+            states (numpy array)
+                The probability of the qubit being excited for each segment. Defaults to the ground state.
+            snr (float)
+                Amplitude signal to noise ratio of the readout.
+            rate (float)
+                Records per second to send, or None to send them as fast as they are received.
+            seed (int)
+                Seed of the random states and noise.
+
+        Examples:
+            >>> exp = QubitExperiment(RabiAmp(q1,amps),averages=1000)
+            >>> exp.set_synthetic_data(digitizer_1, states=np.linspace(0, 1, 51), snr=2.0)
+            >>> exp.run_sweeps()
+            >>> digitizer_1.instr._lib.throughput()
+        """
+        auspex_instr = self.proxy_name_to_instrument[digitizer_proxy.label]
+        auspex_instr.gen_fake_data = False
+        auspex_instr.synthetic = dict(states=states, snr=snr, rate=rate, seed=seed, **kwargs)
+
     def add_connector(self, stream_selector):
         name = stream_selector.qubit_name+'-'+stream_selector.stream_type
         logger.debug(f"Adding {name} output connector to experiment.")
@@ -448,8 +475,14 @@ class QubitExperiment(Experiment):
         return oc
 
     def init_instruments(self):
-        for name, instr in self._instruments.items():
-            instr.configure_with_proxy(instr.proxy_obj)
+        # The master AWG triggers the others, so set it up once they are ready
+        awgs = [n for n, v in self._instruments.items() if "AWG" in v.instrument_type]
+        dependencies = {n: list(deps) for n, deps in self.instrument_dependencies.items()}
+        for name in awgs:
+            if getattr(self._instruments[name].proxy_obj, "master", False):
+                deps = dependencies.setdefault(name, [])
+                deps.extend(n for n in awgs if n != name and n not in deps)
+        self.for_each_instrument(lambda instr: instr.configure_with_proxy(instr.proxy_obj), "Configured", dependencies)
 
         self.digitizers = [v for _, v in self._instruments.items() if "Digitizer" in v.instrument_type]
         self.awgs       = [v for _, v in self._instruments.items() if "AWG" in v.instrument_type]
@@ -550,6 +583,9 @@ class QubitExperiment(Experiment):
                     getattr(instr, "set_"+prop)(chan, value)
             param.set_pair = (thing.phys_chan.label, attribute)
 
+        # Parameters of other instruments may be set at the same time as this one
+        param.instrument = instr
+
         if method:
             # Custom method
             param.assign_method(method)
@@ -558,7 +594,7 @@ class QubitExperiment(Experiment):
             # Get method by name
             if hasattr(instr, "set_"+attribute):
                 param.assign_method(getattr(instr, "set_"+attribute)) # Couple the parameter to the instrument
-                param.add_post_push_hook(lambda: time.sleep(0.05))
+                param.settle_time = 0.05
             else:
                 raise ValueError("The instrument {} has no method {}".format(name, "set_"+attribute))
             param.set_pair = (instr.name, attribute)
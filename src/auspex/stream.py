@@ -46,6 +46,29 @@ def cartesian(arrays, out=None, dtype='f'):
             out[j*m:(j+1)*m,1:] = out[0:m,1:]
     return out
 
+def tuple_grid(axes, start=0, stop=None):
+    """Returns the structured array of tuples in the cartesian product of the original points of
+    the axes (outermost first), or just the slice [start:stop] of it. Each field is gathered
+    from its axis' values using the flat indices, so no Python tuples are ever built."""
+    dtype = []
+    for a in axes:
+        dtype.extend(a.data_type(with_metadata=True))
+    dims  = [len(a.original_points) for a in axes]
+    total = int(np.prod(dims))
+    stop  = total if stop is None else min(stop, total)
+    index = np.arange(start, max(start, stop))
+    out   = np.empty(index.size, dtype=dtype)
+    if index.size == 0:
+        return out
+    names = iter(out.dtype.names or ())
+    inner = total
+    for a, n in zip(axes, dims):
+        inner //= n
+        point = (index // inner) % n
+        for column in a.columns():
+            out[next(names)] = column[point]
+    return out
+
 class DataAxis(object):
     """An axis in a data stream"""
     def __init__(self, name, points=[], unit=None, metadata=None, dtype=np.float32):
@@ -89,7 +112,9 @@ class DataAxis(object):
             dtype.append((name, 'f'))
 
         if with_metadata and self.metadata is not None:
-            dtype.append((name + "_metadata", str))
+            # Wide enough for the longest value, since a bare str field would hold nothing
+            width = max([len(str(m)) for m in self.metadata] + [1])
+            dtype.append((name + "_metadata", 'U{}'.format(width)))
         return dtype
 
     def points_with_metadata(self):
@@ -101,6 +126,18 @@ class DataAxis(object):
             return [tuple(self.original_points[i]) for i in range(len(self.original_points))]
         return [(self.original_points[i],) for i in range(len(self.original_points))]
 
+    def columns(self):
+        """Returns one array per field of data_type(with_metadata=True), holding the values
+        of that field at each of the original points."""
+        if self.unstructured:
+            points  = np.asarray(self.original_points)
+            columns = [points[:, i] for i in range(points.shape[1])]
+        else:
+            columns = [np.asarray(self.original_points)]
+        if self.metadata is not None:
+            columns.append(np.asarray(self.metadata))
+        return columns
+
     def tuple_width(self):
         if self.unstructured:
             width = len(name)
@@ -179,20 +216,25 @@ class SweepAxis(DataAxis):
 
         logger.debug("Created {}".format(self.__repr__()))
 
-    def update(self):
+    def update(self, push=True):
         """ Update value after each run.
         """
         if self.step < self.num_points():
             if self.callback_func:
                 self.callback_func(self, self.experiment)
-            self.value = self.points[self.step]
-            if self.metadata is not None:
-                self.metadata_value = self.metadata[self.step]
-            logger.debug("Sweep Axis '{}' at step {} takes value: {}.".format(self.name,
-                                                                               self.step,self.value))
-            self.push()
-            self.step += 1
-            self.done = False
+            self.move_to(self.step)
+            if push:
+                self.push()
+
+    def move_to(self, index):
+        """Take on the value of the given point of the axis, without pushing it."""
+        self.value = self.points[index]
+        if self.metadata is not None:
+            self.metadata_value = self.metadata[index]
+        logger.debug("Sweep Axis '{}' at step {} takes value: {}.".format(self.name,
+                                                                           index,self.value))
+        self.step = index + 1
+        self.done = False
 
     def check_for_refinement(self, output_connectors_dict):
         """Check to see if we need to perform any refinements. If there is a refine_func
@@ -225,15 +267,20 @@ class SweepAxis(DataAxis):
                 logger.debug("Sweep Axis '{}' complete.".format(self.name))
                 return False
 
-    def push(self):
-        """ Push parameter value(s) """
+    def parameter_values(self, value=None):
+        """ List of (parameter, value) pairs to push for the current value, or the given one """
+        value = self.value if value is None else value
         if self.unstructured:
-            for p, v in zip(self.parameter, self.value):
-                p.value = v
-                p.push()
-        else:
-            self.parameter.value = self.value
-            self.parameter.push()
+            return list(zip(self.parameter, value))
+        return [(self.parameter, value)]
+
+    def push(self, settle=True):
+        """ Push parameter value(s) """
+        settled = []
+        for p, v in self.parameter_values():
+            p.value = v
+            settled.append(p.push(settle=settle))
+        return max(settled)
 
     def __repr__(self):
         return "<SweepAxis(name={},length={},unit={},value={},unstructured={}>".format(self.name,
@@ -259,8 +306,42 @@ class DataStreamDescriptor(object):
         # since they are emitted as often as possible.
         self.buffer_mult_factor = 1
 
-        # Keep track of the parameter permutations we have actually used...
-        self.visited_tuples = []
+        # Keep track of the parameter permutations we have actually used, in an array
+        # with room to grow. Copies of the descriptor share it until they add to it.
+        self._visited        = None
+        self._num_visited    = 0
+        self._visited_shared = False
+
+    @property
+    def visited_tuples(self):
+        if self._visited is None:
+            return []
+        return self._visited[:self._num_visited]
+
+    @visited_tuples.setter
+    def visited_tuples(self, tuples):
+        if isinstance(tuples, np.ndarray) and tuples.dtype.names is not None:
+            self._visited = tuples
+        elif len(tuples) > 0:
+            self._visited = np.rec.fromrecords(list(tuples), dtype=self.axis_data_type(with_metadata=True))
+        else:
+            self._visited = None
+        self._num_visited    = 0 if self._visited is None else len(self._visited)
+        self._visited_shared = False
+
+    def add_visited_tuples(self, tuples):
+        """Append a structured array of newly visited tuples to visited_tuples."""
+        num_new = len(tuples)
+        if self._visited is None or self._visited_shared or self._num_visited + num_new > len(self._visited):
+            dtype    = tuples.dtype if self._visited is None else self._visited.dtype
+            capacity = max(2*(self._num_visited + num_new), 256)
+            storage  = np.empty(capacity, dtype=dtype)
+            if self._num_visited:
+                storage[:self._num_visited] = self._visited[:self._num_visited]
+            self._visited        = storage
+            self._visited_shared = False
+        self._visited[self._num_visited:self._num_visited + num_new] = tuples
+        self._num_visited += num_new
 
     def is_adaptive(self):
         return True in [a.refine_func is not None for a in self.axes]
@@ -268,7 +349,7 @@ class DataStreamDescriptor(object):
     def add_axis(self, axis, position=0):
         # Check if axis is DataAxis or SweepAxis (which inherits from DataAxis)
         if isinstance(axis, DataAxis):
-            logger.debug("Adding DataAxis into DataStreamDescriptor: {}".format(axis))
+            logger.debug("Adding DataAxis into DataStreamDescriptor: %s", axis)
             self.axes.insert(position, axis)
         else:
             raise TypeError("Failed adding axis. Object is not DataAxis: {}".format(axis))
@@ -302,10 +383,6 @@ class DataStreamDescriptor(object):
         return sum([a.tuple_width() for a in self.axes])
 
     def dims(self):
-        dims = []
-
-        for a in self.axes:
-                dims.append(len(a.points))
         return [a.num_points() for a in self.axes]
 
     def axes_done(self):
@@ -352,42 +429,30 @@ class DataStreamDescriptor(object):
             self.visited_tuples = self.expected_tuples(with_metadata=True)
 
         if as_structured_array:
-            # If we already have a structured array
-            if type(self.visited_tuples) is np.ndarray and type(self.visited_tuples.dtype.names) is tuple:
-                return self.visited_tuples
-            elif type(self.visited_tuples) is np.ndarray:
-                return np.rec.fromarrays(self.visited_tuples.T, dtype=self.axis_data_type(with_metadata=True))
-            return np.core.records.fromrecords(self.visited_tuples, dtype=self.axis_data_type(with_metadata=True))
-        return self.visited_tuples
-
-    def expected_tuples(self, with_metadata=False, as_structured_array=True):
-        """Returns a list of tuples representing the cartesian product of the axis values. Should only
-        be used with non-adaptive sweeps."""
-        vals           = [a.points_with_metadata() for a in self.axes]
-
-        #
-        # TODO: avoid this slow list comprehension
-        simple = True
-        if True in [a.unstructured for a in self.axes]:
-            simple = False
-        if True in [a.metadata is not None for a in self.axes]:
-            simple = False
-        if self.axes == []:
-            simple = False
-
-        if simple:
-            # flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-            flattened_list = cartesian(vals)
-        else:
-            nested_list    = itertools.product(*vals)
-            flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-            # flattened_list = np.array(list(nested_list)).reshape(-1, self.tuple_width())
+            return self.visited_tuples
+        return self.visited_tuples.tolist()
 
+    def expected_tuples(self, with_metadata=False, as_structured_array=True, excluding_axis=None, start=0, stop=None):
+        """Returns a list of tuples representing the cartesian product of the axis values. Should only
+        be used with non-adaptive sweeps. The tuples are computed directly from their indices, so
+        any slice [start:stop] of the product can be had without generating the rest of it."""
+        axes   = [a for a in self.axes if a.name != excluding_axis]
+        tuples = tuple_grid(axes, start, stop).view(np.recarray)
         if as_structured_array:
-            if simple:
-                return np.rec.fromarrays(flattened_list.T, dtype=self.axis_data_type(with_metadata=True))
-            return np.rec.fromrecords(flattened_list, dtype=self.axis_data_type(with_metadata=True))
-        return flattened_list
+            return tuples
+        return tuples.tolist()
+
+    def sweep_tuples(self, sweep_values=None):
+        """Returns the tuples visited at one point of the sweep: the given values of the sweep axes
+        (as returned by Sweeper.update) along with every point of the data axes."""
+        data_tuples = tuple_grid([a for a in self.axes if not isinstance(a, SweepAxis)])
+        tuples      = np.empty(len(data_tuples), dtype=self.axis_data_type(with_metadata=True))
+        names       = iter(tuples.dtype.names)
+        for value in itertools.chain.from_iterable(sweep_values or []):
+            tuples[next(names)] = value
+        for name in data_tuples.dtype.names or ():
+            tuples[next(names)] = data_tuples[name]
+        return tuples
 
     def axis_names(self, with_metadata=False):
         """Returns all axis names included those from unstructured axes"""
@@ -421,6 +486,8 @@ class DataStreamDescriptor(object):
         newone = type(self)()
         newone.__dict__.update(self.__dict__)
         newone.axes = self.axes[:]
+        if self._visited is not None:
+            self._visited_shared = newone._visited_shared = True
         return newone
 
     def copy(self):
@@ -479,35 +546,86 @@ class DataStreamDescriptor(object):
     def _ipython_key_completions_(self):
         return [a.name for a in self.axes]
 
+class StreamChannel(object):
+    """The transport behind a DataStream: the notification queue, the points counter, and the
+    ring buffer counters and memory. Streams normally own a private channel, but a FilterRuntime
+    allocates long-lived ones before forking its workers and lends them to each new experiment."""
+    def __init__(self, buffer_bytes=0):
+        self.queue             = Queue()
+        self.points_taken_lock = mp.Lock()
+        self.points_taken      = Value('i', 0)
+        self.head              = RawValue(ctypes.c_longlong, 0)
+        self.tail              = RawValue(ctypes.c_longlong, 0)
+        self.blocked           = RawValue(ctypes.c_bool, False)
+        self.buff_shared       = RawArray(ctypes.c_byte, buffer_bytes) if buffer_bytes else None
+
 class DataStream(object):
-    """A stream of data"""
+    """A stream of data. Samples are carried between processes by a single-producer,
+    single-consumer ring buffer in shared memory, while the queue carries notifications
+    and events. The producer owns `head` and the consumer owns `tail`, both of which count
+    points monotonically, so neither side needs a lock to access the buffer."""
+
+    # Upper limit on the ring buffer size. Pushes larger than the buffer are
+    # streamed through it in pieces, so this only bounds memory usage.
+    max_buffer_size = 2**22
+
+    # How long (s) a producer will wait on a full buffer before giving up
+    push_timeout = 30.0
+
     def __init__(self, name=None, unit=None):
         super(DataStream, self).__init__()
-        self.queue = Queue()
         self.name = name
         self.unit = unit
-        self.points_taken_lock = mp.Lock()
-        self.points_taken = Value('i', 0) # Using shared memory since these are used in filter processes
         self.descriptor = None
         self.start_connector = None
         self.end_connector = None
-        self.closed = False
+
+        # Set when both ends run in the same process, so that data can be
+        # handed to the downstream filter directly (see ExperimentGraph.fuse_chains)
+        self.fused = False
 
         # Shared memory interface
-        self.buffer_lock    = mp.Lock()
-        # self.buffer_size    = 500000
-        self.buff_idx       = Value('i', 0)
+        self.attach(None)
+        self.buffer_size = 0
+        self._pending = 0 # Points handed out by pop() but not yet released
+
+    def attach(self, channel):
+        """Carry this stream over the given long-lived StreamChannel, or over a private
+        one if channel is None. Must be followed by final_init()."""
+        self.channel           = channel
+        transport              = channel if channel is not None else StreamChannel()
+        self.queue             = transport.queue
+        self.points_taken_lock = transport.points_taken_lock
+        self.points_taken      = transport.points_taken # Using shared memory since these are used in filter processes
+        self.head              = transport.head
+        self.tail              = transport.tail
+        self.blocked           = transport.blocked # Set while the producer waits for space
+        self.closed            = False
+        if channel is not None:
+            # Clear out anything left behind by the channel's previous borrower
+            with self.points_taken_lock:
+                self.points_taken.value = 0
+            while not self.queue.empty():
+                self.queue.get_nowait()
 
     def final_init(self):
-        self.buffer_size = self.descriptor.num_points()*self.descriptor.buffer_mult_factor
+        self.buffer_size = int(min(self.descriptor.num_points()*self.descriptor.buffer_mult_factor, self.max_buffer_size))
+        self.buffer_size = max(self.buffer_size, 1)
         # logger.info(f"{self.start_connector.parent}:{self.start_connector} to {self.end_connector.parent}:{self.end_connector} buffer of size {self.buffer_size}")
-        if self.buffer_size > 50e6:
-            logger.debug(f"Limiting buffer size of {self} to 50 Million Points")
-            self.buffer_size = 50e6
-        self.buff_shared_re = RawArray(ctypes.c_double, int(self.buffer_size))
-        self.buff_shared_im = RawArray(ctypes.c_double, int(self.buffer_size))
-        self.re_np = np.frombuffer(self.buff_shared_re, dtype=np.float64)
-        self.im_np = np.frombuffer(self.buff_shared_im, dtype=np.float64)
+        # Store samples in the descriptor's own dtype (complex values interleaved) so that
+        # data moves between processes without any conversion.
+        self.dtype = np.dtype(self.descriptor.dtype)
+        if self.channel is not None:
+            # Borrowed memory is fixed in size, larger pushes are streamed through it
+            self.buffer_size = max(min(self.buffer_size, len(self.channel.buff_shared)//self.dtype.itemsize), 1)
+            self.buff_shared = self.channel.buff_shared
+        else:
+            self.buff_shared = RawArray(ctypes.c_byte, self.buffer_size*self.dtype.itemsize)
+        self.buff_np = np.frombuffer(self.buff_shared, dtype=self.dtype, count=self.buffer_size)
+        self.head.value = 0
+        self.tail.value = 0
+        self.blocked.value = False
+        self._pending = 0
 
     def set_descriptor(self, descriptor):
         if isinstance(descriptor,DataStreamDescriptor):
@@ -540,6 +658,9 @@ class DataStream(object):
             self.points_taken.value = 0
         while not self.queue.empty():
             self.queue.get_nowait()
+        self.head.value = 0
+        self.tail.value = 0
+        self._pending = 0
         if self.start_connector is not None:
             self.start_connector.points_taken.value = 0
 
@@ -562,43 +683,195 @@ class DataStream(object):
                         self.points_taken.value += 1
                     except:
                         raise ValueError("Got data {} that is neither an array nor a float".format(data))
-        with self.buffer_lock:
-            start = self.buff_idx.value
-            re = np.real(np.array(data)).flatten()
-            if start+re.size > self.re_np.size:
-                raise ValueError(f"Stream {self} received more data than fits in the shared memory buffer. \
-                    This is probably due to digitizer raw streams producing data too quickly for the pipeline.")
-            self.re_np[start:start+re.size] = re
-            if np.issubdtype(self.descriptor.dtype, np.complexfloating):
-                im = np.imag(data).flatten()
-                self.im_np[start:start+im.size] = im
-            message = {"type": "data", "data": None}
-            self.buff_idx.value = start + np.array(data).size
-        self.queue.put(message)
-
-    def pop(self):
-        result = None
-        with self.buffer_lock:
-            idx = self.buff_idx.value
-            if idx != 0:
-                result = self.re_np[:idx]
-
-                if np.issubdtype(self.descriptor.dtype, np.complexfloating):
-                    result = result.astype(np.complex128) + 1.0j*self.im_np[:idx]
-                self.buff_idx.value = 0
-                result = result.copy()
+        data = np.asarray(data).ravel()
+        if np.iscomplexobj(data) and not np.issubdtype(self.dtype, np.complexfloating):
+            data = np.real(data)
+        if self.fused:
+            self.end_connector.parent.receive_fused_data(data.astype(self.dtype, copy=False))
+            return
+        # Stream anything larger than the ring buffer through it in pieces
+        for offset in range(0, data.size, self.buffer_size):
+            piece = data[offset:offset+self.buffer_size]
+            self._wait_for_space(piece.size)
+            head  = self.head.value
+            start = head % self.buffer_size
+            first = min(piece.size, self.buffer_size - start)
+            self.buff_np[start:start+first] = piece[:first]
+            self.buff_np[:piece.size-first] = piece[first:]
+            # Only publish the new head once the data is in place
+            self.head.value = head + piece.size
+            self.queue.put({"type": "data", "data": None})
+
+    def reserve(self, max_points):
+        """Return a writable view of the next free stretch of the ring buffer, at most max_points
+        long, for the producer to fill in place (e.g. with socket.recv_into) instead of pushing.
+        Waits, like `push()`, for the consumer to make room, so a producer that reserves before
+        reading its source stops reading while the consumer is behind. The view may be shorter
+        than requested where it meets the end of the ring. Nothing is published before
+        `commit()`. Not available on fused streams."""
+        if self.closed:
+            raise Exception("The queue is closed and should not be receiving any more data")
+        self._wait_for_space(min(max_points, self.buffer_size))
+        head  = self.head.value
+        start = head % self.buffer_size
+        free  = self.buffer_size - (head - self.tail.value)
+        return self.buff_np[start:start+min(max_points, free, self.buffer_size - start)]
+
+    def commit(self, num_points):
+        """Publish the first num_points of the view handed out by `reserve()`."""
+        with self.points_taken_lock:
+            self.points_taken.value += num_points
+        self.head.value += num_points
+        self.queue.put({"type": "data", "data": None})
+
+    def _wait_for_space(self, num_points):
+        """Block the producer until the consumer has released enough of the ring buffer."""
+        waiting_since = None
+        while self.buffer_size - (self.head.value - self.tail.value) < num_points:
+            if waiting_since is None:
+                waiting_since = time.time()
+                self.blocked.value = True
+                logger.debug(f"Stream {self} is full, waiting for the consumer.")
+            elif time.time() - waiting_since > self.push_timeout:
+                self.blocked.value = False
+                raise Exception(f"Stream {self} consumer has not freed any buffer space in {self.push_timeout} s. \
+                    The downstream filter has probably stalled or crashed.")
+            time.sleep(0.0005)
+        self.blocked.value = False
+
+    def available(self):
+        """Number of points in the buffer that have not yet been popped."""
+        return self.head.value - self.tail.value - self._pending
+
+    def pop(self, max_points=None):
+        """Return the data currently available in the buffer (at most max_points of it), in the
+        descriptor's dtype. This is a zero-copy view into shared memory whenever the data do not
+        wrap around the end of the ring, so it is only valid until `release()` (or the next `pop()`)
+        is called. Consumers that keep data around must copy it."""
+        self.release()
+        head  = self.head.value
+        tail  = self.tail.value
+        if max_points is not None:
+            head = min(head, tail + max_points)
+        if head == tail:
+            return None
+        start = tail % self.buffer_size
+        stop  = start + head - tail
+        if stop <= self.buffer_size:
+            result = self.buff_np[start:stop]
+        else:
+            result = np.concatenate((self.buff_np[start:], self.buff_np[:stop-self.buffer_size]))
+        self._pending = head - tail
         return result
 
+    def release(self):
+        """Hand the space occupied by the last `pop()` back to the producer."""
+        if self._pending:
+            self.tail.value += self._pending
+            self._pending = 0
+
     def push_event(self, event_type, data=None):
         if self.closed:
             raise Exception("The queue is closed and should not be receiving any more data")
         message = {"type": "event", "event_type": event_type, "data": data}
-        self.queue.put(message)
+        if self.fused:
+            self.end_connector.parent.receive_fused_event(message)
+        else:
+            # Record where the event falls in the data, so that consumers of several streams
+            # can line it up with the events of the others (see StreamAligner)
+            message["position"] = self.head.value
+            self.queue.put(message)
         if event_type == "done":
             logger.debug(f"Closing out queue {self}")
-            self.queue.close()
+            if self.channel is None:
+                # Borrowed queues outlive the experiment
+                self.queue.close()
             self.closed = True
 
+class StreamAligner(object):
+    """Reads several streams in lockstep, returning equal length chunks of data from each
+    of them. Chunks are zero-copy views into the streams' ring buffers wherever possible, and
+    points that one stream has but the others do not yet have are left in place. Only when the
+    producer of a stream that is running ahead is waiting for space are its points moved to a
+    private backlog, so that it is never held up by a slower stream."""
+
+    def __init__(self, streams):
+        super(StreamAligner, self).__init__()
+        self.streams  = list(streams)
+        self.consumed = [0]*len(self.streams)
+        self.backlogs = [np.empty(0, dtype=s.dtype) for s in self.streams]
+        self.starts   = [0]*len(self.streams)
+        self.stops    = [0]*len(self.streams)
+
+    def available(self, index):
+        """Number of points of the given stream that have not yet been read."""
+        return self.stops[index] - self.starts[index] + self.streams[index].available()
+
+    def read(self, max_points=None):
+        """Return a list with one chunk of data per stream, all of the same length (at most
+        max_points), or None if some stream has no data. The chunks are only valid until the
+        next call to `read()`, `discard()` or `release()`."""
+        self.release()
+        available = [self.available(i) for i in range(len(self.streams))]
+        num_points = min(available)
+        if max_points is not None:
+            num_points = min(num_points, max_points)
+        for i, stream in enumerate(self.streams):
+            if available[i] > num_points and stream.blocked.value:
+                self._spill(i)
+        if num_points <= 0:
+            return None
+        return [self._take(i, num_points) for i in range(len(self.streams))]
+
+    def discard(self, index, num_points):
+        """Drop points from the given stream, e.g. to realign it with the others."""
+        self.release()
+        while num_points > 0:
+            data = self._take(index, min(num_points, self.available(index)))
+            if data is None:
+                break
+            num_points -= data.size
+            self.release()
+
+    def release(self):
+        """Hand the space occupied by the last chunks back to the producers."""
+        for stream in self.streams:
+            stream.release()
+
+    def _take(self, index, num_points):
+        if num_points <= 0:
+            return None
+        self.consumed[index] += num_points
+        if self.stops[index] == self.starts[index]:
+            return self.streams[index].pop(num_points)
+        if self.stops[index] - self.starts[index] < num_points:
+            self._spill(index)
+        start = self.starts[index]
+        self.starts[index] += num_points
+        if self.starts[index] == self.stops[index]:
+            self.starts[index] = self.stops[index] = 0
+        return self.backlogs[index][start:start+num_points]
+
+    def _spill(self, index):
+        """Move the points of a stream from its ring buffer to the end of its backlog."""
+        data = self.streams[index].pop()
+        if data is None:
+            return
+        backlog = self.backlogs[index]
+        start, stop = self.starts[index], self.stops[index]
+        if stop + data.size > backlog.size:
+            live = stop - start
+            if live + data.size > backlog.size:
+                backlog = np.empty(max(2*backlog.size, live + data.size), dtype=backlog.dtype)
+                backlog[:live] = self.backlogs[index][start:stop]
+                self.backlogs[index] = backlog
+            else:
+                backlog[:live] = backlog[start:stop]
+            start, stop = 0, live
+        backlog[stop:stop+data.size] = data
+        self.starts[index], self.stops[index] = start, stop + data.size
+        self.streams[index].release()
+
 # These connectors are where we attached the DataStreams
 class InputConnector(object):
     def __init__(self, name="", parent=None, datatype=None, max_input_streams=1):
@@ -7,16 +7,36 @@
 #    http://www.apache.org/licenses/LICENSE-2.0
 
 import itertools
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from auspex.parameter import ParameterGroup, FloatParameter, IntParameter, Parameter
 from auspex.stream import DataStream, DataAxis, SweepAxis, DataStreamDescriptor, InputConnector, OutputConnector
 from auspex.log import logger
 
+def push_in_order(parameters):
+    """Push the parameters one after another, returning the time by which all have settled."""
+    return max(p.push(settle=False) for p in parameters)
+
 class Sweeper(object):
-    """ Control center of sweep axes """
+    """ Control center of sweep axes. The parameters that change from one point of the sweep
+    to the next are pushed together, and their settle times run concurrently. If `concurrent`
+    is set, parameters of different instruments (see Parameter.push_key) are also pushed from
+    separate threads. If `prefetch` is set, the parameters of each point are pushed in the
+    background as soon as the previous point has been taken (see `prefetch_next`)."""
+
+    # Most instruments that are set up at once
+    max_concurrent_pushes = 8
+
     def __init__(self):
         self.axes = []
+        self.push_all = False
+        self.concurrent = False
+        self.prefetch = False
+        self._executor = None
+        self._prefetcher = None
+        self._prefetched = None
         logger.debug("Generate Sweeper.")
 
     def swept_parameters(self):
@@ -38,13 +58,24 @@ class Sweeper(object):
         if imax < 0:
             logger.debug("There are no sweep axis, only data axes.")
             return None, None
+        elif self._prefetched is not None:
+            plan, pushes = self._prefetched
+            self._prefetched = None
+            self.wait_until(pushes.result())
+            for axis, index in plan:
+                axis.move_to(index)
         else:
             i=0
-            while i<imax and self.axes[i].step==0:
+            while i<imax and (self.push_all or self.axes[i].step==0):
                 i += 1
+            self.push_all = False
             # Need to update parameters from outer --> inner axis
+            parameter_values = []
             for j in range(i,-1,-1):
-                self.axes[j].update()
+                if self.axes[j].step < self.axes[j].num_points():
+                    self.axes[j].update(push=False)
+                    parameter_values.extend(self.axes[j].parameter_values())
+            self.set_and_push(parameter_values)
 
         # At this point all of the updates should have happened
         # return the current coordinates of the sweep. Return the
@@ -65,6 +96,85 @@ class Sweeper(object):
                     values.append((a.value,))
         return values, names
 
+    def set_and_push(self, parameter_values, settle=True):
+        """Set and push the (parameter, value) pairs."""
+        for p, v in parameter_values:
+            p.value = v
+        return self.push_parameters([p for p, v in parameter_values], settle=settle)
+
+    def push_parameters(self, parameters, settle=True):
+        """Push the parameters, in order for any given instrument, and unless settle is False
+        wait for all of them to settle. Returns the time at which they will have settled."""
+        groups = {}
+        if self.concurrent:
+            for p in parameters:
+                groups.setdefault(p.push_key(), []).append(p)
+        if not parameters:
+            settled = time.time()
+        elif len(groups) < 2:
+            settled = push_in_order(parameters)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_concurrent_pushes, thread_name_prefix="sweeper")
+            futures = [self._executor.submit(push_in_order, group) for group in groups.values()]
+            settled = max(f.result() for f in futures)
+        if settle:
+            self.wait_until(settled)
+        return settled
+
+    def wait_until(self, settled):
+        delay = settled - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def prefetch_next(self):
+        """Start pushing the parameters of the next point of the sweep in the background, so that
+        the instruments are set, and settle, while the current point is finished off. The
+        experiment calls this after each point if `prefetch` is set, but Experiment.run() may
+        call it as soon as the current point has been acquired. From then on the parameters
+        hold the values of the next point. Adaptive sweeps cannot be prefetched."""
+        if self._prefetched is not None or self.push_all or not self.axes or self.is_adaptive():
+            return
+        # Find the innermost axis that has not run through all of its points. Those inside it
+        # start over, while outer axes keep their values. If there is none the sweep is over.
+        i = 0
+        while i<len(self.axes) and self.axes[i].step in (0, self.axes[i].num_points()):
+            i += 1
+        if i == len(self.axes):
+            return
+        plan = [(self.axes[j], self.axes[j].step if j == i else 0) for j in range(i,-1,-1)]
+        parameter_values = []
+        for axis, index in plan:
+            if axis.callback_func:
+                axis.callback_func(axis, axis.experiment)
+            parameter_values.extend(axis.parameter_values(axis.points[index]))
+        if self._prefetcher is None:
+            self._prefetcher = ThreadPoolExecutor(1, thread_name_prefix="sweeper-prefetch")
+        self._prefetched = (plan, self._prefetcher.submit(self.set_and_push, parameter_values, False))
+
+    def cancel_prefetch(self):
+        """Forget any prefetched point, once its parameters have been pushed."""
+        if self._prefetched is not None:
+            self._prefetched[1].result()
+            self._prefetched = None
+
+    def num_points(self):
+        """Total number of sweep tuples, not counting any refinements."""
+        return int(np.prod([a.num_points() for a in self.axes]))
+
+    def restart_from(self, index):
+        """Position the axes so that the next update starts from the sweep tuple with the given
+        (flat, outermost axis slowest) index, setting every parameter on the way."""
+        if self.is_adaptive():
+            raise ValueError("Adaptive sweeps cannot be restarted part way through.")
+        self.cancel_prefetch()
+        for a in self.axes:
+            index, a.step = divmod(index, a.num_points())
+            a.done = False
+        if index > 0:
+            raise ValueError("Cannot restart a sweep past its end.")
+        self.push_all = True
+
     def is_adaptive(self):
         return True in [a.refine_func is not None for a in self.axes]
 
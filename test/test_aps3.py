@@ -0,0 +1,142 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import socket
+import threading
+import numpy as np
+
+from auspex.instruments.aps3 import AMC599, APS3, APS3CommunicationManager, CSR_WFA_OFFSET, CSR_WFB_OFFSET, \
+                                    CSR_SEQ_OFFSET, DRAM_WFA_0_LOC, DRAM_WFB_0_LOC, DRAM_SEQ_0_LOC
+
+class FakeAMC599(object):
+    """A loopback stand-in for the AMC599 ethernet core, which keeps its memory in a dictionary
+    and echoes back the header of every datagram written to it."""
+    def __init__(self, bad_echo=False):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port      = self.server.getsockname()[1]
+        self.bad_echo  = bad_echo
+        self.memory    = {}
+        self.datagrams = 0
+        self.thread    = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def recv_words(self, conn, num_words):
+        buf = np.empty(num_words, dtype='>u4')
+        view, received = memoryview(buf).cast('B'), 0
+        while received < len(view):
+            n = conn.recv_into(view[received:])
+            if n == 0:
+                return None
+            received += n
+        return buf
+
+    def serve(self):
+        try:
+            conn, _ = self.server.accept()
+        except OSError:
+            return
+        while True:
+            header = self.recv_words(conn, 2)
+            if header is None:
+                conn.close()
+                return
+            cmd, addr = int(header[0]), int(header[1])
+            num_words = cmd & 0xffff
+            if cmd & 0x80000000:
+                words = self.recv_words(conn, num_words)
+                self.memory.update(zip(range(addr, addr + 4*num_words, 4), words.tolist()))
+                self.datagrams += 1
+                echo = [0x80800000 + num_words, addr + (4 if self.bad_echo else 0)]
+                conn.sendall(np.array(echo, dtype='>u4').tobytes())
+            else:
+                words = [self.memory.get(addr + 4*i, 0) for i in range(num_words)]
+                conn.sendall(np.array([0x10800000 + num_words, addr] + words, dtype='>u4').tobytes())
+
+    def close(self):
+        self.server.close()
+
+class NoSendmsgSocket(object):
+    """Wraps a socket, hiding its sendmsg method."""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __getattr__(self, name):
+        if name == "sendmsg":
+            raise AttributeError(name)
+        return getattr(self.sock, name)
+
+class APS3TransferTestCase(unittest.TestCase):
+
+    def connect(self, **kwargs):
+        self.amc = FakeAMC599(**kwargs)
+        self.board = AMC599()
+        self.board.PORT = self.amc.port
+        self.board.connect(("127.0.0.1", None))
+        return self.board
+
+    def tearDown(self):
+        self.board.disconnect()
+        self.amc.close()
+        APS3CommunicationManager.instances.pop(("127.0.0.1", None), None)
+
+    def test_memory(self):
+        """Check that long writes are split into datagrams and read back whole."""
+        board = self.connect()
+        data = np.random.RandomState(0).randint(0, 2**32, size=3*board.max_datagram_words + 100, dtype=np.uint64)
+        board.write_memory(0x80000000, data)
+        self.assertEqual(self.amc.datagrams, 4)
+        self.assertTrue(np.all(board.read_words(0x80000000, len(data)) == data))
+
+        board.write_memory(0x100, 0xdeadbeef)
+        board.write_memory(0x104, [1, 2, 3])
+        self.assertEqual(board.read_memory(0x100, 1), 0xdeadbeef)
+        self.assertEqual(board.read_memory(0x104, 3), [1, 2, 3])
+
+        # Without sendmsg (as on win32) buffers are sent one by one
+        board.socket = NoSendmsgSocket(board.socket)
+        board.write_memory(0x200, np.arange(100))
+        self.assertEqual(board.read_memory(0x200, 100), list(range(100)))
+
+        for bad in [1.5, [1, 2.5], -1, [0, 2**32], "words"]:
+            with self.assertRaises(ValueError):
+                board.write_memory(0x100, bad)
+
+    def test_bad_echo(self):
+        """Check that a wrong echo from the board is an error."""
+        board = self.connect(bad_echo=True)
+        with self.assertRaises(IOError):
+            board.write_memory(0x80000000, np.arange(1000))
+
+    def test_waveforms(self):
+        """Check the memory layout of waveforms and sequences."""
+        board = self.connect()
+        APS3CommunicationManager.instances[("127.0.0.1", None)] = {'board': board, 'connected': True, 'running': False}
+        aps = APS3(name="Loopback APS3")
+        aps.address, aps.dac = ("127.0.0.1", None), 0
+        aps.write_register(CSR_WFA_OFFSET, DRAM_WFA_0_LOC)
+        aps.write_register(CSR_WFB_OFFSET, DRAM_WFB_0_LOC)
+        aps.write_register(CSR_SEQ_OFFSET, DRAM_SEQ_0_LOC)
+
+        wfA = np.arange(20000, dtype=np.uint16)
+        wfB = (2**16 - 1 - wfA).astype(np.uint16)
+        aps.load_waveforms(wfA, wfB)
+        self.assertEqual(self.amc.memory[DRAM_WFA_0_LOC + 4], (3 << 16) | 2)
+        readA, readB = aps.read_waveforms(len(wfA))
+        self.assertEqual(readA, wfA.tolist())
+        self.assertEqual(readB, wfB.tolist())
+
+        sequence = [0x0123456789abcdef, 0xfedcba9876543210]
+        aps.load_sequence(sequence)
+        self.assertEqual([self.amc.memory[DRAM_SEQ_0_LOC + 4*i] for i in range(4)],
+                         [0x89abcdef, 0x01234567, 0x76543210, 0xfedcba98])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -123,6 +123,54 @@ class AverageTestCase(unittest.TestCase):
         self.assertTrue(np.abs(np.sum(var_data - np.var(orig_data, axis=0, ddof=1))) <= 1e-3)
 
 
+    def test_streaming_variance(self):
+        data_dims = [10, 5, 3]
+        vals      = np.random.random(2*np.prod(data_dims)).view(np.complex128)
+        orig_data = vals.reshape(data_dims)
+
+        for axis_num, axis in enumerate(['repeats', 'trials', 'samples']):
+            for chunk in [2, vals.size]:
+                desc = DataStreamDescriptor(dtype=np.complex128)
+                for name, num in zip(['samples', 'trials', 'repeats'], data_dims[::-1]):
+                    desc.add_axis(DataAxis(name, list(range(num))))
+                sink_stream = DataStream()
+                sink_stream.set_descriptor(desc)
+
+                avgr = Averager(axis, name="TestAverager")
+                avgr.sink.add_input_stream(sink_stream)
+                outputs = {}
+                for oc in [avgr.source, avgr.final_variance, avgr.final_counts]:
+                    outputs[oc.name] = DataStream()
+                    oc.add_output_stream(outputs[oc.name])
+                    Print().sink.add_input_stream(outputs[oc.name])
+                avgr.sink.update_descriptors()
+                avgr.final_init()
+                for stream in outputs.values():
+                    stream.final_init()
+
+                for idx in range(0, vals.size, chunk):
+                    avgr.process_data(vals[idx:idx+chunk])
+
+                results = {}
+                for name, stream in outputs.items():
+                    results[name] = stream.buff_np[:stream.head.value].copy()
+                above = (orig_data.real > 0.5).sum(axis=axis_num).ravel()
+                if chunk < vals.size:
+                    # Chunks that do not line up with the averaging frames: the variances of the real and
+                    # imaginary parts, states below the threshold, and counts pushed frame by frame
+                    expected_var = np.var(orig_data.real, axis=axis_num, ddof=1) + 1j*np.var(orig_data.imag, axis=axis_num, ddof=1)
+                    expected_excited = data_dims[axis_num] - above
+                    counts = results['final_counts'].reshape(int(np.prod(data_dims[:axis_num])), 2, -1)
+                else:
+                    # Whole frames at once: the total variance, states above the threshold, and counts
+                    # pushed for all frames together
+                    expected_var = np.var(orig_data, axis=axis_num, ddof=1)
+                    expected_excited = above
+                    counts = results['final_counts'].reshape(1, 2, -1)
+                self.assertTrue(np.allclose(results['source'], np.mean(orig_data, axis=axis_num).ravel()))
+                self.assertTrue(np.allclose(results['final_variance'], expected_var.ravel()))
+                self.assertTrue(np.all(counts[:, 1].ravel() == expected_excited))
+
     def test_partial_average_runs(self):
         exp             = TestExperiment()
         printer_partial = Print(name="Partial")
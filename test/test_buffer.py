@@ -124,6 +124,25 @@ class BufferTestCase(unittest.TestCase):
         self.assertTrue(data.shape == (3, 4, 5))
         self.assertTrue(np.all(desc['field'] == np.linspace(0,100.0,4)))
 
+    def test_shared_buffer(self):
+        exp = SweptTestExperiment()
+        db  = DataBuffer()
+        exp.set_graph([(exp.voltage, db.sink)])
+        exp.add_sweep(exp.field, np.linspace(0,100.0,4))
+        exp.run_sweeps()
+
+        # The data written by the filter process is read in place
+        data, desc = db.get_data()
+        self.assertTrue(np.shares_memory(data, db.buff))
+        self.assertGreater(db.generation, 0)
+        self.assertEqual(db.header[1], data.size)
+
+        # A snapshot taken while running is a copy
+        db.done.clear()
+        snapshot, _ = db.get_data()
+        self.assertFalse(np.shares_memory(snapshot, db.buff))
+        self.assertTrue(np.all(snapshot == data))
+
     def test_buffer_metadata(self):
         exp = SweptTestExperimentMetadata()
         db  = DataBuffer()
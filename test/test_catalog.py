@@ -0,0 +1,80 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import tempfile
+import os
+import time
+import numpy as np
+
+import auspex.config as config
+config.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment, update_filename
+from auspex.parameter import FloatParameter
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters import WriteToFile
+from auspex.catalog import RunCatalog
+
+class CatalogTestExperiment(Experiment):
+
+    field   = FloatParameter(unit="Oe")
+    voltage = OutputConnector()
+
+    def init_instruments(self):
+        self.field.assign_method(lambda x: None)
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("samples", list(range(5))))
+
+    def run(self):
+        time.sleep(0.001)
+        self.voltage.push(np.random.random(5))
+
+class RunCatalogTestCase(unittest.TestCase):
+
+    def test_allocate(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            # Runs made before the catalog existed are indexed when it is created
+            os.makedirs(os.path.join(tmpdirname, "old-0003.auspex"))
+            self.assertEqual(update_filename(tmpdirname+"/new.auspex", add_date=False), tmpdirname+"/new-0004")
+            self.assertEqual(update_filename(tmpdirname+"/new.auspex", add_date=False), tmpdirname+"/new-0005")
+            self.assertEqual(update_filename(tmpdirname+"/old.auspex", add_date=False, resume=True), tmpdirname+"/old-0003")
+            # Runs made behind the catalog's back are skipped
+            os.makedirs(os.path.join(tmpdirname, "new-0006.auspex"))
+            self.assertEqual(update_filename(tmpdirname+"/new.auspex", add_date=False), tmpdirname+"/new-0007")
+
+            catalog = RunCatalog(tmpdirname)
+            self.assertEqual([r[:2] for r in catalog.runs()], [("old", 3), ("new", 4), ("new", 5), ("new", 7)])
+            self.assertEqual(catalog.find(5), tmpdirname+"/new-0005.auspex")
+            self.assertIsNone(catalog.find(6))
+            catalog.rebuild()
+            self.assertEqual([r[:2] for r in catalog.runs()], [("old", 3), ("new", 6)])
+            catalog.close()
+
+    def test_record_datasets(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            exp = CatalogTestExperiment()
+            wr1 = WriteToFile(tmpdirname+"/test_catalog.auspex", groupname="q1")
+            wr2 = WriteToFile(tmpdirname+"/test_catalog.auspex", groupname="q2", datasetname="raw")
+            exp.set_graph([(exp.voltage, wr1.sink), (exp.voltage, wr2.sink)])
+            exp.add_sweep(exp.field, np.linspace(0, 1, 3))
+            exp.run_sweeps()
+
+            catalog = RunCatalog.existing(tmpdirname)
+            run = catalog.find(0)
+            self.assertEqual(run, tmpdirname+"/test_catalog-0000.auspex")
+            datasets = catalog.datasets(run)
+            self.assertEqual(set(datasets), {"q1", "q2"})
+            self.assertEqual(datasets["q2"]["raw"]["shape"], (3, 5))
+            self.assertEqual([a["name"] for a in datasets["q1"]["data"]["axes"]], ["field", "samples"])
+            self.assertEqual(datasets["q1"]["data"]["axes"][0]["unit"], "Oe")
+            catalog.close()
+
+if __name__ == '__main__':
+    unittest.main()
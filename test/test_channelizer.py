@@ -0,0 +1,86 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import time
+import numpy as np
+import scipy.signal
+
+import auspex.config as config
+config.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters import Channelizer, DataBuffer
+from auspex.filters.channelizer import PolyphaseChannelizer
+
+time_step   = 4e-9
+num_samples = 512
+time_pts    = time_step*np.arange(num_samples)
+
+def tone(freq, amplitude=1.0, num_records=1):
+    return np.tile(amplitude*np.cos(2*np.pi*freq*time_pts), num_records)
+
+class TestExperiment(Experiment):
+
+    voltage = OutputConnector()
+
+    num_records = 6
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("time", time_pts))
+        self.voltage.add_axis(DataAxis("records", list(range(self.num_records))))
+
+    def run(self):
+        time.sleep(0.01)
+        self.voltage.push(tone(10e6, 0.5, self.num_records))
+
+class ChannelizerTestCase(unittest.TestCase):
+
+    def make_channelizer(self, frequencies):
+        taps = scipy.signal.firwin(64, 2.5e6, fs=1/time_step)
+        return PolyphaseChannelizer(taps, 8, time_pts, frequencies)
+
+    def test_streaming_state(self):
+        data    = tone(10e6, num_records=5) + 0.1*np.random.randn(5*num_samples)
+        whole   = self.make_channelizer([10e6]).process(data)
+        chan    = self.make_channelizer([10e6])
+        chunked = np.concatenate([chan.process(data[i:i+301]) for i in range(0, data.size, 301)])
+        self.assertEqual(whole.shape, (5*num_samples//8, 1))
+        self.assertTrue(np.allclose(whole, chunked, atol=1e-5))
+
+    def test_multiple_frequencies(self):
+        data = tone(10e6, 0.3, num_records=2) + tone(-30e6, 0.7, num_records=2)
+        out  = self.make_channelizer([10e6, 30e6]).process(data).reshape(2, -1, 2)
+        # Past the filter transient each channel recovers the amplitude of its own tone
+        self.assertTrue(np.allclose(np.abs(out[:, 16:, 0]), 0.3, atol=0.02))
+        self.assertTrue(np.allclose(np.abs(out[:, 16:, 1]), 0.7, atol=0.02))
+
+    def test_fir_backend(self):
+        exp  = TestExperiment()
+        chan = Channelizer(frequency=10e6, bandwidth=5e6, decimation_factor=8, backend="fir")
+        buff = DataBuffer()
+        exp.set_graph([(exp.voltage, chan.sink), (chan.source, buff.sink)])
+        exp.run_sweeps()
+        self.assertEqual(buff.output_data.shape, (exp.num_records, num_samples//8))
+        self.assertTrue(np.allclose(np.abs(buff.output_data[:, 16:]), 0.5, atol=0.02))
+
+    def test_fir_frequencies(self):
+        exp  = TestExperiment()
+        chan = Channelizer(frequencies=[10e6, 30e6], bandwidth=5e6, decimation_factor=8)
+        buff = DataBuffer()
+        exp.set_graph([(exp.voltage, chan.sink), (chan.source, buff.sink)])
+        exp.run_sweeps()
+        self.assertEqual(chan.backend, "fir")
+        self.assertEqual([a.name for a in buff.descriptor.axes], ["records", "frequency", "time"])
+        self.assertEqual(buff.output_data.shape, (exp.num_records, 2, num_samples//8))
+        self.assertTrue(np.allclose(np.abs(buff.output_data[:, 0, 16:]), 0.5, atol=0.02))
+        self.assertTrue(np.allclose(np.abs(buff.output_data[:, 1, 16:]), 0.0, atol=0.02))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,8 @@ import auspex.config as config
 config.auspex_dummy_mode = True
 
 from auspex.experiment import Experiment
-from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
+from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, InputConnector, OutputConnector
+from auspex.filters.filter import Filter
 from auspex.filters.debug import Print, Passthrough
 from auspex.filters.correlator import Correlator
 from auspex.filters.io import DataBuffer
@@ -58,6 +59,56 @@ class CorrelatorExperiment(Experiment):
             time.sleep(0.002)
             logger.debug("Idx_1: %d, Idx_2: %d", self.idx_1, self.idx_2)
 
+class MultiCorrelatorExperiment(Experiment):
+
+    chan1 = OutputConnector()
+    chan2 = OutputConnector()
+    chan3 = OutputConnector()
+    chan4 = OutputConnector()
+
+    samples = 1000
+    vals    = np.random.random((4, samples))
+
+    def init_streams(self):
+        for chan in self.channels():
+            chan.add_axis(DataAxis("samples", list(range(self.samples))))
+
+    def channels(self):
+        return [self.chan1, self.chan2, self.chan3, self.chan4]
+
+    def run(self):
+        # Each channel arrives in chunks of its own sizes
+        for k, chan in enumerate(self.channels()):
+            edges = np.unique(np.r_[0, np.random.randint(0, self.samples, 10*(k+1)), self.samples])
+            for start, stop in zip(edges[:-1], edges[1:]):
+                chan.push(self.vals[k, start:stop])
+
+class Recorder(Filter):
+    """Records what the aligned run loop hands over."""
+    sink   = InputConnector()
+    source = OutputConnector()
+
+    def __init__(self, **kwargs):
+        super(Recorder, self).__init__(**kwargs)
+        self.sink.max_input_streams = 10
+        self.chunks = []
+        self.events = []
+
+    def process_aligned(self, chunks):
+        self.chunks.append([c.copy() for c in chunks])
+
+    def process_message(self, msg):
+        self.events.append((sum(c[0].size for c in self.chunks), msg['event_type']))
+
+class Merger(Filter):
+    """Takes several streams without saying how to combine them."""
+    sink   = InputConnector()
+    source = OutputConnector()
+
+    def __init__(self, **kwargs):
+        super(Merger, self).__init__(**kwargs)
+        self.sink.max_input_streams = 2
+
 class CorrelatorTestCase(unittest.TestCase):
 
     def test_correlator(self):
@@ -76,6 +127,49 @@ class CorrelatorTestCase(unittest.TestCase):
         expected_data = exp.vals*exp.vals
         self.assertAlmostEqual(np.sum(corr_data), np.sum(expected_data), places=0)
 
+    def test_many_streams(self):
+        exp   = MultiCorrelatorExperiment()
+        corr  = Correlator(name='corr')
+        buff  = DataBuffer()
+        edges = [(chan, corr.sink) for chan in exp.channels()] + [(corr.source, buff.sink)]
+        exp.set_graph(edges)
+        exp.run_sweeps()
+        self.assertTrue(np.allclose(buff.output_data, np.prod(exp.vals, axis=0)))
+
+    def test_unaligned_filter(self):
+        exp   = CorrelatorExperiment()
+        merge = Merger()
+        with self.assertRaises(ValueError):
+            exp.set_graph([(exp.chan1, merge.sink), (exp.chan2, merge.sink)])
+
+    def test_aligned_events(self):
+        rec = Recorder()
+        streams = []
+        for _ in range(3):
+            desc = DataStreamDescriptor(dtype=np.float64)
+            desc.add_axis(DataAxis("samples", list(range(12))))
+            stream = DataStream()
+            stream.set_descriptor(desc)
+            stream.final_init()
+            rec.sink.add_input_stream(stream)
+            streams.append(stream)
+
+        data = np.arange(12, dtype=np.float64)
+        for k, stream in enumerate(streams):
+            stream.push(data[:4+k])
+            stream.push(data[4+k:6])
+            stream.push_event("refined", ("samples", False, []))
+            stream.push(data[6:])
+            # push_event would close the queue, which this process is also reading from
+            stream.queue.put({"type": "event", "event_type": "done", "data": None, "position": 12})
+        rec.main()
+
+        self.assertTrue(rec.done.is_set())
+        # The event is acted on once, at the same point in every stream
+        self.assertEqual(rec.events, [(6, "refined")])
+        for k in range(3):
+            self.assertTrue(np.all(np.concatenate([c[k] for c in rec.chunks]) == data))
+        self.assertTrue(all(c[0].size == c[1].size == c[2].size for c in rec.chunks))
 
 if __name__ == '__main__':
     unittest.main()
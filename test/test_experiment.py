@@ -9,6 +9,7 @@
 import unittest
 
 import time
+import threading
 import numpy as np
 
 from copy import copy, deepcopy
@@ -20,7 +21,7 @@ from auspex.instruments.instrument import SCPIInstrument, StringCommand, FloatCo
 from auspex.experiment import Experiment
 from auspex.parameter import FloatParameter
 from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
-from auspex.filters import Print, Passthrough
+from auspex.filters import Print, Passthrough, Averager, DataBuffer
 from auspex.log import logger
 
 class TestInstrument1(SCPIInstrument):
@@ -198,5 +199,76 @@ class ExperimentTestCase(unittest.TestCase):
         exp.set_graph(edges)
         exp.run_sweeps()
 
+    def test_fused_chain(self):
+        exp    = TestExperiment()
+        pt1    = Passthrough(name="One")
+        pt2    = Passthrough(name="Two")
+        avgr   = Averager('samples', name="Averager")
+        buff   = DataBuffer(name="Buffer")
+        direct = DataBuffer(name="Direct")
+
+        edges = [(exp.chan1, pt1.sink), (pt1.source, pt2.sink), (pt2.source, avgr.sink),
+                 (avgr.source, buff.sink), (exp.chan1, direct.sink)]
+
+        exp.set_graph(edges)
+        exp.add_sweep(exp.freq_1, np.linspace(0, 1, 4))
+        exp.run_sweeps()
+
+        # Every stage downstream of the first passthrough runs in its process, while the
+        # direct buffer hangs off the experiment and so gets its own.
+        self.assertEqual(pt1.fused_filters, [pt2, avgr, buff])
+        self.assertEqual([s.fused for s in exp.graph.edges], [False, True, True, True, False])
+        self.assertTrue(np.allclose(buff.output_data, direct.output_data.mean(axis=-1)))
+
+    def test_concurrent_instruments(self):
+        exp   = TestExperiment()
+        times = {}
+        def slow_setup(instr):
+            start = time.time()
+            time.sleep(0.2)
+            times[instr] = (start, time.time())
+
+        # Instruments are set up one at a time, from this thread, unless asked otherwise
+        threads = set()
+        exp.for_each_instrument(lambda instr: threads.add(threading.current_thread()))
+        self.assertEqual(threads, {threading.current_thread()})
+        exp.for_each_instrument(slow_setup)
+        self.assertGreaterEqual(max(t[1] for t in times.values()) - min(t[0] for t in times.values()), 0.6)
+        exp.for_each_instrument(slow_setup, dependencies={'fake_instr_1': ['fake_instr_3']})
+        self.assertGreaterEqual(times[exp.fake_instr_1][0], times[exp.fake_instr_3][1])
+        with self.assertRaises(ValueError):
+            exp.for_each_instrument(slow_setup, dependencies={'fake_instr_1': ['fake_instr_1']})
+
+        exp.concurrent_instruments = True
+        exp.for_each_instrument(slow_setup)
+        self.assertEqual(len(times), 3)
+        self.assertLess(max(t[1] for t in times.values()) - min(t[0] for t in times.values()), 0.35)
+
+        # Instruments wait for those they depend on
+        exp.instrument_dependencies = {'fake_instr_3': ['fake_instr_1', 'fake_instr_2']}
+        exp.for_each_instrument(slow_setup)
+        self.assertGreaterEqual(times[exp.fake_instr_3][0], times[exp.fake_instr_1][1])
+        self.assertGreaterEqual(times[exp.fake_instr_3][0], times[exp.fake_instr_2][1])
+        exp.for_each_instrument(slow_setup, dependencies={'fake_instr_1': ['fake_instr_3']})
+        self.assertGreaterEqual(times[exp.fake_instr_1][0], times[exp.fake_instr_3][1])
+
+        exp.instrument_dependencies = {'fake_instr_1': ['fake_instr_2'], 'fake_instr_2': ['fake_instr_1']}
+        with self.assertRaises(ValueError):
+            exp.for_each_instrument(slow_setup)
+
+    def test_instrument_failure(self):
+        exp     = TestExperiment()
+        started = []
+        def failing_setup(instr):
+            started.append(instr)
+            if instr is exp.fake_instr_1:
+                raise RuntimeError("No such instrument")
+
+        exp.concurrent_instruments  = True
+        exp.instrument_dependencies = {'fake_instr_3': ['fake_instr_1']}
+        with self.assertRaises(RuntimeError):
+            exp.for_each_instrument(failing_setup)
+        self.assertNotIn(exp.fake_instr_3, started)
+
 if __name__ == '__main__':
     unittest.main()
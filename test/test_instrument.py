@@ -16,7 +16,22 @@ from auspex.instruments.instrument import SCPIInstrument, StringCommand, FloatCo
 class TestInstrument(SCPIInstrument):
 	frequency     = FloatCommand(get_string="frequency?", set_string="frequency {:g}", value_range=(0.1, 10))
 	serial_number = IntCommand(get_string="serial?")
-	mode          = StringCommand(name="enumerated mode", scpi_string=":mode", allowed_values=["A", "B", "C"])
+	mode          = StringCommand(name="enumerated mode", scpi_string=":mode", allowed_values=["A", "B", "C"], aliases=["state"])
+	power         = FloatCommand(scpi_string="power{channel:d}", additional_args=["channel"])
+	temperature   = FloatCommand(scpi_string="temperature", volatile=True)
+
+class RecordingInterface(object):
+	"""Answers every query with 1, and keeps track of the traffic."""
+	def __init__(self):
+		self.writes  = []
+		self.queries = []
+
+	def write(self, string):
+		self.writes.append(string)
+
+	def query(self, string):
+		self.queries.append(string)
+		return "1"
 
 class InstrumentTestCase(unittest.TestCase):
 	"""
@@ -60,5 +75,69 @@ class InstrumentTestCase(unittest.TestCase):
 		with self.assertRaises(TypeError):
 			self.instrument.nonexistent_property = 16
 
+class InstrumentCacheTestCase(unittest.TestCase):
+	"""
+	Tests the cache of instrument settings
+	"""
+
+	def setUp(self):
+		self.instrument = TestInstrument("DUMMY::RESOURCE")
+		self.instrument.connect()
+		self.instrument.interface = RecordingInterface()
+		self.instrument.enable_cache()
+
+	def test_redundant_traffic(self):
+		"""Check that settings are only written once, and read back from the cache."""
+		instr = self.instrument
+		instr.frequency = 5
+		instr.frequency = 5
+		self.assertEqual(instr.frequency, 5)
+		instr.mode = "A"
+		self.assertEqual(instr.state, "A")
+		instr.state = "A"
+		instr.set_power(3, channel=1)
+		instr.set_power(3, channel=2)
+		instr.set_power(3, channel=1)
+		self.assertEqual(instr.get_power(channel=2), 3)
+		self.assertEqual(instr.interface.writes, ["frequency 5", ":mode A", "power1 3.000000E+00", "power2 3.000000E+00"])
+		self.assertEqual(instr.interface.queries, [])
+
+		# Values that are read are cached too
+		instr.invalidate("frequency")
+		self.assertEqual(instr.frequency, 1)
+		self.assertEqual(instr.frequency, 1)
+		self.assertEqual(instr.interface.queries, ["frequency?"])
+
+	def test_volatile(self):
+		"""Check that volatile and get-only commands always reach the instrument."""
+		instr = self.instrument
+		instr.temperature = 4
+		instr.temperature = 4
+		self.assertEqual(instr.temperature, 1)
+		self.assertEqual(instr.serial_number, 1)
+		self.assertEqual(instr.serial_number, 1)
+		instr.mark_volatile("frequency")
+		instr.frequency = 5
+		instr.frequency = 5
+		self.assertEqual(len(instr.interface.writes), 4)
+		self.assertEqual(len(instr.interface.queries), 3)
+
+	def test_resync(self):
+		"""Check that resync reads the cached settings back from the instrument."""
+		instr = self.instrument
+		instr.frequency = 5
+		instr.set_power(3, channel=2)
+		instr.resync()
+		self.assertEqual(sorted(instr.interface.queries), ["frequency?", "power2?;"])
+		self.assertEqual(instr.frequency, 1)
+		self.assertEqual(instr.get_power(channel=2), 1)
+		self.assertEqual(len(instr.interface.queries), 2)
+
+		# Without the cache, every access reaches the instrument
+		instr.enable_cache(False)
+		instr.frequency = 1
+		instr.frequency = 1
+		self.assertEqual(instr.interface.writes, ["frequency 5", "power2 3.000000E+00", "frequency 1", "frequency 1"])
+
 if __name__ == '__main__':
 	unittest.main()
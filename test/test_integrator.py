@@ -0,0 +1,58 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import time
+import numpy as np
+
+import auspex.config as config
+config.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters import KernelIntegrator, DataBuffer
+
+time_step   = 4e-9
+num_samples = 128
+num_records = 10
+time_pts    = time_step*np.arange(num_samples)
+data        = np.random.randn(num_records, num_samples)
+
+class IntegratorTestExperiment(Experiment):
+
+    voltage = OutputConnector()
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("time", time_pts))
+        self.voltage.add_axis(DataAxis("records", list(range(num_records))))
+
+    def run(self):
+        # Chunks that split records
+        for chunk in np.array_split(data.ravel(), 7):
+            time.sleep(0.002)
+            self.voltage.push(chunk)
+
+class KernelIntegratorTestCase(unittest.TestCase):
+
+    def test_multiple_kernels(self):
+        custom  = np.exp(-time_pts[:100]/100e-9)
+        kernels = [{'box_car_start': 0, 'box_car_stop': 202e-9, 'demod_frequency': 10e6}, custom]
+
+        exp     = IntegratorTestExperiment()
+        ki      = KernelIntegrator(kernels=kernels)
+        buffers = [DataBuffer(), DataBuffer()]
+        exp.set_graph([(exp.voltage, ki.sink), (ki.source, buffers[0].sink), (ki.source_1, buffers[1].sink)])
+        exp.run_sweeps()
+
+        box_car = np.zeros(num_samples, dtype=np.complex128)
+        box_car[:51] = np.exp(2j*np.pi*10e6*time_pts[:51])
+        self.assertTrue(np.allclose(buffers[0].output_data, np.inner(data, box_car)))
+        self.assertTrue(np.allclose(buffers[1].output_data, np.inner(data[:, :100], custom)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# Copyright 2017 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import time
+import socket
+import threading
+import numpy as np
+
+from auspex.instruments.prologix import PrologixAdapter, PrologixSocketResource
+from pyvisa.util import to_ieee_block
+
+class FakePrologix(object):
+    """A Prologix GPIB-ETHERNET controller with a few instruments behind it, which keeps
+    track of the commands it receives."""
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(4)
+        self.port        = self.server.getsockname()[1]
+        self.connections = 0
+        self.lines       = []
+        self.values      = {}
+        self.thread      = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def respond(self, gpib, line):
+        if line == "*IDN?":
+            return f"Instrument {gpib}"
+        elif line == "DATA?":
+            return ",".join(["1.5"]*2000)
+        elif line == "BIN?":
+            return to_ieee_block(np.arange(100, dtype=np.float32)).decode('latin-1')
+        elif line == "SLOW?":
+            return ("1.234", "5\r\n") # The rest of the response comes late
+        elif line == "VALUE?":
+            return self.values.get(gpib, "")
+        elif line.startswith("VALUE "):
+            self.values[gpib] = line.split()[1]
+        return None
+
+    def handle(self, conn):
+        buf, gpib, pending = b"", None, None
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                return
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                line = line.decode('latin-1').strip("\r")
+                self.lines.append(line)
+                if line == "++ver":
+                    conn.sendall(b"Prologix GPIB-ETHERNET Controller version 01.06.06.00\r\n")
+                elif line.startswith("++addr"):
+                    gpib = int(line.split()[1])
+                elif line == "++read eoi":
+                    if isinstance(pending, tuple):
+                        conn.sendall(pending[0].encode('latin-1'))
+                        time.sleep(0.5)
+                        conn.sendall(pending[1].encode('latin-1'))
+                    else:
+                        conn.sendall((pending or "").encode('latin-1') + b"\r\n")
+                    pending = None
+                elif not line.startswith("++"):
+                    pending = self.respond(gpib, line)
+
+    def close(self):
+        self.server.close()
+
+class PrologixTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.prologix = FakePrologix()
+        self.port = PrologixAdapter.port
+        PrologixAdapter.port = self.prologix.port
+
+    def tearDown(self):
+        PrologixAdapter.port = self.port
+        for adapter in list(PrologixAdapter._adapters.values()):
+            adapter.users = 0
+            adapter.release()
+        self.prologix.close()
+
+    def connect(self, *addresses):
+        resources = [PrologixSocketResource(ipaddr="127.0.0.1", gpib=gpib) for gpib in addresses]
+        for resource in resources:
+            resource.connect()
+        return resources
+
+    def test_shared_adapter(self):
+        """Check that instruments share a connection, which only switches address when it must."""
+        one, two = self.connect(1, 2)
+        self.assertIs(one.adapter, two.adapter)
+        self.assertEqual(self.prologix.connections, 1)
+
+        del self.prologix.lines[:]
+        one.write("VALUE 3")
+        one.write("VALUE 4")
+        two.write("VALUE 5")
+        self.assertEqual(one.query("VALUE?"), "4")
+        self.assertEqual(two.query("VALUE?"), "5")
+        self.assertEqual([l for l in self.prologix.lines if l.startswith("++addr")], ["++addr 1", "++addr 2", "++addr 1", "++addr 2"])
+
+        one.close()
+        self.assertEqual(two.query("*IDN?"), "Instrument 2")
+        two.close()
+        self.assertNotIn("127.0.0.1", PrologixAdapter._adapters)
+
+    def test_long_responses(self):
+        """Check that responses longer than a single read come back whole."""
+        one, = self.connect(1)
+        self.assertEqual(one.query_ascii_values("DATA?"), [1.5]*2000)
+        self.assertTrue(np.all(one.query_binary_values("BIN?", datatype='f') == np.arange(100)))
+        self.assertEqual(one.query("*IDN?"), "Instrument 1")
+        one.close()
+
+    def test_timeouts(self):
+        """Check that each instrument has its own timeout, and that what is left of a response
+        that timed out isn't taken as the start of the next one."""
+        one, = self.connect(1)
+        two = PrologixSocketResource(ipaddr="127.0.0.1", gpib=2)
+        two.timeout = 0.2
+        two.connect()
+        start = time.time()
+        with self.assertRaises(socket.timeout):
+            two.query("SLOW?")
+        self.assertLess(time.time() - start, 0.4)
+        time.sleep(0.6)
+        self.assertEqual(one.query("*IDN?"), "Instrument 1")
+
+        # The same wait is fine for an instrument with a longer timeout
+        self.assertEqual(one.query("SLOW?"), "1.2345")
+        self.assertEqual(one.adapter.timeout, 5)
+        self.assertEqual(two.query("*IDN?"), "Instrument 2")
+        one.close()
+        two.close()
+
+    def test_threads(self):
+        """Check that instruments used from several threads get their own responses."""
+        resources = self.connect(1, 2, 3, 4)
+        errors = []
+        def hammer(resource):
+            for i in range(50):
+                resource.write(f"VALUE {i}")
+                if resource.query("VALUE?") != str(i) or resource.query("*IDN?") != f"Instrument {resource.gpib}":
+                    errors.append(resource.gpib)
+        threads = [threading.Thread(target=hammer, args=(r,)) for r in resources]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        for resource in resources:
+            resource.close()
+
+if __name__ == '__main__':
+    unittest.main()
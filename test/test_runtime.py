@@ -0,0 +1,132 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import time
+import numpy as np
+
+import auspex.config as config
+config.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.parameter import FloatParameter
+from auspex.stream import DataAxis, InputConnector, OutputConnector
+from auspex.filters import Averager, DataBuffer, FilterRuntime, Filter
+from auspex.log import logger
+
+class RuntimeTestExperiment(Experiment):
+
+    # Parameters
+    freq = FloatParameter(unit="Hz")
+
+    # DataStreams
+    chan1 = OutputConnector()
+
+    # Constants
+    samples = 4
+    trials  = 6
+
+    def init_instruments(self):
+        self.freq.assign_method(lambda x: logger.debug("Set: {}".format(x)))
+
+    def init_streams(self):
+        self.chan1.add_axis(DataAxis("samples", list(range(self.samples))))
+        self.chan1.add_axis(DataAxis("trials", list(range(self.trials))))
+
+    def run(self):
+        time.sleep(0.002)
+        self.chan1.push(self.freq.value + np.arange(self.samples*self.trials, dtype=np.float64))
+
+class Failing(Filter):
+    """Takes all of its data and then fails."""
+    sink = InputConnector()
+
+    def process_data(self, data):
+        pass
+
+    def on_done(self):
+        raise ValueError("Bad data")
+
+def run_experiment(runtime):
+    exp  = RuntimeTestExperiment()
+    avgr = Averager('trials', name="Averager")
+    raw  = DataBuffer(name="Raw")
+    mean = DataBuffer(name="Mean")
+    exp.set_graph([(exp.chan1, avgr.sink), (exp.chan1, raw.sink), (avgr.source, mean.sink)])
+    exp.add_sweep(exp.freq, np.linspace(0, 4, 5))
+    exp.runtime = runtime
+    # Run every filter in a worker of its own
+    exp.fuse_filters = False
+    exp.run_sweeps()
+    return exp, raw, mean
+
+class FilterRuntimeTestCase(unittest.TestCase):
+
+    def test_reuse_workers(self):
+        runtime = FilterRuntime(num_workers=4, num_channels=8, channel_bytes=2**16).start()
+        try:
+            pids = [s.process.pid for s in runtime.slots]
+            for _ in range(2):
+                exp, raw, mean = run_experiment(runtime)
+                self.assertEqual(len(exp.pooled_nodes), 3)
+                expected = np.linspace(0, 4, 5)[:,None,None] + np.arange(24).reshape(6,4)
+                self.assertTrue(np.all(raw.output_data == expected))
+                self.assertTrue(np.allclose(mean.output_data, expected.mean(axis=1)))
+                # The filters get their own, finished, events back
+                self.assertTrue(all(n.done.is_set() for n in exp.other_nodes))
+                self.assertFalse(runtime.leased)
+            self.assertEqual(pids, [s.process.pid for s in runtime.slots])
+        finally:
+            runtime.stop()
+
+    def test_fallback_when_busy(self):
+        runtime = FilterRuntime(num_workers=1, num_channels=8, channel_bytes=2**16).start()
+        try:
+            exp, raw, mean = run_experiment(runtime)
+            self.assertEqual(len(exp.pooled_nodes), 1)
+            expected = np.linspace(0, 4, 5)[:,None,None] + np.arange(24).reshape(6,4)
+            self.assertTrue(np.all(raw.output_data == expected))
+        finally:
+            runtime.stop()
+
+    def test_unshippable_filter(self):
+        runtime = FilterRuntime(num_workers=4, num_channels=8, channel_bytes=2**16).start()
+        try:
+            exp  = RuntimeTestExperiment()
+            buff = DataBuffer(name="Raw")
+            # A lambda cannot follow the filter into a worker
+            buff.transform = lambda x: x
+            exp.set_graph([(exp.chan1, buff.sink)])
+            exp.add_sweep(exp.freq, np.linspace(0, 4, 5))
+            exp.runtime = runtime
+            exp.run_sweeps()
+            self.assertEqual(exp.pooled_nodes, [])
+            self.assertEqual(buff.output_data.size, 5*24)
+            self.assertTrue(all(s.head.value == s.tail.value == 0 for s in exp.graph.edges))
+        finally:
+            runtime.stop()
+
+    def test_worker_failure(self):
+        runtime = FilterRuntime(num_workers=2, num_channels=8, channel_bytes=2**16).start()
+        try:
+            exp  = RuntimeTestExperiment()
+            fail = Failing(name="Failing")
+            exp.set_graph([(exp.chan1, fail.sink)])
+            exp.add_sweep(exp.freq, np.linspace(0, 4, 5))
+            exp.runtime = runtime
+            with self.assertRaises(ValueError):
+                exp.run_sweeps()
+            self.assertEqual(exp.pooled_nodes, [fail])
+            # The runtime is ready for the next experiment
+            exp, raw, mean = run_experiment(runtime)
+            self.assertEqual(len(exp.pooled_nodes), 2)
+        finally:
+            runtime.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,12 @@
+import unittest
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import auspex.config as config
 config.auspex_dummy_mode = True
 from auspex.filters import SingleShotMeasurement as SSM
+from auspex.filters.singleshot import binned_kde
+from scipy.stats import gaussian_kde
 
 def generate_fake_data(alpha, phi, sigma, N = 5000, plot=False):
 
@@ -38,6 +42,61 @@ def generate_fake_data(alpha, phi, sigma, N = 5000, plot=False):
         plt.show()
     return gnd, ex
 
+class SingleShotTestCase(unittest.TestCase):
+
+    def test_streaming_statistics(self):
+        gnd, ex = generate_fake_data(3, np.pi/5, 1.6, N=2000)
+        ss = SSM(save_kernel=False, optimal_integration_time=True, zero_mean=False, set_threshold=True)
+        ss.ground_data = gnd
+        ss.excited_data = ex
+        ss.compute_filter()
+        expected = ss.fidelity_result
+
+        # Interleave ground and excited shots, and feed them through in uneven chunks
+        ss.record_length, ss.num_averages, ss.num_segments = gnd.shape[0], gnd.shape[1], 2
+        ss.final_init()
+        data = np.stack([gnd, ex], axis=1).ravel(order='F')
+        for chunk in np.array_split(data, 37):
+            ss.process_data(chunk)
+        self.assertAlmostEqual(ss.fidelity_result, expected)
+        self.assertTrue(np.all(ss.pdf_data["Ground I PDF"] >= 0))
+        self.assertGreater(np.real(expected), 0.9)
+
+    def test_binned_kde(self):
+        """Check the binned KDE against scipy's gaussian_kde, which it replaced."""
+        rng = np.random.RandomState(0)
+        for samples in [rng.normal(1.0, 2.0, 5000), np.concatenate([rng.normal(-3, 1, 2000), rng.normal(3, 1, 1000)])]:
+            grid = np.linspace(samples.min(), samples.max(), 100)
+            expected = gaussian_kde(samples)(grid)
+            self.assertLess(np.max(np.abs(binned_kde(samples, grid) - expected)), 0.01*np.max(expected))
+
+    def test_fidelity_with_gaussian_kde(self):
+        """Check that the I fidelity is what it was when the distributions came from gaussian_kde."""
+        gnd, ex = generate_fake_data(1.5, np.pi/5, 1.6, N=2000)
+        ss = SSM(save_kernel=False, optimal_integration_time=False, zero_mean=False, set_threshold=True)
+        ss.ground_data = gnd
+        ss.excited_data = ex
+        ss.compute_filter()
+
+        ground_I = np.real(np.dot(ss.kernel, gnd))
+        excited_I = np.real(np.dot(ss.kernel, ex))
+        bins = ss.pdf_data["I Bins"]
+        g_PDF = gaussian_kde(ground_I)(bins)
+        e_PDF = gaussian_kde(excited_I)(bins)
+        max_F_I = 1 - 0.5 * (1 - 0.5 * (bins[2] - bins[1]) * np.sum(np.abs(g_PDF - e_PDF)))
+        self.assertLess(np.max(np.abs(ss.pdf_data["Ground I PDF"] - g_PDF)), 0.01*np.max(g_PDF))
+        self.assertAlmostEqual(ss.pdf_data["Max I Fidelity"], max_F_I, delta=0.005)
+        self.assertLess(ss.pdf_data["Max I Fidelity"], 0.99)
+
+    def test_many_shots(self):
+        N = 200000
+        noise = lambda: 1.6*(np.random.randn(16, N) + 1j*np.random.randn(16, N))
+        ss = SSM(save_kernel=False, optimal_integration_time=True, zero_mean=False, set_threshold=True)
+        ss.ground_data = 3*np.exp(1j*np.pi/5) + noise()
+        ss.excited_data = -3*np.exp(1j*np.pi/5) + noise()
+        start = time.time()
+        ss.compute_filter()
+        self.assertLess(time.time() - start, 1.0)
 
 if __name__ == "__main__":
     gnd, ex = generate_fake_data(3, np.pi/5, 1.6, plot=True)
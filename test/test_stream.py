@@ -0,0 +1,281 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import threading
+import itertools
+import socket
+import struct
+import time
+import numpy as np
+
+import auspex.config as config
+config.auspex_dummy_mode = True
+
+from auspex.stream import DataStream, DataAxis, SweepAxis, DataStreamDescriptor, StreamAligner, OutputConnector
+from auspex.instruments.instrument import SocketReceiver
+from auspex.parameter import FloatParameter
+
+def make_stream(num_points, dtype=np.float64, buffer_size=None):
+    desc = DataStreamDescriptor(dtype=dtype)
+    desc.add_axis(DataAxis("samples", list(range(num_points))))
+    stream = DataStream(name="test")
+    stream.set_descriptor(desc)
+    if buffer_size:
+        stream.max_buffer_size = buffer_size
+    stream.final_init()
+    return stream
+
+def drain(stream, num_points):
+    received = []
+    total = 0
+    while total < num_points:
+        stream.queue.get(timeout=5.0)
+        data = stream.pop()
+        if data is None:
+            continue
+        received.append(data.copy())
+        total += data.size
+        stream.release()
+    return np.concatenate(received)
+
+class RingBufferTestCase(unittest.TestCase):
+
+    def test_wraparound(self):
+        stream = make_stream(1000, buffer_size=7)
+        data = np.arange(20, dtype=np.float64)
+        out = []
+        for i in range(0, 20, 5):
+            stream.push(data[i:i+5])
+            out.append(drain(stream, 5))
+        self.assertTrue(np.all(np.concatenate(out) == data))
+
+    def test_zero_copy_view(self):
+        stream = make_stream(10)
+        stream.push(np.arange(4, dtype=np.float64))
+        stream.queue.get(timeout=5.0)
+        view = stream.pop()
+        self.assertTrue(np.shares_memory(view, stream.buff_np))
+        stream.release()
+        self.assertIsNone(stream.pop())
+
+    def test_native_dtype(self):
+        for dtype in [np.int16, np.float32, np.complex64, np.complex128]:
+            stream = make_stream(10, dtype=dtype)
+            data = (np.arange(10) + (1j*np.arange(10) if np.issubdtype(dtype, np.complexfloating) else 0)).astype(dtype)
+            stream.push(data)
+            stream.queue.get(timeout=5.0)
+            view = stream.pop()
+            self.assertEqual(view.dtype, dtype)
+            self.assertEqual(stream.buff_np.nbytes, 10*np.dtype(dtype).itemsize)
+            self.assertTrue(np.shares_memory(view, stream.buff_np))
+            self.assertTrue(np.all(view == data))
+            stream.release()
+
+    def test_backpressure(self):
+        stream = make_stream(1000, buffer_size=16)
+        data   = np.random.random(1000)
+        result = {}
+        consumer = threading.Thread(target=lambda: result.update(out=drain(stream, data.size)))
+        consumer.start()
+        for chunk in np.split(data, 100):
+            stream.push(chunk)
+        consumer.join()
+        self.assertTrue(np.all(result['out'] == data))
+
+    def test_push_larger_than_buffer(self):
+        stream = make_stream(100, dtype=np.complex128, buffer_size=8)
+        data   = np.random.random(100) + 1j*np.random.random(100)
+        result = {}
+        consumer = threading.Thread(target=lambda: result.update(out=drain(stream, data.size)))
+        consumer.start()
+        stream.push(data)
+        consumer.join()
+        self.assertTrue(np.allclose(result['out'], data))
+
+class StreamAlignerTestCase(unittest.TestCase):
+
+    def test_aligned_reads(self):
+        streams = [make_stream(100) for _ in range(3)]
+        aligner = StreamAligner(streams)
+        for stream, n in zip(streams, [5, 8, 6]):
+            stream.push(np.arange(n, dtype=np.float64))
+        chunks = aligner.read()
+        self.assertEqual([c.size for c in chunks], [5, 5, 5])
+        self.assertTrue(all(np.shares_memory(c, s.buff_np) for c, s in zip(chunks, streams)))
+        self.assertTrue(all(np.all(c == np.arange(5)) for c in chunks))
+        # The leftover points stay where they are until the others catch up
+        self.assertIsNone(aligner.read())
+        streams[0].push(np.arange(5, 10, dtype=np.float64))
+        streams[2].push(np.arange(6, 10, dtype=np.float64))
+        chunks = aligner.read(max_points=2)
+        self.assertTrue(all(np.all(c == [5, 6]) for c in chunks))
+        self.assertEqual(aligner.consumed, [7, 7, 7])
+
+    def test_skewed_streams(self):
+        streams = [make_stream(1000, buffer_size=16) for _ in range(2)]
+        data    = np.random.random(1000)
+        aligner = StreamAligner(streams)
+        received = []
+        def consume():
+            total = 0
+            while total < data.size:
+                chunks = aligner.read()
+                if chunks is None:
+                    continue
+                self.assertTrue(np.all(chunks[0] == chunks[1]))
+                received.append(chunks[0].copy())
+                total += chunks[0].size
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        # One stream gets far ahead of the other, which would fill its ring buffer
+        for stream in streams:
+            for chunk in np.split(data, 50):
+                stream.push(chunk)
+        consumer.join()
+        self.assertTrue(np.all(np.concatenate(received) == data))
+
+class SocketReceiverTestCase(unittest.TestCase):
+
+    def send(self, sock, messages):
+        for msg in messages:
+            sock.sendall(struct.pack('n', msg.nbytes) + msg.tobytes())
+
+    def receive(self, receiver, num_messages):
+        for _ in range(num_messages):
+            receiver.receive()
+
+    def drain(self, stream, num_points):
+        received = []
+        while sum(r.size for r in received) < num_points:
+            data = stream.pop()
+            if data is not None:
+                received.append(data.copy())
+        stream.release()
+        return np.concatenate(received)
+
+    def test_receive_into_stream(self):
+        rsock, wsock = socket.socketpair()
+        stream   = make_stream(500, dtype=np.float32, buffer_size=64)
+        oc       = OutputConnector()
+        oc.add_output_stream(stream)
+        receiver = SocketReceiver(rsock, oc, np.float32)
+        self.assertIs(receiver.stream, stream)
+
+        messages = np.split(np.random.random(500).astype(np.float32), 10)
+        sender   = threading.Thread(target=self.send, args=(wsock, messages))
+        reader   = threading.Thread(target=self.receive, args=(receiver, len(messages)))
+        sender.start()
+        reader.start()
+        # With nobody consuming, the receiver waits for room instead of reading on
+        time.sleep(0.1)
+        self.assertTrue(stream.blocked.value)
+        self.assertEqual(stream.head.value, 50)
+
+        received = self.drain(stream, 500)
+        reader.join()
+        sender.join()
+        self.assertTrue(np.all(received == np.concatenate(messages)))
+        self.assertEqual(len(oc), 500)
+        self.assertEqual(stream.points_taken.value, 500)
+        rsock.close()
+        wsock.close()
+
+    def test_receive_into_buffer(self):
+        rsock, wsock = socket.socketpair()
+        streams  = [make_stream(500, dtype=np.float32) for _ in range(2)]
+        oc       = OutputConnector()
+        for stream in streams:
+            oc.add_output_stream(stream)
+        receiver = SocketReceiver(rsock, oc, np.float32)
+        self.assertIsNone(receiver.stream)
+
+        messages = np.split(np.random.random(500).astype(np.float32), 5)
+        self.send(wsock, messages)
+        self.receive(receiver, len(messages))
+        for stream in streams:
+            self.assertTrue(np.all(self.drain(stream, 500) == np.concatenate(messages)))
+        self.assertEqual(len(oc), 500)
+
+        wsock.close()
+        with self.assertRaises(ConnectionError):
+            receiver.receive()
+        rsock.close()
+
+    def test_timeouts(self):
+        rsock, wsock = socket.socketpair()
+        rsock.settimeout(0.1)
+        stream   = make_stream(500, dtype=np.float32, buffer_size=64)
+        oc       = OutputConnector()
+        oc.add_output_stream(stream)
+        receiver = SocketReceiver(rsock, oc, np.float32)
+
+        # Nothing arrived, so the caller may simply try again
+        with self.assertRaises(socket.timeout):
+            receiver.receive()
+
+        # Half a message arrived, which leaves the framing broken
+        msg = np.arange(100, dtype=np.float32)
+        wsock.sendall(struct.pack('n', msg.nbytes) + msg[:30].tobytes())
+        with self.assertRaises(ConnectionError):
+            receiver.receive()
+        self.assertEqual(len(oc), stream.head.value)
+        rsock.close()
+        wsock.close()
+
+class DescriptorTuplesTestCase(unittest.TestCase):
+
+    def make_descriptor(self):
+        desc = DataStreamDescriptor()
+        desc.add_axis(DataAxis("time", np.arange(5)))
+        desc.add_axis(DataAxis("qubit", [0, 1, 2], metadata=["q1", "q2", "readout"]))
+        desc.add_axis(DataAxis("field", [10.0, 20.0]))
+        return desc
+
+    def test_expected_tuples(self):
+        desc     = self.make_descriptor()
+        tuples   = desc.expected_tuples()
+        expected = [(f, q, m, t) for f, (q, m), t in itertools.product([10.0, 20.0], zip([0, 1, 2], ["q1", "q2", "readout"]), range(5))]
+        self.assertEqual(tuples.dtype.names, ("field", "qubit", "qubit_metadata", "time"))
+        self.assertTrue(np.all(tuples['field'] == [t[0] for t in expected]))
+        self.assertTrue(np.all(tuples['qubit'] == [t[1] for t in expected]))
+        self.assertEqual(tuples['qubit_metadata'].tolist(), [t[2] for t in expected])
+        self.assertTrue(np.all(tuples['time'] == [t[3] for t in expected]))
+        # Any slice can be had without the rest
+        self.assertTrue(np.all(desc.expected_tuples(start=7, stop=19) == tuples[7:19]))
+        without_qubit = desc.expected_tuples(excluding_axis="qubit")
+        self.assertEqual(without_qubit.dtype.names, ("field", "time"))
+        self.assertEqual(len(without_qubit), 10)
+
+    def test_large_grid(self):
+        desc = DataStreamDescriptor()
+        for name, n in [("a", 100), ("b", 100), ("c", 100)]:
+            desc.add_axis(DataAxis(name, np.arange(n)))
+        start  = time.time()
+        tuples = desc.expected_tuples()
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(len(tuples), 10**6)
+        self.assertEqual(tuple(tuples[123456]), (12, 34, 56))
+
+    def test_visited_tuples(self):
+        desc = self.make_descriptor()
+        desc.axes[0] = SweepAxis(FloatParameter(name="field"), [1.0, 2.0, 3.0])
+        copy = desc.copy()
+        for value in [1.0, 2.0, 3.0]:
+            desc.add_visited_tuples(desc.sweep_tuples([(value,)]))
+            copy.add_visited_tuples(copy.sweep_tuples([(-value,)]))
+        self.assertEqual(len(desc.visited_tuples), 45)
+        self.assertTrue(np.all(desc.visited_tuples['field'] == np.repeat([1.0, 2.0, 3.0], 15)))
+        self.assertTrue(np.all(copy.visited_tuples['field'] == np.repeat([-1.0, -2.0, -3.0], 15)))
+        self.assertTrue(np.all(desc.visited_tuples['time'][:5] == np.arange(5)))
+        self.assertEqual(desc.visited_tuples['qubit_metadata'][:15].tolist(), ["q1"]*5 + ["q2"]*5 + ["readout"]*5)
+        desc.visited_tuples = []
+        self.assertEqual(len(desc.visited_tuples), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@
 import unittest
 import time
 import os
+import itertools
 import numpy as np
 
 import auspex.config as config
@@ -16,7 +17,8 @@ config.auspex_dummy_mode = True
 
 from auspex.experiment import Experiment
 from auspex.parameter import FloatParameter
-from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
+from auspex.stream import DataStream, DataAxis, SweepAxis, DataStreamDescriptor, OutputConnector
+from auspex.sweep import Sweeper
 from auspex.filters.debug import Print
 from auspex.filters.io import WriteToFile
 from auspex.log import logger
@@ -58,6 +60,36 @@ class SweptTestExperiment(Experiment):
         logger.debug("Stream pushed points {}.".format(data_row))
         logger.debug("Stream has filled {} of {} points".format(self.voltage.points_taken, self.voltage.num_points() ))
 
+class RecordingExperiment(Experiment):
+    """Records the values that reach the instruments, and those seen by each run."""
+
+    field   = FloatParameter(unit="Oe")
+    freq    = FloatParameter(unit="Hz")
+    voltage = OutputConnector()
+
+    def init_instruments(self):
+        self.pushed = []
+        self.seen   = []
+        self.field.assign_method(lambda x: self.pushed.append(("field", x)))
+        self.freq.assign_method(lambda x: self.pushed.append(("freq", x)))
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("trials", list(range(5))))
+
+    def run(self):
+        self.seen.append((self.freq.value, self.field.value))
+        time.sleep(0.002)
+        self.voltage.push(np.random.random(5))
+
+class SlowInstrument(object):
+    def __init__(self, delay=0.1):
+        self.delay  = delay
+        self.values = []
+
+    def set_value(self, value):
+        time.sleep(self.delay)
+        self.values.append(value)
+
 class SweepTestCase(unittest.TestCase):
 
     def test_add_sweep(self):
@@ -135,5 +167,52 @@ class SweepTestCase(unittest.TestCase):
         exp.run_sweeps()
         self.assertTrue(pri.sink.input_streams[0].points_taken.value == exp.voltage.num_points())
 
+    def test_settle_times_overlap(self):
+        sweeper = Sweeper()
+        params  = [FloatParameter(name=n, settle_time=0.1) for n in ["a", "b", "c"]]
+        for p in params:
+            p.assign_method(lambda x: None)
+        sweeper.add_sweep(SweepAxis(params, [[1, 2, 3], [4, 5, 6]]))
+        start = time.time()
+        sweeper.update()
+        sweeper.update()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual([p.value for p in params], [4, 5, 6])
+
+    def test_concurrent_pushes(self):
+        sweeper = Sweeper()
+        sweeper.concurrent = True
+        shared, other = SlowInstrument(), SlowInstrument()
+        a = FloatParameter(name="a")
+        b = FloatParameter(name="b")
+        c = FloatParameter(name="c")
+        a.assign_method(shared.set_value)
+        b.assign_method(other.set_value)
+        c.assign_method(lambda x: shared.set_value(-x))
+        c.instrument = shared
+        sweeper.add_sweep(SweepAxis([a, b, c], [[1, 2, 3], [4, 5, 6]]))
+        start = time.time()
+        sweeper.update()
+        sweeper.update()
+        # The two instruments are set up at the same time...
+        self.assertLess(time.time() - start, 0.7)
+        # ...but the parameters of each one are pushed in order
+        self.assertEqual(shared.values, [1, -3, 4, -6])
+        self.assertEqual(other.values, [2, 5])
+
+    def test_prefetch(self):
+        results = []
+        for prefetch in [False, True]:
+            exp = RecordingExperiment()
+            pri = Print()
+            exp.set_graph([(exp.voltage, pri.sink)])
+            exp.add_sweep(exp.field, np.linspace(0, 100.0, 4))
+            exp.add_sweep(exp.freq, np.linspace(0, 10.0, 3))
+            exp.sweeper.prefetch = prefetch
+            exp.run_sweeps()
+            results.append((exp.pushed, exp.seen))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][1], list(itertools.product(np.linspace(0, 10.0, 3), np.linspace(0, 100.0, 4))))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,220 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import time
+import socket
+import threading
+import numpy as np
+
+import auspex.config as config
+config.auspex_dummy_mode = True
+
+from multiprocessing import Process, Event, Value
+from auspex.instruments.alazar import AlazarATS9870, AlazarChannel
+from auspex.instruments.X6 import X6, X6Channel
+from auspex.instruments.instrument import SocketReceiver
+from auspex.instruments.synthetic import SyntheticATS9870, SyntheticX6
+from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
+
+def alazar_config(segments, round_robins, record_length=512):
+    return {'recordLength': record_length, 'nbrSegments': segments, 'nbrWaveforms': 1,
+            'nbrRoundRobins': round_robins, 'samplingRate': 500e6}
+
+def make_connector(num_points, dtype):
+    desc = DataStreamDescriptor(dtype=dtype)
+    desc.add_axis(DataAxis("samples", list(range(num_points))))
+    stream = DataStream(name="test")
+    stream.set_descriptor(desc)
+    stream.final_init()
+    oc = OutputConnector(dtype=dtype)
+    oc.set_descriptor(desc)
+    oc.add_output_stream(stream)
+    return oc, stream
+
+def consume(stream, num_points):
+    received = []
+    while sum(r.size for r in received) < num_points:
+        data = stream.pop()
+        if data is not None:
+            received.append(data.copy())
+    stream.release()
+    return np.concatenate(received)
+
+class SyntheticDigitizerTestCase(unittest.TestCase):
+
+    def test_deterministic(self):
+        """Check that sources with the same seed send the same data."""
+        blocks = []
+        for seed in [1, 1, 2]:
+            lib = SyntheticATS9870(states=[0, 0.5, 1], seed=seed)
+            lib.setAll(alazar_config(3, 10))
+            lib.register_socket(0, None)
+            lib._prepare()
+            blocks.append(lib._messages[0])
+        self.assertEqual(blocks[0], blocks[1])
+        self.assertNotEqual(blocks[0], blocks[2])
+
+    def test_qubit_states(self):
+        """Check that integrated records follow the qubit states."""
+        rsock, wsock = socket.socketpair()
+        lib = SyntheticX6(states=[0, 1, 0.5], snr=20.0, num_blocks=8)
+        lib.nbr_segments, lib.nbr_round_robins = 3, 64
+        lib.register_socket(1, 0, 1, wsock)
+        oc, stream = make_connector(3*64, np.complex128)
+        receiver = SocketReceiver(rsock, oc, np.complex128)
+
+        lib.acquire()
+        for _ in range(64):
+            receiver.receive()
+        lib.stop()
+        data = consume(stream, 3*64).reshape(64, 3)
+        self.assertTrue(np.allclose(data[:, 0], 1.0, atol=0.25))
+        self.assertTrue(np.allclose(data[:, 1], -1.0, atol=0.25))
+        self.assertTrue(np.all(np.abs(data[:, 2].imag) < 0.25))
+        self.assertTrue(0.2 < np.mean(data[:, 2].real < 0) < 0.8)
+        self.assertFalse(lib.get_is_running())
+        rsock.close()
+        wsock.close()
+
+    def test_rate(self):
+        """Check that a rate limited source takes as long as it should."""
+        rsock, wsock = socket.socketpair()
+        lib = SyntheticATS9870(rate=2000)
+        lib.setAll(alazar_config(10, 40, record_length=64))
+        lib.register_socket(0, wsock)
+        oc, stream = make_connector(400*64, np.float32)
+        receiver = SocketReceiver(rsock, oc, np.float32)
+
+        start = time.time()
+        lib.acquire()
+        for _ in range(40):
+            receiver.receive()
+            stream.pop()
+        lib.stop()
+        self.assertGreater(time.time() - start, 0.19)
+        self.assertEqual(len(oc), 400*64)
+        rsock.close()
+        wsock.close()
+
+    def test_alazar_acquisition(self):
+        """Check that the Alazar driver takes the synthetic data as it would the hardware's."""
+        dig = AlazarATS9870(resource_name="1", name="Synthetic Alazar")
+        dig.synthetic = dict(states=[0, 1], snr=5.0)
+        chan = AlazarChannel()
+        chan.phys_channel = 1
+        dig.add_channel(chan)
+        dig.connect()
+        dig._lib.setAll(alazar_config(2, 200))
+        dig.number_segments, dig.number_averages, dig.record_length = 2, 200, 512
+
+        num_points = 2*200*512
+        oc, stream = make_connector(num_points, np.float32)
+        exit, run, ready = Event(), Event(), Value('i', 0)
+        listener = Process(target=dig.receive_data, args=(chan, oc, exit, ready, run))
+        listener.start()
+        while ready.value < 1:
+            time.sleep(0.01)
+
+        received = []
+        consumer = threading.Thread(target=lambda: received.append(consume(stream, num_points)))
+        consumer.start()
+        dig.acquire()
+        run.set()
+        dig.wait_for_acquisition(run, timeout=5, ocs=[oc])
+        consumer.join()
+        dig.stop()
+        exit.set()
+        listener.join()
+
+        self.assertEqual(dig.total_received.value, num_points)
+        self.assertEqual(received[0].size, num_points)
+        self.assertGreater(dig._lib.throughput(), 0)
+        dig.disconnect()
+
+    def test_x6_completion(self):
+        """Check that waiting on the X6 ends as soon as the last points arrive, without polling."""
+        dig = X6(resource_name="0", name="Synthetic X6")
+        dig.synthetic = dict(states=[0, 1], snr=5.0)
+        chan = X6Channel()
+        chan.stream_type = "raw"
+        dig.add_channel(chan)
+        dig.connect()
+        dig.get_socket(chan)
+        dig.record_length, dig.number_segments, dig.number_averages = 1024, 2, 100
+        # Completion must come from the receiver, not the library or the progress updates
+        dig.done = lambda: False
+        dig.progress_interval = 10.0
+
+        num_points = 256*2*100
+        oc, stream = make_connector(num_points, np.float64)
+        exit, run, ready = Event(), Event(), Value('i', 0)
+        listener = Process(target=dig.receive_data, args=(chan, oc, exit, ready, run))
+        listener.start()
+        while ready.value < 1:
+            time.sleep(0.01)
+
+        consumer = threading.Thread(target=consume, args=(stream, num_points))
+        consumer.start()
+        start = time.time()
+        dig.acquire()
+        run.set()
+        dig.wait_for_acquisition(run, timeout=5, ocs=[oc])
+        elapsed = time.time() - start
+        consumer.join()
+        dig.stop()
+        exit.set()
+        listener.join()
+
+        self.assertEqual(dig.expected_points.value, num_points)
+        self.assertEqual(dig.total_received.value, num_points)
+        self.assertLess(elapsed, 5.0)
+        dig.disconnect()
+
+    def test_x6_hardware_completion(self):
+        """Check that on hardware only the library ends the wait, whatever number of points is expected."""
+        dig = X6(resource_name="0", name="Synthetic X6")
+        dig.synthetic = dict(states=[0, 1], snr=5.0)
+        chan = X6Channel()
+        chan.stream_type = "raw"
+        dig.add_channel(chan)
+        dig.connect()
+        dig.get_socket(chan)
+        dig.record_length, dig.number_segments, dig.number_averages = 1024, 2, 100
+        # Stand in for the hardware, which finishes some time after the data are all in
+        dig.synthetic = None
+        finish = time.time() + 1.0
+        dig.done = lambda: time.time() > finish
+
+        num_points = 256*2*100
+        oc, stream = make_connector(num_points, np.float64)
+        exit, run, ready = Event(), Event(), Value('i', 0)
+        listener = Process(target=dig.receive_data, args=(chan, oc, exit, ready, run))
+        listener.start()
+        while ready.value < 1:
+            time.sleep(0.01)
+
+        consumer = threading.Thread(target=consume, args=(stream, num_points))
+        consumer.start()
+        dig.acquire()
+        self.assertEqual(dig.expected_points.value, 0)
+        dig.expected_points.value = 1 # A miscount, reached by the first message
+        run.set()
+        dig.wait_for_acquisition(run, timeout=5, ocs=[oc])
+        self.assertGreater(time.time(), finish)
+        consumer.join()
+        dig.stop()
+        exit.set()
+        listener.join()
+
+        self.assertTrue(dig.acquisition_complete.is_set())
+        self.assertEqual(dig.total_received.value, num_points)
+        dig.disconnect()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,7 +22,7 @@ from auspex.experiment import Experiment
 from auspex.parameter import FloatParameter
 from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
 from auspex.filters.debug import Print
-from auspex.filters.io import WriteToFile
+from auspex.filters.io import WriteToFile, AsyncWriter
 from auspex.log import logger
 from auspex.data_format import AuspexDataContainer
 
@@ -332,6 +332,125 @@ class WriteTestCase(unittest.TestCase):
             self.assertTrue(desc1.axis('freq').unit == "Hz")
             self.assertTrue(desc1.axis('freq').unit == "Hz")
 
+    def test_async_writer(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            data = np.random.random(10000)
+            mm = np.memmap(tmpdirname+"/async.dat", dtype=np.float64, mode='w+', shape=data.shape)
+            commits = []
+            writer = AsyncWriter(mm, np.float64, 1024, queue_depth=2, sync_interval=0.0, fsync=True, commit=commits.append)
+            for chunk in np.array_split(data, 37):
+                writer.write(chunk)
+            writer.close()
+            # Each sync commits every block written so far, including the one that prompted it
+            self.assertGreater(min(commits), 0)
+            self.assertTrue(all(c % 1024 == 0 or c == data.size for c in commits))
+            self.assertEqual(commits[-1], data.size)
+            stats = writer.stats()
+            self.assertEqual(stats['points_written'], data.size)
+            self.assertEqual(stats['lag'], 0)
+            self.assertGreater(stats['max_lag'], 0)
+            self.assertTrue(np.all(np.fromfile(tmpdirname+"/async.dat") == data))
+
+    def test_resume(self):
+        for version in [1, 2]:
+            with tempfile.TemporaryDirectory() as tmpdirname:
+                exp = SweptTestExperiment()
+                wr = WriteToFile(tmpdirname+"/test_resume.auspex", version=version, chunk_bytes=40)
+                exp.set_graph([(exp.voltage, wr.sink)])
+                exp.add_sweep(exp.field, np.linspace(0,100.0,4))
+                exp.add_sweep(exp.freq, np.linspace(0,10.0,3))
+                exp.run_sweeps()
+
+                container = AuspexDataContainer(tmpdirname+"/test_resume-0000.auspex")
+                complete, _, _ = container.open_dataset('main', 'data')
+                complete = complete.load()
+                self.assertEqual(container._read_meta('main', 'data')['committed_points'], complete.size)
+
+                # Pretend the run died after 7 sweep points had been committed
+                container.commit('main', 'data', 7*5 + 3)
+
+                exp = SweptTestExperiment()
+                exp.resume = True
+                wr = WriteToFile(tmpdirname+"/test_resume.auspex", version=version, chunk_bytes=40)
+                exp.set_graph([(exp.voltage, wr.sink)])
+                exp.add_sweep(exp.field, np.linspace(0,100.0,4))
+                exp.add_sweep(exp.freq, np.linspace(0,10.0,3))
+                fields, freqs = [], []
+                def init_instruments():
+                    exp.field.assign_method(fields.append)
+                    exp.freq.assign_method(freqs.append)
+                exp.init_instruments = init_instruments
+                exp.run_sweeps()
+
+                self.assertFalse(os.path.exists(tmpdirname+"/test_resume-0001.auspex"))
+                self.assertEqual(fields, [100.0, 0.0, 33.333333333333336, 66.66666666666667, 100.0])
+                self.assertEqual(freqs, [5.0, 10.0])
+                data, _, _ = AuspexDataContainer(tmpdirname+"/test_resume-0000.auspex").open_dataset('main', 'data')
+                self.assertTrue(np.all(np.ravel(data)[:35] == np.ravel(complete)[:35]))
+                self.assertFalse(np.any(np.ravel(data)[35:] == np.ravel(complete)[35:]))
+
+    def test_open_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            exp = SweptTestExperiment()
+            wr1 = WriteToFile(tmpdirname+"/test_open_lazy.auspex", groupname="group1")
+            wr2 = WriteToFile(tmpdirname+"/test_open_lazy.auspex", groupname="group2")
+
+            edges = [(exp.voltage, wr1.sink), (exp.current, wr2.sink)]
+            exp.set_graph(edges)
+
+            exp.add_sweep(exp.field, np.linspace(0,100.0,4))
+            exp.run_sweeps()
+
+            container = AuspexDataContainer(tmpdirname+"/test_open_lazy-0000.auspex")
+            self.assertEqual(set(container.groups), {"group1", "group2"})
+            self.assertIsNone(container.groups["group1"].datasets["data"])
+            data, desc, _ = container.groups["group1"]["data"]
+            self.assertIsNone(container.groups["group2"].datasets["data"])
+            self.assertIsInstance(data, np.memmap)
+            self.assertEqual(data.shape, (4, 5))
+            # Axis points are only built when they are used
+            self.assertEqual(sorted(desc.dims()), [4, 5])
+            self.assertTrue(all(a._points is None for a in desc.axes))
+            field = next(a for a in desc.axes if a.name == "field")
+            self.assertTrue(np.allclose(field.points, np.linspace(0,100.0,4)))
+            self.assertIs(field.original_points, field.points)
+            loaded = data.load()
+            self.assertNotIsInstance(loaded, np.memmap)
+            self.assertTrue(np.all(loaded == data))
+            # Changes stay in memory
+            data[0] = 0.0
+            data, _, _ = container.open_dataset("group1", "data")
+            self.assertTrue(np.all(data == loaded))
+
+    def test_write_chunked(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            exp = SweptTestExperiment()
+            wr1 = WriteToFile(tmpdirname+"/test_write_chunked.auspex", groupname="flat")
+            wr2 = WriteToFile(tmpdirname+"/test_write_chunked.auspex", groupname="zlib", version=2, chunk_bytes=40)
+            wr3 = WriteToFile(tmpdirname+"/test_write_chunked.auspex", groupname="lzma", version=2, compression="lzma")
+
+            edges = [(exp.voltage, wr1.sink), (exp.voltage, wr2.sink), (exp.voltage, wr3.sink)]
+            exp.set_graph(edges)
+
+            exp.add_sweep(exp.field, np.linspace(0,100.0,4))
+            exp.add_sweep(exp.freq, np.linspace(0,10.0,3))
+            exp.run_sweeps()
+
+            container = AuspexDataContainer(tmpdirname+"/test_write_chunked-0000.auspex")
+            data, desc, _ = container.open_dataset('flat', 'data')
+            chunked, chunked_desc, _ = container.open_dataset('zlib', 'data')
+            self.assertEqual(chunked.shape, data.shape)
+            # Records of 5 points, 2 to a chunk (the last one partial)
+            self.assertEqual(len(chunked.index), 6)
+            self.assertTrue(np.all(np.array(chunked) == data))
+            self.assertTrue(np.all(chunked[2] == data[2]))
+            self.assertTrue(np.all(chunked[1:3, -1, ::2] == data[1:3, -1, ::2]))
+            self.assertTrue(np.all(chunked[..., 3] == data[..., 3]))
+            self.assertTrue(np.all(chunked[[2, 0], 1] == data[[2, 0], 1]))
+            self.assertTrue(np.all(chunked_desc['freq'] == np.linspace(0,10.0,3)))
+            chunked, _, _ = container.open_dataset('lzma', 'data')
+            self.assertTrue(np.all(chunked[...] == data))
+
     def test_write_complex(self):
         with tempfile.TemporaryDirectory() as tmpdirname:
             exp = SweptTestExperiment()